@@ -0,0 +1,285 @@
+import os
+import zlib
+import queue
+import struct
+from collections import deque
+from concurrent.futures import Executor, Future
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Callable, Deque, List, NamedTuple, Optional, Tuple, Union
+from .tracing import span
+
+# A zip writer that deflates files in parallel, pigz-style: large files are split in chunks that are compressed
+# independently (each one primed with the last 32KiB of the previous chunk) and concatenated back in order.
+# Entries use data descriptors, so the output never needs to be seekable.
+# See: https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+DICT_SIZE = 32 * 1024
+
+_local_header = struct.Struct('<IHHHHHIIIHH')
+_central_header = struct.Struct('<IHHHHHHIIIHHHHHII')
+_end_record = struct.Struct('<IHHHHIIH')
+_end_record64 = struct.Struct('<IQHHIIQQQQ')
+_end_locator64 = struct.Struct('<IIQI')
+
+FLAG_DATA_DESCRIPTOR = 1 << 3
+FLAG_UTF8 = 1 << 11
+METHOD_DEFLATE = 8
+
+
+class _Entry(NamedTuple):
+    name: bytes
+    flags: int
+    dos_time: int
+    dos_date: int
+    crc: int
+    compress_size: int
+    file_size: int
+    offset: int
+    mode: int
+
+
+def _dos_datetime(mtime: float):
+    t = datetime.fromtimestamp(max(mtime, 315532800))  # DOS dates start in 1980
+    return (t.hour << 11 | t.minute << 5 | t.second // 2), ((t.year - 1980) << 9 | t.month << 5 | t.day)
+
+
+def _deflate(data: bytes, zdict: Optional[bytes], level: int, last: bool) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict) if zdict \
+        else zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _deflate_job(entry: '_PendingEntry', data: bytes, zdict: Optional[bytes], level: int, last: bool) \
+        -> Tuple['_PendingEntry', bytes, int]:
+    with span('zip.compress', bytes=len(data)):
+        return entry, _deflate(data, zdict, level, last), len(data)
+
+
+class ZipWriter:
+    def __init__(self, out: BinaryIO, executor: Executor, level: int = 6,
+                 chunk_size: int = 1024 * 1024, max_pending: int = 16):
+        self.out: BinaryIO = out
+        self.executor: Executor = executor
+        self.level: int = level
+        self.chunk_size: int = chunk_size
+        self.max_pending: int = max_pending
+        self.offset: int = 0
+        self.entries: List[_Entry] = []
+        # Things to write, in order: compressed chunks as futures, headers/descriptors as callables
+        self._pending: Deque[Union[Future, Callable]] = deque()
+        self._n_futures: int = 0
+        self.closed: bool = False
+
+    def __enter__(self) -> 'ZipWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            if not self.closed:
+                self.close()
+        else:
+            for item in self._pending:
+                if isinstance(item, Future):
+                    item.cancel()
+
+    def _write(self, data: bytes):
+        # Blocks while a streamed upload catches up
+        with span('zip.write', bytes=len(data)):
+            self.out.write(data)
+        self.offset += len(data)
+
+    def _flush(self, max_futures: int = 0) -> int:
+        # Writes out pending items until at most `max_futures` compression jobs are still in flight;
+        # returns the number of uncompressed bytes that were written
+        written = 0
+        while self._pending:
+            item = self._pending[0]
+            if isinstance(item, Future):
+                if self._n_futures <= max_futures and not item.done():
+                    break
+                self._n_futures -= 1
+                entry, data, src_size = item.result()
+                self._write(data)
+                entry.compress_size += len(data)
+                written += src_size
+            else:
+                item()
+            self._pending.popleft()
+        return written
+
+    def write(self, src_path: Path, arcname: str, st: Optional[os.stat_result] = None) -> int:
+        # Queues a file to be written to the archive; returns the number of uncompressed bytes
+        # written out meanwhile (to report progress)
+        st = st or os.stat(src_path)
+        entry = _PendingEntry(self, arcname, st)
+        self._pending.append(entry.write_header)
+
+        written = 0
+        crc = 0
+        prev_tail = None
+        with open(src_path, 'rb') as f:
+            data = f.read(self.chunk_size)
+            while True:
+                next_data = f.read(self.chunk_size) if len(data) == self.chunk_size else b''
+                last = not next_data
+                crc = zlib.crc32(data, crc)
+                entry.file_size += len(data)
+                future = self.executor.submit(_deflate_job, entry, data, prev_tail, self.level, last)
+                self._pending.append(future)
+                self._n_futures += 1
+                written += self._flush(self.max_pending)
+                if last:
+                    break
+                prev_tail = data[-DICT_SIZE:]
+                data = next_data
+
+        entry.crc = crc
+        self._pending.append(entry.write_descriptor)
+        return written
+
+    def close(self) -> int:
+        written = self._flush()
+
+        cd_offset = self.offset
+        for e in self.entries:
+            extra = b''
+            file_size, compress_size, offset = e.file_size, e.compress_size, e.offset
+            zip64_fields = []
+            if file_size >= ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+                file_size = ZIP64_LIMIT
+            if compress_size >= ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+                compress_size = ZIP64_LIMIT
+            if offset >= ZIP64_LIMIT:
+                zip64_fields.append(offset)
+                offset = ZIP64_LIMIT
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields else 20
+            self._write(_central_header.pack(
+                0x02014b50, (3 << 8) | version, version, e.flags, METHOD_DEFLATE, e.dos_time, e.dos_date,
+                e.crc, compress_size, file_size, len(e.name), len(extra), 0, 0, 0, e.mode << 16, offset))
+            self._write(e.name)
+            self._write(extra)
+        cd_size = self.offset - cd_offset
+
+        n_entries = len(self.entries)
+        if n_entries >= ZIP_MAX_ENTRIES or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            end64_offset = self.offset
+            self._write(_end_record64.pack(0x06064b50, _end_record64.size - 12, (3 << 8) | 45, 45, 0, 0,
+                                           n_entries, n_entries, cd_size, cd_offset))
+            self._write(_end_locator64.pack(0x07064b50, 0, end64_offset, 1))
+            n_entries = min(n_entries, ZIP_MAX_ENTRIES)
+            cd_size = min(cd_size, ZIP64_LIMIT)
+            cd_offset = min(cd_offset, ZIP64_LIMIT)
+        self._write(_end_record.pack(0x06054b50, 0, 0, n_entries, n_entries, cd_size, cd_offset, 0))
+        self.out.flush()
+        self.closed = True
+        return written
+
+
+class _PendingEntry:
+    def __init__(self, writer: ZipWriter, arcname: str, st: os.stat_result):
+        self.writer: ZipWriter = writer
+        self.name: bytes = arcname.encode('utf-8')
+        self.flags: int = FLAG_DATA_DESCRIPTOR | (FLAG_UTF8 if not arcname.isascii() else 0)
+        self.dos_time, self.dos_date = _dos_datetime(st.st_mtime)
+        self.mode: int = st.st_mode & 0xFFFF
+        # Decide upfront; files can not grow past this while the server is stopped
+        self.zip64: bool = st.st_size >= ZIP64_LIMIT // 2
+        self.offset: int = 0
+        self.crc: int = 0
+        self.file_size: int = 0
+        self.compress_size: int = 0
+
+    def write_header(self):
+        w = self.writer
+        self.offset = w.offset
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            sizes = ZIP64_LIMIT
+        else:
+            extra = b''
+            sizes = 0
+        w._write(_local_header.pack(0x04034b50, 45 if self.zip64 else 20, self.flags, METHOD_DEFLATE,
+                                    self.dos_time, self.dos_date, 0, sizes, sizes, len(self.name), len(extra)))
+        w._write(self.name)
+        w._write(extra)
+
+    def write_descriptor(self):
+        w = self.writer
+        size_fmt = 'Q' if self.zip64 else 'I'
+        w._write(struct.pack(f'<II{size_fmt}{size_fmt}', 0x08074b50, self.crc, self.compress_size, self.file_size))
+        w.entries.append(_Entry(name=self.name, flags=self.flags, dos_time=self.dos_time, dos_date=self.dos_date,
+                                crc=self.crc, compress_size=self.compress_size, file_size=self.file_size,
+                                offset=self.offset, mode=self.mode))
+
+
+class ChunkPipe:
+    # A write-only file object that hands out what is written to it in fixed-size chunks, to be consumed by
+    # another thread; at most `max_chunks` are buffered, after which writers block
+    _EOF = object()
+
+    def __init__(self, chunk_size: int, max_chunks: int = 4):
+        self.chunk_size: int = chunk_size
+        self._queue: queue.Queue = queue.Queue(maxsize=max_chunks)
+        self._buffer: bytearray = bytearray()
+        self._aborted: bool = False
+        self._done: bool = False
+
+    def _put(self, item):
+        while True:
+            if self._aborted:
+                raise BrokenPipeError("Reader went away")
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error: Optional[BaseException] = None):
+        # Called by the writer when done; `error` is re-raised on the reader's side. Once the reader has gone away,
+        # there is nobody left to tell
+        try:
+            if error is None and self._buffer:
+                self._put(bytes(self._buffer))
+            self._buffer.clear()
+            self._put(error or self._EOF)
+        except BrokenPipeError:
+            self._buffer.clear()
+
+    def abort(self):
+        # Called by the reader to give up; unblocks the writer, whose next write will fail
+        self._aborted = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def read_chunk(self) -> bytes:
+        # Returns b'' at the end of the stream
+        if self._done:
+            return b''
+        item = self._queue.get()
+        if item is self._EOF:
+            self._done = True
+            return b''
+        elif isinstance(item, BaseException):
+            self._done = True
+            raise item
+        return item
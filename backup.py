@@ -0,0 +1,441 @@
+import os
+import json
+import zlib
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from . import env
+from . import region
+from .scan import ScanEntry, in_batches, scan_tree
+from .tracing import span
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+if TYPE_CHECKING:
+    from tqdm.auto import tqdm
+
+log = logging.getLogger()
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def blob_name(digest: str) -> str:
+    # Name of a blob once uploaded to remote storage
+    return f'blob-{digest}'
+
+
+def snapshot_name(base_name: str, time: Optional[datetime] = None) -> str:
+    time = time or datetime.now()
+    return f'{base_name}-{time:%Y%m%d-%H%M%S}'
+
+
+def _is_under(rel_path: str, paths: Set[str], itself: bool) -> bool:
+    # Whether any parent directory of `rel_path` (or `rel_path` itself) is in `paths`
+    parts = rel_path.split('/')
+    return any('/'.join(parts[:i]) in paths for i in range(1, len(parts) + itself))
+
+
+def write_json_atomic(path: Path, data: Any):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FileEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    sha256: Optional[str]  # None for region files, which are verified chunk by chunk instead
+    chunks: List[Union[str, Future, None]]  # Futures only while the backup is in progress
+    region: Optional[Tuple[List[int], List[int]]] = None  # (locations, timestamps) of region files
+
+
+class Snapshot(NamedTuple):
+    name: str
+    manifest_path: Path
+    blobs: List[Path]  # Blobs still to be uploaded (including leftovers from previous snapshots)
+    store: 'BackupStore'
+
+
+class BackupStore:
+    chunk_size = env.Var('CB_BACKUP_CHUNK_SIZE', type=int,
+                         help="Size (in bytes) of the content-addressed chunks that incremental backups split files in",
+                         optional=True,
+                         default=4 * 1024 * 1024)
+    compress_level = env.Var('CB_BACKUP_COMPRESS_LEVEL', type=int,
+                             help="Compression level for incremental backup blobs",
+                             optional=True,
+                             default=6)
+    codec = env.Var('CB_BACKUP_CODEC', type=str,
+                    help="Compression codec for incremental backup blobs\n"
+                    "`zlib`: always available\n"
+                    "`zstd`: faster and smaller, needs the `zstandard` package",
+                    optional=True,
+                    default='zlib')
+
+    INDEX_VERSION = 2
+
+    def __init__(self, root: Path, workers: int = 1):
+        # Layout:
+        # - `index.json`: path/size/mtime/hash of every file seen by the last backup, plus all known blobs
+        # - `outbox/<sha256>`: compressed blobs that still have to be uploaded
+        # - `snapshots/<name>.json`: per-snapshot manifests
+        self.root: Path = root
+        self.index_path: Path = root / 'index.json'
+        self.outbox: Path = root / 'outbox'
+        self.snapshots: Path = root / 'snapshots'
+        self.files: Dict[str, FileEntry] = {}
+        self.blobs: Set[str] = set()
+        self.workers: int = max(workers, 1)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._in_flight: Deque[Future] = deque()
+        self._zstd_compressors = threading.local()
+
+        if self.codec not in ('zlib', 'zstd'):
+            raise RuntimeError(f"Unknown backup codec: {self.codec}")
+        if self.codec == 'zstd' and zstandard is None:
+            raise RuntimeError("The zstd backup codec needs the `zstandard` package")
+
+        for path in (self.root, self.outbox, self.snapshots):
+            path.mkdir(parents=True, exist_ok=True)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            log.exception("Backup index is corrupt, starting from scratch")
+            return
+
+        if index.get('version') != self.INDEX_VERSION or index.get('chunk_size') != self.chunk_size:
+            log.warning("Backup index is outdated, starting from scratch")
+            return
+
+        self.files = {path: FileEntry(*entry) for path, entry in index['files'].items()}
+        self.blobs = set(index['blobs'])
+
+    def save(self):
+        write_json_atomic(self.index_path, {
+            'version': self.INDEX_VERSION,
+            'chunk_size': self.chunk_size,
+            'files': self.files,
+            'blobs': sorted(self.blobs),
+        })
+
+    def pending_blobs(self) -> List[Path]:
+        return sorted(p for p in self.outbox.iterdir() if not p.name.endswith('.tmp'))
+
+    def mark_uploaded(self, blob_path: Path):
+        blob_path.unlink(missing_ok=True)
+
+    def forget(self, digests: Iterable[str]):
+        # For blobs deleted from remote storage: chunks with the same contents have to be stored again
+        self.blobs.difference_update(digests)
+        self.save()
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.codec == 'zstd':
+            # Compressors are not thread-safe
+            if (compressor := getattr(self._zstd_compressors, 'compressor', None)) is None:
+                compressor = self._zstd_compressors.compressor = zstandard.ZstdCompressor(level=self.compress_level)
+            return compressor.compress(data)
+        return zlib.compress(data, self.compress_level)
+
+    def _put_blob(self, data: bytes) -> str:
+        # Runs on the worker threads; both hashing and compression release the GIL
+        with span('backup.hash', bytes=len(data)):
+            digest = hashlib.sha256(data).hexdigest()
+        if digest in self.blobs:
+            return digest
+
+        blob_path = self.outbox / digest
+        tmp_path = blob_path.with_name(f'{digest}.{threading.get_ident()}.tmp')
+        with span('backup.compress', bytes=len(data)):
+            compressed = self._compress(data)
+        with span('backup.write', bytes=len(compressed)), open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, blob_path)
+
+        self.blobs.add(digest)
+        return digest
+
+    def _submit_blob(self, data: bytes) -> Future:
+        future = self._executor.submit(self._put_blob, data)
+        self._in_flight.append(future)
+        # Bound the number of chunks held in memory
+        while len(self._in_flight) > 2 * self.workers:
+            self._in_flight.popleft().result()
+        return future
+
+    def _store_file(self, src_path: Path, st: os.stat_result, progress: 'tqdm', on_progress: Callable) -> FileEntry:
+        file_hash = hashlib.sha256()
+        chunks = []
+        with open(src_path, 'rb') as f:
+            while chunk := f.read(self.chunk_size):
+                file_hash.update(chunk)
+                chunks.append(self._submit_blob(chunk))
+                progress.update(len(chunk))
+                on_progress(progress)
+
+        return FileEntry(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=file_hash.hexdigest(), chunks=chunks)
+
+    def _store_region(self, src_path: Path, st: os.stat_result, prev: Optional[FileEntry],
+                      progress: 'tqdm', on_progress: Callable) -> FileEntry:
+        # Each Minecraft chunk becomes a blob; chunks whose location and timestamp did not change since the last
+        # backup are not even read
+        with open(src_path, 'rb') as f:
+            locations, timestamps = region.read_header(f)
+            prev_locations, prev_timestamps = prev.region if prev and prev.region else ([0] * region.N_CHUNKS,) * 2
+
+            chunks = []
+            for i, (location, timestamp) in enumerate(zip(locations, timestamps)):
+                if location == 0:
+                    chunks.append(None)
+                elif location == prev_locations[i] and timestamp == prev_timestamps[i] and prev.chunks[i]:
+                    chunks.append(prev.chunks[i])
+                else:
+                    chunks.append(self._submit_blob(region.read_chunk(f, location)))
+
+        progress.update(st.st_size)
+        on_progress(progress)
+        return FileEntry(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=None, chunks=chunks,
+                         region=(locations, timestamps))
+
+    def _store(self, src_path: Path, st: os.stat_result, prev: Optional[FileEntry], regions: bool,
+               progress: 'tqdm', on_progress: Callable) -> FileEntry:
+        if regions and src_path.suffix == '.mca' and st.st_size >= region.HEADER_SIZE:
+            try:
+                return self._store_region(src_path, st, prev, progress, on_progress)
+            except region.RegionError as err:
+                log.warning("Storing %s as a regular file: %s", src_path, err)
+        return self._store_file(src_path, st, progress, on_progress)
+
+    def _scan_changes(self, in_dir: Path, changes: Set[str]) -> Iterator[List[ScanEntry]]:
+        # Like `scan_tree`, but only looking at the paths that changed since the last backup; every other file is
+        # taken from the index as is
+        entries = [ScanEntry(rel_path, os.path.join(in_dir, rel_path), None)
+                   for rel_path in self.files if not _is_under(rel_path, changes, itself=True)]
+        for rel_path in changes:
+            if _is_under(rel_path, changes, itself=False):
+                continue
+            path = in_dir / rel_path
+            try:
+                if path.is_dir():
+                    if not path.is_symlink():
+                        for batch in scan_tree(path, prefix=rel_path + '/'):
+                            entries.extend(batch)
+                    continue
+                entries.append(ScanEntry(rel_path, str(path), path.stat()))
+            except FileNotFoundError:
+                # Deleted: dropped from the index along with the rest
+                continue
+        entries.sort(key=lambda entry: entry.rel_path)
+        return in_batches(entries)
+
+    def backup(self, in_dir: Path, base_name: str, on_progress: Optional[Callable] = None,
+               regions: bool = False, changes: Optional[Set[str]] = None,
+               dirs: Optional[Dict[str, Tuple[int, int]]] = None) -> Snapshot:
+        # `changes`: the paths (files or directories) that changed since the last backup, if known (see
+        # `ChangeJournal`), to avoid scanning the whole folder. `dirs`: filled with the directories seen by a full scan
+        if changes is not None and self.files:
+            batches = self._scan_changes(in_dir, changes)
+        else:
+            batches = scan_tree(in_dir, dirs=dirs)
+        on_progress = on_progress if on_progress is not None else (lambda *args, **kwargs: None)
+
+        name = snapshot_name(base_name)
+        files = {}
+        n_changed = 0
+        total_src_size = 0
+        from tqdm.auto import tqdm
+        # Files are backed up while the folder is still being scanned: until then, the total is the last backup's
+        progress = tqdm(total=sum(entry.size for entry in self.files.values()),
+                        leave=False, ncols=120, unit='B', unit_scale=True)
+        try:
+            with progress, ThreadPoolExecutor(self.workers) as self._executor:
+                while True:
+                    with span('backup.walk'):
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    for rel_path, src_path, st in batch:
+                        entry = self.files.get(rel_path)
+                        if st is None:
+                            # Known not to have changed
+                            files[rel_path] = entry
+                            total_src_size += entry.size
+                            progress.update(entry.size)
+                            continue
+                        total_src_size += st.st_size
+                        progress.set_description_str(rel_path)
+                        if entry is None or entry.size != st.st_size or entry.mtime_ns != st.st_mtime_ns:
+                            with span('backup.read', path=rel_path, bytes=st.st_size):
+                                entry = self._store(Path(src_path), st, entry, regions, progress, on_progress)
+                            n_changed += 1
+                        else:
+                            progress.update(st.st_size)
+                            on_progress(progress)
+                        files[rel_path] = entry
+                progress.total = total_src_size
+                progress.refresh()
+                on_progress(progress)
+                with span('backup.drain'):
+                    # Waits for the last blobs to be stored
+                    self._executor.shutdown(wait=True)
+        finally:
+            self._executor = None
+            self._in_flight.clear()
+
+        files = {path: entry._replace(chunks=[c.result() if isinstance(c, Future) else c for c in entry.chunks])
+                 for path, entry in files.items()}
+
+        # Files that disappeared since the last backup are dropped from the index here
+        self.files = files
+        manifest_path = self.snapshots / f'{name}.json'
+        with span('backup.index', files=len(files)):
+            self.save()
+            write_json_atomic(manifest_path, {
+                'version': self.INDEX_VERSION,
+                'name': name,
+                'folder': base_name,
+                'created': datetime.now().isoformat(),
+                'files': [dict(path=path, **entry._asdict()) for path, entry in files.items()],
+            })
+
+        blobs = self.pending_blobs()
+        log.info("Snapshot %s: %d/%d files changed, %d blobs to upload", name, n_changed, len(files), len(blobs))
+        return Snapshot(name=name, manifest_path=manifest_path, blobs=blobs, store=self)
+
+
+FICLONE = 0x40049409  # From <linux/fs.h>
+_can_reflink: bool = True
+
+
+def reflink(src: Path, dst: Path) -> bool:
+    # Copy-on-write clone of `src` (BTRFS, XFS, ...); returns False if not supported by the filesystem
+    global _can_reflink
+    if not _can_reflink:
+        return False
+    try:
+        import fcntl
+    except ImportError:
+        _can_reflink = False
+        return False
+
+    with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+        try:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+        except OSError as err:
+            if err.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                _can_reflink = False
+                return False
+            raise
+    return True
+
+
+def snapshot_tree(src_dir: Path, dst_dir: Path, prev_dir: Optional[Path] = None) -> Tuple[int, int]:
+    # Copies `src_dir` to `dst_dir` as fast as possible: files that did not change since `prev_dir` (an older
+    # snapshot) are hardlinked to it, the rest are reflinked or copied. Hardlinks are never made to `src_dir`
+    # itself, since the game keeps writing to its files in place.
+    # Returns (number of files copied, number of files linked)
+    n_copied, n_linked = 0, 0
+    for root, dirnames, filenames in os.walk(src_dir):
+        rel_root = Path(root).relative_to(src_dir)
+        (dst_dir / rel_root).mkdir(parents=True, exist_ok=True)
+        for f in filenames:
+            src_path = Path(root) / f
+            dst_path = dst_dir / rel_root / f
+            st = src_path.stat()
+            if prev_dir is not None:
+                prev_path = prev_dir / rel_root / f
+                try:
+                    prev_st = prev_path.stat()
+                except FileNotFoundError:
+                    prev_st = None
+                if prev_st and prev_st.st_size == st.st_size and prev_st.st_mtime_ns == st.st_mtime_ns:
+                    os.link(prev_path, dst_path)
+                    n_linked += 1
+                    continue
+
+            if reflink(src_path, dst_path):
+                shutil.copystat(src_path, dst_path)
+            else:
+                shutil.copy2(src_path, dst_path)
+            n_copied += 1
+
+    return n_copied, n_linked
+
+
+def read_blob(data: bytes) -> bytes:
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Restoring zstd blobs needs the `zstandard` package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def restore_file(file: Dict, dst_path: Path, fetch_blob: Callable[[str], bytes]):
+    file_hash = hashlib.sha256()
+    with open(dst_path, 'wb') as f:
+        for digest in file['chunks']:
+            chunk = read_blob(fetch_blob(digest))
+            file_hash.update(chunk)
+            f.write(chunk)
+
+    if file_hash.hexdigest() != file['sha256']:
+        raise RuntimeError(f"Hash mismatch when restoring {file['path']}")
+
+
+def restore_region(file: Dict, dst_path: Path, fetch_blob: Callable[[str], bytes],
+                   local_chunks: Optional[Dict[str, bytes]] = None):
+    # The rebuilt region file is not byte-for-byte identical to the original (chunks are packed back to back),
+    # but contains exactly the same chunks and timestamps.
+    # `local_chunks` maps hashes to (uncompressed) chunks that are already at hand, and need not be fetched
+    chunks = []
+    for digest in file['chunks']:
+        if digest is None:
+            chunks.append(None)
+            continue
+        if local_chunks is not None and digest in local_chunks:
+            chunks.append(local_chunks[digest])
+            continue
+        chunk = read_blob(fetch_blob(digest))
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise RuntimeError(f"Hash mismatch when restoring a chunk of {file['path']}")
+        chunks.append(chunk)
+
+    locations, timestamps = file['region']
+    with open(dst_path, 'wb') as f:
+        region.write_region(f, chunks, timestamps)
+
+
+def restore_snapshot(manifest: Dict, dest: Path, fetch_blob: Callable[[str], bytes],
+                     paths: Optional[Iterable[str]] = None):
+    # `fetch_blob(sha256)` must return the (compressed) contents of the given blob
+    wanted = set(paths) if paths is not None else None
+    for file in manifest['files']:
+        if wanted is not None and file['path'] not in wanted:
+            continue
+
+        dst_path = dest / file['path']
+        dst_path.parent.mkdir(parents=True, exist_ok=True)
+        if file.get('region'):
+            restore_region(file, dst_path, fetch_blob)
+        else:
+            restore_file(file, dst_path, fetch_blob)
+        os.utime(dst_path, ns=(file['mtime_ns'], file['mtime_ns']))
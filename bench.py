@@ -0,0 +1,628 @@
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import shutil
+import asyncio
+import hashlib
+import logging
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import parse_qs, urlsplit
+from . import env
+from . import region
+from .backup import BackupStore, Snapshot, snapshot_name
+from .game import Server
+from .gdrive import GDrive
+from .rcon import RconClient, RconError, RconPacket
+from .tracing import tracer
+
+log = logging.getLogger()
+
+# Benchmarks of backups, uploads, restores and RCON, run against a synthetic world and local stand-ins for Google
+# Drive and a game server's RCON. Everything is generated from a seed, so that runs on different commits do the same
+# work; results are printed as JSON, and can be compared with those of a previous run (`--baseline`)
+
+RESULTS_VERSION = 1
+BASE_NAME = 'world'
+
+
+# Synthetic worlds
+
+def _chunk_payload(rng: random.Random, size: int) -> bytes:
+    # Roughly as compressible as real chunk data: runs of repeated blocks, with some noise
+    parts = []
+    while size > 0:
+        run = min(rng.randrange(16, 512), size)
+        parts.append(rng.randbytes(run // 4) if rng.random() < 0.3 else bytes([rng.randrange(256)]) * run)
+        size -= len(parts[-1])
+    return b''.join(parts)
+
+
+def _region_chunk(rng: random.Random, size: int) -> bytes:
+    # As stored in a region file: length + compression type (2 = zlib) + compressed data
+    data = zlib.compress(_chunk_payload(rng, size), 6)
+    return (len(data) + 1).to_bytes(4, 'big') + b'\x02' + data
+
+
+def _write_region(path: Path, rng: random.Random, n_chunks: int, chunk_size: int):
+    slots = sorted(rng.sample(range(region.N_CHUNKS), n_chunks))
+    chunks: List[Optional[bytes]] = [None] * region.N_CHUNKS
+    timestamps = [0] * region.N_CHUNKS
+    for i in slots:
+        chunks[i] = _region_chunk(rng, chunk_size)
+        timestamps[i] = 1_600_000_000 + i
+    with open(path, 'wb') as f:
+        region.write_region(f, chunks, timestamps)
+
+
+def make_world(world_dir: Path, seed: int, n_files: int, file_size: int, n_regions: int, n_chunks: int,
+               chunk_size: int) -> int:
+    # Many small files (e.g. player data, stats) and a few big region files; returns the total size
+    rng = random.Random(seed)
+    for i in range(n_files):
+        path = world_dir / 'data' / f'{i // 256:02x}' / f'{i:06d}.dat'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(_chunk_payload(rng, file_size))
+    for i in range(n_regions):
+        path = world_dir / 'region' / f'r.{i % 8}.{i // 8}.mca'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _write_region(path, rng, n_chunks, chunk_size)
+
+    total_size = 0
+    for path in sorted(world_dir.rglob('*')):
+        if path.is_file():
+            os.utime(path, ns=(1_600_000_000 * 10 ** 9, 1_600_000_000 * 10 ** 9))
+            total_size += path.stat().st_size
+    return total_size
+
+
+def modify_world(world_dir: Path, seed: int, fraction: float, chunk_size: int) -> int:
+    # Like a play session: some chunks of some regions, and some small files, change; returns the number of changes
+    rng = random.Random(seed + 1)
+    n_changed = 0
+    mtime_ns = 1_700_000_000 * 10 ** 9
+    for path in sorted(world_dir.rglob('*')):
+        if not path.is_file() or rng.random() >= fraction * 4:
+            continue
+        if path.suffix == '.mca':
+            with open(path, 'rb') as f:
+                locations, timestamps = region.read_header(f)
+                chunks = [region.read_chunk(f, loc) if loc else None for loc in locations]
+            for i, chunk in enumerate(chunks):
+                if chunk is not None and rng.random() < fraction:
+                    chunks[i] = _region_chunk(rng, chunk_size)
+                    timestamps[i] += 1
+                    n_changed += 1
+            with open(path, 'wb') as f:
+                region.write_region(f, chunks, timestamps)
+        else:
+            path.write_bytes(_chunk_payload(rng, path.stat().st_size))
+            n_changed += 1
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return n_changed
+
+
+# Fake RCON server, speaking the same protocol as `RconClient`
+
+class FakeRconServer:
+    # Echoes commands back, answering with `response_size` characters split in 4096-byte packets like Minecraft does
+    PACKET_BODY_SIZE = 4096
+
+    def __init__(self, password: str = 'bench', response_size: int = 64):
+        self.password: str = password
+        self.response_size: int = response_size
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.n_commands: int = 0
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._serve, host='127.0.0.1', port=0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def respond(self, command: str) -> str:
+        n, rest = divmod(self.response_size, len(command) + 1)
+        return (command + ' ') * n + '.' * rest
+
+    async def _serve(self, rx: asyncio.StreamReader, tx: asyncio.StreamWriter):
+        try:
+            while True:
+                packet = await RconPacket.async_read(rx)
+                if packet.type == RconPacket.SERVERDATA_AUTH:
+                    ok = packet.body == self.password
+                    tx.write(RconPacket(id=packet.id if ok else -1, type=RconPacket.SERVERDATA_AUTH_RESPONSE,
+                                        body='').encode())
+                elif packet.type == RconPacket.SERVERDATA_EXECCOMMAND:
+                    self.n_commands += 1
+                    body = self.respond(packet.body)
+                    for i in range(0, max(len(body), 1), self.PACKET_BODY_SIZE):
+                        tx.write(RconPacket(id=packet.id, type=RconPacket.SERVERDATA_RESPONSE_VALUE,
+                                            body=body[i:i + self.PACKET_BODY_SIZE]).encode())
+                else:
+                    # What `RconClient` uses to find the end of multi-packet responses
+                    tx.write(RconPacket(id=packet.id, type=RconPacket.SERVERDATA_RESPONSE_VALUE, body='').encode())
+                await tx.drain()
+        except (ConnectionError, RconError):
+            pass
+        finally:
+            tx.close()
+
+
+# Fake Google Drive: resumable uploads and (ranged) downloads, the only parts of the API that move data.
+# It runs in its own process, so that it neither competes for the GIL nor shows up in our memory usage
+
+class _FakeDriveState:
+    def __init__(self, root: Path, latency: float):
+        self.root: Path = root
+        self.latency: float = latency
+        self.lock: threading.Lock = threading.Lock()
+        self.sessions: Dict[str, Dict] = {}
+        self.files: Dict[str, Dict] = {}
+        self.next_id: int = 0
+
+    def new_id(self, prefix: str) -> str:
+        with self.lock:
+            self.next_id += 1
+            return f'{prefix}{self.next_id:08d}'
+
+
+class _FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, as with the real thing
+    disable_nagle_algorithm = True  # Otherwise the body, sent after the headers, waits for a delayed ACK
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+    @property
+    def drive(self) -> _FakeDriveState:
+        return self.server.drive
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, status: int, body: bytes = b'', headers: Optional[Dict[str, str]] = None):
+        if self.drive.latency:
+            time.sleep(self.drive.latency)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_session(self, file_id: Optional[str]):
+        metadata = json.loads(self._body() or b'{}')
+        if file_id is not None and file_id not in self.drive.files:
+            return self._reply(404)
+        session_id = self.drive.new_id('s')
+        self.drive.sessions[session_id] = dict(file_id=file_id, name=metadata.get('name'), received=0,
+                                               md5=hashlib.md5(), path=self.drive.root / f'{session_id}.part')
+        self.drive.sessions[session_id]['path'].touch()
+        host = self.headers.get('Host', f'127.0.0.1:{self.server.server_port}')
+        self._reply(200, headers={'Location': f'http://{host}/upload/session/{session_id}'})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != '/upload':
+            return self._reply(404)
+        self._start_session(None)
+
+    def do_PATCH(self):
+        path = urlsplit(self.path).path
+        if not path.startswith('/upload/'):
+            return self._reply(404)
+        self._start_session(path.removeprefix('/upload/'))
+
+    def do_PUT(self):
+        path = urlsplit(self.path).path
+        data = self._body()
+        if (session := self.drive.sessions.get(path.removeprefix('/upload/session/'))) is None:
+            return self._reply(404)
+        content_range = self.headers['Content-Range'].removeprefix('bytes ')
+        span, total = content_range.split('/')
+        total = int(total)
+        if span != '*':
+            start = int(span.split('-')[0])
+            if start != session['received']:
+                return self._reply(400)
+            with open(session['path'], 'ab') as f:
+                f.write(data)
+            session['md5'].update(data)
+            session['received'] += len(data)
+
+        if session['received'] < total:
+            headers = {'Range': f"bytes=0-{session['received'] - 1}"} if session['received'] else {}
+            return self._reply(308, headers=headers)
+
+        file_id = session['file_id'] or self.drive.new_id('f')
+        name = session['name'] or self.drive.files[file_id]['name']
+        os.replace(session['path'], self.drive.root / file_id)
+        file = dict(id=file_id, name=name, md5Checksum=session['md5'].hexdigest(), size=str(total),
+                    modifiedTime='2020-01-01T00:00:00.000Z')
+        self.drive.files[file_id] = file
+        self.drive.sessions.pop(path.removeprefix('/upload/session/'), None)
+        self._reply(200, json.dumps(file).encode(), headers={'Content-Type': 'application/json'})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        file_id = url.path.removeprefix('/files/')
+        if not url.path.startswith('/files/') or parse_qs(url.query).get('alt') != ['media'] \
+                or file_id not in self.drive.files:
+            return self._reply(404)
+        with open(self.drive.root / file_id, 'rb') as f:
+            if range_header := self.headers.get('Range'):
+                start, end = map(int, range_header.removeprefix('bytes=').split('-'))
+                f.seek(start)
+                return self._reply(206, f.read(end - start + 1))
+            self._reply(200, f.read())
+
+
+def _serve_fake_drive(root: str, latency: float, conn: Any):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeDriveHandler)
+    server.daemon_threads = True
+    server.drive = _FakeDriveState(Path(root), latency)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+@contextmanager
+def fake_drive(root: Path, latency: float = 0.0) -> Iterator[str]:
+    # Yields the fake's base URL
+    root.mkdir(parents=True, exist_ok=True)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve_fake_drive, args=(str(root), latency, child_conn), daemon=True)
+    process.start()
+    try:
+        yield f'http://127.0.0.1:{parent_conn.recv()}'
+    finally:
+        process.terminate()
+        process.join()
+
+
+class BenchDrive(GDrive):
+    # Talks to the fake Drive, without credentials; the folder starts empty, and is never listed through the API
+    root_id = 'bench'
+
+    def __init__(self, url: str, cache_dir: Path):
+        self.upload_url = f'{url}/upload'
+        self.download_url = f'{url}/files'
+        self.cache_dir = cache_dir
+        self.index_max_age = math.inf
+        super().__init__()
+        from google.auth.credentials import AnonymousCredentials
+        self._credentials = AnonymousCredentials()
+        self.latencies: List[float] = []
+        self._latencies_lock: threading.Lock = threading.Lock()
+
+    def http_session(self) -> Any:
+        fresh = getattr(self._local, 'session', None) is None
+        session = super().http_session()
+        if fresh:
+            session.hooks['response'].append(self._on_response)
+        return session
+
+    def _on_response(self, resp: Any, *args: Any, **kwargs: Any):
+        with self._latencies_lock:
+            self.latencies.append(resp.elapsed.total_seconds())
+
+
+# Measurements
+
+def _reset_peak_rss() -> bool:
+    # Linux only: makes VmHWM start again from the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> int:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Since the process started, in KiB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    # In milliseconds, nearest-rank
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def rank(p: float) -> float:
+        return samples[min(len(samples) - 1, max(0, math.ceil(p / 100 * len(samples)) - 1))] * 1000
+
+    return dict(count=len(samples), p50=rank(50), p90=rank(90), p99=rank(99), max=samples[-1] * 1000,
+                mean=sum(samples) / len(samples) * 1000)
+
+
+class Run:
+    # One run of one benchmark; filled in by the benchmark while it runs
+    def __init__(self):
+        self.seconds: float = 0.0
+        self.bytes: int = 0
+        self.ops: int = 0
+        self.latencies: List[float] = []
+        self.peak_rss: int = 0
+
+
+@contextmanager
+def measure() -> Iterator[Run]:
+    run = Run()
+    exact_rss = _reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield run
+    finally:
+        run.seconds = time.perf_counter() - start
+        run.peak_rss = _peak_rss() if exact_rss else 0
+
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def summarize(name: str, runs: List[Run]) -> Dict:
+    seconds = _median([run.seconds for run in runs])
+    result = dict(name=name, seconds=seconds, runs=[run.seconds for run in runs])
+    if runs[0].bytes:
+        result.update(bytes=runs[0].bytes, mb_per_s=runs[0].bytes / 2 ** 20 / seconds if seconds else None)
+    if runs[0].ops:
+        result.update(ops=runs[0].ops, ops_per_s=runs[0].ops / seconds if seconds else None)
+    latencies = [latency for run in runs for latency in run.latencies]
+    if latencies:
+        result.update(latency_ms=percentiles(latencies))
+    if any(run.peak_rss for run in runs):
+        result.update(peak_rss_mb=max(run.peak_rss for run in runs) / 2 ** 20)
+    return result
+
+
+# Benchmarks
+
+class Bench:
+    def __init__(self, opts: Any, work_dir: Path):
+        self.opts: Any = opts
+        self.work_dir: Path = work_dir
+        self.runs: Dict[str, List[Run]] = {}
+
+    @contextmanager
+    def record(self, name: str) -> Iterator[Run]:
+        with measure() as run:
+            yield run
+        self.runs.setdefault(name, []).append(run)
+        log.info("%-20s %8.3f s", name, run.seconds)
+
+    def selected(self, name: str) -> bool:
+        return not self.opts.only or any(name.startswith(prefix) for prefix in self.opts.only.split(','))
+
+    def server(self, root: Path) -> Server:
+        server = Server()
+        server.server_path = root
+        server.save_folder = Path(BASE_NAME)
+        server.data_dir = root / 'data'
+        server.backup_workers = self.opts.workers
+        # The worlds are modified behind the server's back: every backup has to scan them entirely
+        server.backup_journal = 'none'
+        return server
+
+    def storage_run(self, i: int):
+        # Backup, upload and restore, each on what the previous step produced
+        opts = self.opts
+        root = self.work_dir / f'run-{i}'
+        world_dir = root / BASE_NAME
+        world_size = make_world(world_dir, opts.seed, opts.files, opts.file_size, opts.regions, opts.chunks,
+                                opts.chunk_size)
+        server = self.server(root)
+
+        with fake_drive(root / 'drive', latency=opts.drive_latency / 1000) as url:
+            drive = BenchDrive(url, root / 'cache')
+
+            def transfer(name: str, upload: Callable[[], Any], size: int):
+                drive.latencies.clear()
+                with self.record(name) as run:
+                    upload()
+                    run.latencies = list(drive.latencies)
+                    run.ops = len(run.latencies)
+                    run.bytes = size
+
+            def snapshot_size(snapshot: Snapshot) -> int:
+                return sum(path.stat().st_size for path in (*snapshot.blobs, snapshot.manifest_path))
+
+            if self.selected('zip'):
+                zip_path = root / f'{snapshot_name(BASE_NAME)}.zip'
+                with self.record('zip') as run, open(zip_path, 'wb') as out:
+                    server.write_saves_zip(out)
+                    run.bytes = world_size
+                if self.selected('upload-zip'):
+                    transfer('upload-zip', lambda: drive.upload_file(zip_path, zip_path.name), zip_path.stat().st_size)
+                zip_path.unlink()
+
+            if not self.selected('backup') and not self.selected('upload') and not self.selected('restore'):
+                return
+            with self.record('backup') as run:
+                snapshot = server.backup_saves(format='region')
+                run.bytes = world_size
+            transfer('upload', lambda: drive.upload_snapshot(snapshot), snapshot_size(snapshot))
+
+            # Snapshot names have a resolution of one second
+            time.sleep(1 - time.time() % 1)
+            modify_world(world_dir, opts.seed, opts.modify, opts.chunk_size)
+            with self.record('backup-incremental') as run:
+                snapshot = server.backup_saves(format='region')
+                run.bytes = world_size
+            transfer('upload-incremental', lambda: drive.upload_snapshot(snapshot), snapshot_size(snapshot))
+
+            if self.selected('restore'):
+                from .restore import Restorer
+                from .retention import Retention
+                first, latest = Retention(drive).generations(BASE_NAME)[-2:]
+                restore_dir = root / 'restored' / BASE_NAME
+                for name, generation in (('restore', first), ('restore-incremental', latest)):
+                    drive.latencies.clear()
+                    with self.record(name) as run:
+                        Restorer(drive, restore_dir, workers=opts.workers).restore(generation)
+                        run.latencies = list(drive.latencies)
+                        run.ops = len(run.latencies)
+                        run.bytes = world_size
+
+        shutil.rmtree(root)
+
+    async def rcon_run(self):
+        opts = self.opts
+        server = FakeRconServer(response_size=opts.rcon_response_size)
+        port = await server.start()
+        client = RconClient('127.0.0.1', port, password=server.password)
+        try:
+            await client.connect()
+            with self.record('rcon') as run:
+                for i in range(opts.rcon_commands):
+                    start = time.perf_counter()
+                    await client.command(f'list {i}')
+                    run.latencies.append(time.perf_counter() - start)
+                run.ops = opts.rcon_commands
+
+            async def worker(n: int, latencies: List[float]):
+                for i in range(n):
+                    start = time.perf_counter()
+                    await client.command(f'list {i}')
+                    latencies.append(time.perf_counter() - start)
+
+            with self.record('rcon-concurrent') as run:
+                n = opts.rcon_commands // opts.rcon_concurrency
+                await asyncio.gather(*(worker(n, run.latencies) for _ in range(opts.rcon_concurrency)))
+                run.ops = n * opts.rcon_concurrency
+        finally:
+            await client.close()
+            await server.close()
+
+    def packet_run(self):
+        packets = [RconPacket(id=i, type=RconPacket.SERVERDATA_RESPONSE_VALUE, body=f'There are {i} players online')
+                   for i in range(1000)]
+        n_rounds = max(self.opts.rcon_commands // 100, 1)
+        with self.record('rcon-packet') as run:
+            for _ in range(n_rounds):
+                for packet in packets:
+                    RconPacket.decode(packet.encode())
+            run.ops = n_rounds * len(packets)
+
+    def run(self):
+        for i in range(self.opts.repeat):
+            if any(self.selected(name) for name in ('zip', 'backup', 'upload', 'restore')):
+                self.storage_run(i)
+            if self.selected('rcon'):
+                asyncio.run(self.rcon_run())
+            if self.selected('rcon-packet'):
+                self.packet_run()
+
+    def results(self) -> List[Dict]:
+        return [summarize(name, runs) for name, runs in self.runs.items() if self.selected(name)]
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline: Dict) -> List[Dict]:
+    # Adds how much slower (> 0) or faster (< 0) each benchmark got since the baseline
+    before = {result['name']: result for result in baseline.get('results', [])}
+    for result in results:
+        if (prev := before.get(result['name'])) is not None and prev['seconds']:
+            result.update(baseline_seconds=prev['seconds'], change=result['seconds'] / prev['seconds'] - 1)
+    return results
+
+
+def main(args: List[str]) -> int:
+    argp = ArgumentParser(prog='cieloblocco bench',
+                          usage='cieloblocco bench [-h] [options] [flags or environment variables]',
+                          description="Benchmarks backups, uploads, restores and RCON against a synthetic world and "
+                                      "local stand-ins for Google Drive and the game server, and prints the results "
+                                      "as JSON. The CB_ variables that tune these (e.g. CB_BACKUP_CODEC, "
+                                      "CB_GDRIVE_CHUNK_SIZE) apply as usual")
+    argp.add_argument('--only', default='',
+                      help="Comma-separated benchmarks (or prefixes) to run: zip, upload-zip, backup, upload, "
+                           "restore, rcon, rcon-packet (default: all)")
+    argp.add_argument('--seed', type=int, default=1, help="Seed of the synthetic world")
+    argp.add_argument('--files', type=int, default=1000, help="Number of small files in the world")
+    argp.add_argument('--file-size', type=int, default=4096, help="Size of each small file")
+    argp.add_argument('--regions', type=int, default=8, help="Number of region (.mca) files in the world")
+    argp.add_argument('--chunks', type=int, default=512, help="Number of chunks in each region file (at most 1024)")
+    argp.add_argument('--chunk-size', type=int, default=16384, help="Uncompressed size of each chunk")
+    argp.add_argument('--modify', type=float, default=0.05,
+                      help="Fraction of the world changed between the full and the incremental backup")
+    argp.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                      help="Threads for backing up and restoring")
+    argp.add_argument('--drive-latency', type=float, default=0.0,
+                      help="Milliseconds the fake Google Drive waits before answering each request")
+    argp.add_argument('--rcon-commands', type=int, default=2000, help="Number of RCON commands to time")
+    argp.add_argument('--rcon-concurrency', type=int, default=8, help="RCON commands in flight at once")
+    argp.add_argument('--rcon-response-size', type=int, default=64, help="Length of each RCON response")
+    argp.add_argument('--repeat', type=int, default=3, help="Runs of each benchmark; the median time is reported")
+    argp.add_argument('--work-dir', type=Path, default=None,
+                      help="Where to generate the world (default: a temporary directory)")
+    argp.add_argument('--baseline', type=Path, default=None,
+                      help="Results of a previous run (e.g. on another commit), to compare with")
+    argp.add_argument('--output', type=Path, default=None, help="File to write the results to (default: stdout)")
+    params = [action.dest for action in argp._actions if action.dest != 'help']
+    opts = env.load_from_args(args, argp)
+    opts.chunks = min(opts.chunks, region.N_CHUNKS)
+
+    # Progress bars would only get in the way of the results
+    os.environ.setdefault('TQDM_DISABLE', '1')
+    # With CB_TRACE_DIR, the benchmarks are traced too
+    tracer.configure()
+
+    with tempfile.TemporaryDirectory(prefix='cieloblocco-bench-', dir=opts.work_dir) as work_dir:
+        bench = Bench(opts, Path(work_dir))
+        bench.run()
+    tracer.dump('bench')
+    results = bench.results()
+    if opts.baseline is not None:
+        with open(opts.baseline, 'r') as f:
+            results = compare(results, json.load(f))
+
+    output = json.dumps(dict(
+        version=RESULTS_VERSION,
+        commit=_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        params={key: str(value) if isinstance(value, Path) else value
+                for key, value in vars(opts).items() if key in params},
+        settings=dict(backup_codec=BackupStore.codec, backup_compress_level=BackupStore.compress_level,
+                      backup_chunk_size=BackupStore.chunk_size, gdrive_chunk_size=GDrive.chunk_size,
+                      gdrive_upload_workers=GDrive.upload_workers, gdrive_download_workers=GDrive.download_workers),
+        results=results,
+    ), indent=2)
+    if opts.output is not None:
+        opts.output.write_text(output + '\n')
+    else:
+        print(output)
+    return 0
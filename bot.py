@@ -1,9 +1,10 @@
 import os
+import time
 import asyncio
 import logging
 import itertools
-from typing import Optional, Iterable, Callable, Coroutine, Dict
-from discord import Client, Game, Status, RawReactionActionEvent, Message, NotFound, Emoji
+from typing import Optional, Iterable, Callable, Coroutine, Dict, Tuple
+from discord import Client, Game, Status, RawReactionActionEvent, Message, NotFound, Emoji, HTTPException
 from discord.abc import GuildChannel
 from . import env
 from .game import Server
@@ -29,10 +30,43 @@ class Bot(Client):
                             "This should either be a unicode character or a :name: code for custom emojis.\n"
                             "(see https://discordpy.readthedocs.io/en/stable/faq.html#how-can-i-add-a-reaction-to-a-message)",
                             optional=True, default="✋")
+    status_interval = env.Var('CB_DISCORD_STATUS_INTERVAL', type=float,
+                              help="Seconds between updates of the server status message (0 = no status message)",
+                              optional=True, default=60.0)
+
+    edit_interval = env.Var('CB_DISCORD_EDIT_INTERVAL', type=float,
+                            help="Minimum seconds between edits of the same message (e.g. progress updates)",
+                            optional=True, default=1.0)
+
+    console_prefix = env.Var('CB_DISCORD_CONSOLE_PREFIX', type=str,
+                             help="Messages in the channel starting with this prefix (e.g. `!`) are run as server "
+                             "console commands, and answered with the command's output. When running several servers, "
+                             "the command starts with the server's name (e.g. `!mypack list`)\n"
+                             "Only for members with the Administrator permission or one of CB_DISCORD_CONSOLE_ROLES\n"
+                             "Empty = disabled",
+                             optional=True, default="")
+    console_roles = env.Var('CB_DISCORD_CONSOLE_ROLES', type=str,
+                            help="Comma-separated ids of the Discord roles (besides administrators) whose members can "
+                            "run console commands",
+                            optional=True, default="")
+
+    max_message_length = 2000
+    max_edit_interval = 30.0
+    max_edit_attempts = 5
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.is_ready: asyncio.Event = asyncio.Event()
+        # One of each per running server
+        self.running_messages: Dict[Server, Message] = {}
+        self.status_messages: Dict[Server, Message] = {}
+        # Sleeping servers: (message, future set to False when stopped from Discord)
+        self.sleeping_messages: Dict[Server, Tuple[Message, asyncio.Future]] = {}
+        # Message id -> (message, latest content not yet sent)
+        self._pending_edits: Dict[int, Tuple[Message, str]] = {}
+        self._edit_tasks: Dict[int, asyncio.Task] = {}
+        self._reaction_tasks: Dict[int, asyncio.Task] = {}
+        self._cur_edit_interval: float = self.edit_interval
 
     def find_emoji(self, name: str) -> Optional[Emoji]:
         if name.startswith(':') and name.endswith(':'):
@@ -50,6 +84,9 @@ class Bot(Client):
     async def on_ready(self):
         log.info('Bot ready: %s', self.user.name)
         self.channel: GuildChannel = self.get_channel(self.channel_id)
+        if self.is_ready.is_set():
+            # Fired again after reconnecting: the messages in the channel are still ours to keep
+            return
 
         await self.nuke_past()
 
@@ -73,16 +110,73 @@ class Bot(Client):
         except NotFound:
             pass
 
+    def may_use_console(self, member) -> bool:
+        # `member` is a `discord.User` instead of a `discord.Member` if they left the server meanwhile
+        if (permissions := getattr(member, 'guild_permissions', None)) is not None and permissions.administrator:
+            return True
+        role_ids = {role.strip() for role in self.console_roles.split(',') if role.strip()}
+        return any(str(role.id) in role_ids for role in getattr(member, 'roles', []))
+
+    async def on_message(self, message: Message):
+        if (not self.console_prefix or message.channel.id != self.channel_id or message.author == self.user
+                or not message.content.startswith(self.console_prefix)):
+            return
+        if not self.may_use_console(message.author):
+            log.warning("%s is not allowed to run console commands", message.author)
+            return
+
+        command = message.content[len(self.console_prefix):].strip()
+        servers = list(self.running_messages)
+        if any(server.name for server in servers):
+            name, _, command = command.partition(' ')
+            server = next((s for s in servers if s.name == name), None)
+        else:
+            server = servers[0] if servers else None
+        if server is None or server.control is None or not command:
+            await self.message(tr("No such server running"), [self.delete_reaction])
+            return
+
+        log.info("%s runs console command: %s", message.author, command)
+        try:
+            output = await server.control.command(command, capture=True)
+        except asyncio.TimeoutError:
+            output = tr("No response from the server in time")
+        except Exception as err:
+            log.exception("Console command failed")
+            output = tr("Could not run the command: {error}", error=err)
+        else:
+            if not output:
+                output = tr("Command sent")
+            else:
+                output = f'```\n{output[-(self.max_message_length - 100):]}\n```'
+        await self.message(self.label(server, output), [self.delete_reaction])
+
     async def on_delete_reaction(self, message: Message):
         await message.delete()
 
     async def on_stop_reaction(self, message: Message):
+        sleeping = next((s for s, (m, _) in self.sleeping_messages.items() if m.id == message.id), None)
+        if sleeping is not None:
+            # Stays stopped instead of waking up
+            _, stopped = self.sleeping_messages.pop(sleeping)
+            if not stopped.done():
+                stopped.set_result(False)
+            await message.delete()
+            return
+        server = next((s for s, m in self.running_messages.items() if m.id == message.id), None)
+        if server is None:
+            return
         async with self.channel.typing():
             await message.delete()
-            stopping_msg = await self.message(content=tr("Stopping server..."))
-            await self.server.stop()
-            await stopping_msg.edit(content=tr("Server stopped"))
-            await stopping_msg.add_reaction(self.delete_reaction)
+            stopping_msg = await self.message(content=self.label(server, tr("Stopping server...")))
+            await server.stop()
+            await stopping_msg.edit(content=self.label(server, tr("Server stopped")))
+            self.add_reactions(stopping_msg, [self.delete_reaction])
+
+    @staticmethod
+    def label(server: Server, content: str) -> str:
+        # When running several servers, messages say which one they are about
+        return f'**{server.name}** | {content}' if server.name else content
 
     def run(self, **kwargs):
         super().run(self.token, **kwargs)
@@ -90,32 +184,146 @@ class Bot(Client):
     async def message(self, content: str, reactions: Iterable[str] = [], **kwargs) -> Message:
         log.info(content)
         msg = await self.channel.send(content=content, **kwargs)
-        for r in reactions:
-            await msg.add_reaction(r)
+        self.add_reactions(msg, reactions)
         return msg
 
+    def add_reactions(self, message: Message, reactions: Iterable[str]):
+        # Reactions have a tight rate limit: add them in the background, in order, one message at a time
+        reactions = list(reactions)
+        if not reactions:
+            return
+        prev_task = self._reaction_tasks.get(message.id)
+
+        async def add():
+            if prev_task is not None:
+                await asyncio.wait((prev_task,))
+            for r in reactions:
+                try:
+                    await message.add_reaction(r)
+                except NotFound:
+                    return
+                except HTTPException:
+                    log.exception("Could not add reaction %s", r)
+
+        def forget(task: asyncio.Task):
+            if self._reaction_tasks.get(message.id) is task:
+                del self._reaction_tasks[message.id]
+
+        task = self._reaction_tasks[message.id] = asyncio.ensure_future(add())
+        task.add_done_callback(forget)
+
+    def edit_soon(self, message: Message, content: str):
+        # Can be called from any thread. Edits are coalesced per message: only the latest content is sent,
+        # at most once every few seconds (more if Discord starts rate limiting us)
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._queue_edit(message, content)
+        else:
+            self.loop.call_soon_threadsafe(self._queue_edit, message, content)
+
+    def _queue_edit(self, message: Message, content: str):
+        self._pending_edits[message.id] = (message, content)
+        if message.id not in self._edit_tasks:
+            self._edit_tasks[message.id] = asyncio.ensure_future(self._edit_worker(message.id))
+
+    async def _edit_worker(self, message_id: int):
+        failures = 0
+        try:
+            while (pending := self._pending_edits.pop(message_id, None)) is not None:
+                message, content = pending
+                start_time = time.monotonic()
+                try:
+                    await message.edit(content=content)
+                except NotFound:
+                    self._pending_edits.pop(message_id, None)
+                    return
+                except HTTPException as err:
+                    failures += 1
+                    if (err.status == 429 or err.status >= 500) and failures < self.max_edit_attempts:
+                        # Retry with the latest content, unless something newer came in meanwhile
+                        self._pending_edits.setdefault(message_id, pending)
+                    else:
+                        # e.g. too long, or no permission anymore: retrying would not help
+                        log.exception("Could not edit message, giving up on this edit")
+                        failures = 0
+                    self._cur_edit_interval = min(self._cur_edit_interval * 2, self.max_edit_interval)
+                else:
+                    failures = 0
+                    # discord.py waits out rate limits internally: if the edit took long, we were being limited
+                    if time.monotonic() - start_time > self._cur_edit_interval:
+                        self._cur_edit_interval = min(self._cur_edit_interval * 2, self.max_edit_interval)
+                    else:
+                        self._cur_edit_interval = max(self._cur_edit_interval * 0.9, self.edit_interval)
+                await asyncio.sleep(self._cur_edit_interval)
+        finally:
+            del self._edit_tasks[message_id]
+
+    async def flush_edits(self, message: Message):
+        # Waits until all pending edits to the message have been sent
+        while (task := self._edit_tasks.get(message.id)) is not None:
+            await asyncio.wait((task,))
+
+    async def update_presence(self):
+        game_names = [tr("{game} ({modpack})", game=server.game, modpack=server.modpack)
+                      for server in self.running_messages]
+        await self.change_presence(activity=Game(name=', '.join(game_names)) if game_names else None)
+
     async def on_server_started(self, server: Server):
-        self.server = server
+        self.running_messages[server] = await self.message(self.label(server, tr("Server running, react to stop")),
+                                                           [self.stop_reaction])
+        await self.update_presence()
+
+    async def show_status(self, server: Server, summary: Callable[[], str]):
+        # Keeps a status message up to date until cancelled
+        while True:
+            await asyncio.sleep(self.status_interval)
+            content = self.label(server, tr("Server status: {summary}", summary=summary()))
+            if (status_message := self.status_messages.get(server)) is None:
+                self.status_messages[server] = await self.channel.send(content=content)
+            else:
+                self.edit_soon(status_message, content)
 
-        game_name = tr("{game} ({modpack})", game=self.server.game, modpack=self.server.modpack)
-        await self.change_presence(activity=Game(name=game_name))
+    async def on_server_sleeping(self, server: Server) -> asyncio.Future:
+        # Returns a future set to False if the server is stopped for good from Discord
+        stopped = asyncio.get_running_loop().create_future()
+        message = await self.message(self.label(server, tr("Server sleeping, join it to wake it up (react to stop)")),
+                                     [self.stop_reaction])
+        self.sleeping_messages[server] = (message, stopped)
+        return stopped
 
-        self.running_message: Message = await self.message(tr("Server running, react to stop"), [self.stop_reaction])
+    async def on_server_woken(self, server: Server):
+        if (sleeping := self.sleeping_messages.pop(server, None)) is not None:
+            message, _ = sleeping
+            try:
+                await message.delete()
+            except NotFound:
+                pass
 
-    async def on_server_done(self, exitcode: int, stderr: str):
+    async def on_server_done(self, server: Server, exitcode: int, output: str):
         try:
-            await self.running_message.delete()
+            await self.running_messages.pop(server).delete()
         except:
             log.exception("Could not delete 'Running' message")
 
+        if (status_message := self.status_messages.pop(server, None)) is not None:
+            try:
+                await status_message.delete()
+            except NotFound:
+                pass
+
         if exitcode == 0:
             log.info("Server done")
         else:
             log.error("Server crashed")
-            await self.message(tr("Server crashed! (exit code: {exitcode})", exitcode=exitcode),
-                               [self.delete_reaction])
-            log.error("Server stderr: %s", stderr)
-            await self.message(stderr,
+            await self.message(self.label(server, tr("Server crashed! (exit code: {exitcode})", exitcode=exitcode)),
                                [self.delete_reaction])
+            log.error("Server output: %s", output)
+            if output:
+                # Discord messages are at most 2000 characters long
+                await self.message(output[-self.max_message_length:],
+                                   [self.delete_reaction])
 
-        await self.change_presence(activity=None)
+        await self.update_presence()
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import builtins
 from argparse import ArgumentParser, Namespace, Action
@@ -41,10 +42,8 @@ class Var(Generic[_var_t]):
         self.value: Optional[_var_t] = os.getenv(self.key)
         if self.value is not None:
             self.value = self.type(self.value) if self.type is not None else self.value
-        elif self.optional:
-            self.value = self.default
         else:
-            raise VarError(f"${{{self.key}}} not set", self)
+            self.value = self.default if self.optional else None
 
     def __str__(self) -> str:
         doc = f"{self.key}"
@@ -60,9 +59,38 @@ class Var(Generic[_var_t]):
         return f'Var({self.key}={repr(self.value)})'
 
     def __get__(self, instance: 'Var', owner: Any) -> Optional[_var_t]:
+        if self.value is None and not self.optional:
+            # Checked on use, so that required vars can also be set by flags, or by prefixed overrides
+            raise VarError(f"${{{self.key}}} not set", self)
         return self.value
 
 
+class Override(Var):
+    # A var that falls back to another one when not set: `CB_<PREFIX>_FOO` overrides `CB_FOO`
+    def __init__(self, prefix: str, base: Var):
+        super().__init__(base.key.replace('CB_', f'CB_{prefix}_', 1), default=None, type=base.type, optional=True,
+                         help=f"Overrides {base.key} for `{prefix}`")
+        self.base: Var = base
+
+    def __get__(self, instance: Any, owner: Any) -> Optional[_var_t]:
+        return self.value if self.value is not None else self.base.__get__(instance, owner)
+
+
+def name_prefix(name: str) -> str:
+    # `my-pack` -> `MY_PACK`, as in `CB_MY_PACK_GAME_SERVER_PATH`
+    return re.sub(r'\W', '_', name).upper()
+
+
+def with_prefix(cls: type, prefix: str) -> type:
+    # A subclass of `cls` where each var can be overridden by a prefixed one (see `Override`)
+    overrides = {}
+    for klass in reversed(cls.__mro__):
+        for attr, value in vars(klass).items():
+            if isinstance(value, Var):
+                overrides[attr] = Override(prefix, value)
+    return builtins.type(f'{cls.__name__}_{prefix}', (cls,), overrides)
+
+
 class VarArgAction(Action):
     def __init__(self, var: Var, **kwargs):
         super().__init__(**kwargs)
@@ -72,12 +100,18 @@ class VarArgAction(Action):
         self.var.value = value
 
 
-def load_from_args(args: List[str] = sys.argv[1:]):
-    argp = ArgumentParser(prog='cieloblocco',
+def arg_parser() -> ArgumentParser:
+    return ArgumentParser(prog='cieloblocco',
                           usage='cieloblocco [-h] [flags or environment variables]',
                           description="Manages Minecraft or other game servers",
-                          epilog="The flags listed here have precedence over the corresponding CB_ environment variables. "
-                                 "They can also be set with a .env file placed in the module's root directory.")
+                          epilog="The flags listed here have precedence over the corresponding CB_ environment "
+                                 "variables. They can also be set with a .env file placed in the module's root "
+                                 "directory.")
+
+
+def load_from_args(args: List[str] = sys.argv[1:], argp: Optional[ArgumentParser] = None):
+    # `argp` can come with arguments of its own (e.g. for a subcommand); the vars' flags are added to it
+    argp = argp or arg_parser()
     for name, var in all_vars.items():
         flag = '--' + name.removeprefix('CB_').lower().replace('_', '-')
         argp.add_argument(flag, type=var.type,
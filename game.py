@@ -1,109 +1,205 @@
 import os
 import re
+import sys
+import time
+import shutil
 import asyncio
-import struct
 import logging
-import zipfile
+import itertools
 import tempfile
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from pathlib import Path
-from typing import Callable, Optional, Tuple
-from tqdm.auto import tqdm
+from collections import deque
+from typing import BinaryIO, Callable, Deque, List, NamedTuple, Optional, Tuple, Union
 from . import env
+from .archive import ZipWriter
+from .backup import BackupStore, Snapshot, snapshot_tree
+from .journal import ChangeJournal
+from .logs import LogStream
+from .rcon import RconClient
+from .scan import scan_tree
+from .tracing import span
 
 log = logging.getLogger()
 
 
+class QueuedCommand(NamedTuple):
+    text: str
+    future: asyncio.Future
+    capture: bool
+    timeout: Optional[float]  # None = never
+
+
 class Control:
+    # Whether `command` returns the command's output
+    captures_output: bool = False
+    # Most commands sent at once, when several are queued
+    max_batch: int = 16
+
+    # Commands from everywhere (Discord, backups, telemetry...) go through one queue, and are sent by a single
+    # dispatcher task, in order. Transports implement `send`
     def __init__(self, server: 'Server'):
         self.server = server
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(server.command_queue, 1))
+        self._dispatcher: Optional[asyncio.Task] = None
 
     async def init(self):
         pass
 
-    async def stop(self):
-        raise NotImplementedError()
+    def start(self):
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
 
+    async def command(self, command: str, timeout: Optional[float] = None, capture: bool = False) -> Optional[str]:
+        # Returns the command's output, or None if the control can not capture it (stdin captures it only when
+        # asked to, see `StdinControl`). Waits while the queue is full; raises `asyncio.TimeoutError` after
+        # `timeout` (default: CB_GAME_COMMAND_TIMEOUT) seconds, queueing included
+        if self._dispatcher is None or self._dispatcher.done():
+            raise ConnectionResetError("Server control is closed")
+        timeout = (timeout if timeout is not None else self.server.command_timeout) or None
+        queued = QueuedCommand(command, asyncio.get_running_loop().create_future(), capture, timeout)
 
-class StdinControl(Control):
-    async def stop(self):
-        log.debug("Typing stop command")
-        self.server.stdin.write(self.server.stop_command.encode())
-        self.server.stdin.write(b'\n')
+        async def submit():
+            await self._queue.put(queued)
+            return await queued.future
 
+        # If given up on, the future is cancelled and the command skipped, unless already sent
+        return await asyncio.wait_for(submit(), timeout=timeout)
 
-class RconPacket(namedtuple('RconPacket', 'id type body')):
-    # See: https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
-    SERVERDATA_AUTH = 3
-    SERVERDATA_AUTH_RESPONSE = 2
-    SERVERDATA_EXECCOMMAND = 2
-    SERVERDATA_RESPONSE_VALUE = 0
+    async def _dispatch(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            batch = [queued for queued in batch if not queued.future.done()]
+            if not batch:
+                continue
+            try:
+                with span('control.send', server=self.server.name, commands=len(batch)):
+                    await self.send(batch)
+            except asyncio.CancelledError:
+                self._fail(batch, ConnectionResetError("Server control is closed"))
+                raise
+            except Exception as err:
+                self._fail(batch, err)
 
-    MIN_SIZE = 4 * 3 + 1 + 1
+    @staticmethod
+    def _fail(batch: List[QueuedCommand], err: BaseException):
+        for queued in batch:
+            if not queued.future.done():
+                queued.future.set_exception(err)
 
-    def encode(self) -> bytes:
-        data = struct.pack('<ll', self.id, self.type)
-        data += self.body.encode('ascii')
-        data += b'\0\0'
-        size = struct.pack('<l', len(data))
-        return size + data
+    async def send(self, batch: List[QueuedCommand]):
+        # Sends the commands, and resolves their futures
+        raise NotImplementedError()
 
-    @staticmethod
-    def decode(data: bytes) -> 'RconPacket':
-        assert len(data) >= RconPacket.MIN_SIZE, "Packet is too short"
-        size = struct.unpack('<l', data[:4])[0]
-        assert len(data[4:]) == size, "Mismatched packet size"
+    async def stop(self):
+        raise NotImplementedError()
 
-        assert data.endswith(b'\0\0'), "Malformed packet"
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._dispatcher
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+        self._fail(queued, ConnectionResetError("Server control is closed"))
 
-        id, type = struct.unpack('<ll', data[4:12])
-        body = data[12:-2].decode('ascii')
-        return RconPacket(id=id, type=type, body=body)
 
-    @staticmethod
-    async def async_read(stream: asyncio.StreamReader) -> 'RconPacket':
-        # End of body string + empty string = end of packet
-        raw_resp = b''
-        while len(raw_resp) < RconPacket.MIN_SIZE or not raw_resp.endswith(b'\0\0'):
-            if read := await stream.read(1):
-                raw_resp += read
+class StdinControl(Control):
+    # The console does not say which lines answer which command: with `capture`, a command is sent on its own, and
+    # its output is whatever the server prints next, until it has been quiet for `response_quiet` seconds (or
+    # printed nothing for `response_wait` seconds)
+    response_wait: float = 1.0
+    response_quiet: float = 0.2
+
+    async def send(self, batch: List[QueuedCommand]):
+        for capture, group in itertools.groupby(batch, key=lambda queued: queued.capture):
+            group = list(group)
+            if capture:
+                for queued in group:
+                    output = await self._capture(queued)
+                    if not queued.future.done():
+                        queued.future.set_result(output)
             else:
-                # Let other coroutines run while we wait for auth
-                await asyncio.sleep(1)
+                await self._write(group)
+                for queued in group:
+                    if not queued.future.done():
+                        queued.future.set_result(None)
+
+    async def _write(self, batch: List[QueuedCommand]):
+        stdin = self.server.stdin
+        if stdin is None or stdin.is_closing():
+            raise ConnectionResetError("Server console is closed")
+        for queued in batch:
+            log.debug("Typing command: %s", queued.text)
+        stdin.write(''.join(f'{queued.text}\n' for queued in batch).encode())
+        # Waits for the server to read what is already there, if it is falling behind
+        await stdin.drain()
+
+    async def _capture(self, queued: QueuedCommand) -> str:
+        lines = []
+        new_line = asyncio.Event()
+
+        def on_line(line: str, stream: str):
+            if stream == 'stdout':
+                lines.append(line)
+                new_line.set()
+
+        unsubscribe = self.server.logs.subscribe_lines(on_line)
+        try:
+            await self._write([queued])
+            timeout = self.response_wait
+            while not queued.future.done():
+                try:
+                    await asyncio.wait_for(new_line.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                new_line.clear()
+                timeout = self.response_quiet
+        finally:
+            unsubscribe()
+        return '\n'.join(lines)
 
-        return RconPacket.decode(raw_resp)
+    async def stop(self):
+        log.debug("Typing stop command")
+        await self.command(self.server.stop_command)
 
 
 class RconControl(Control):
-    async def _request(self, **kwargs) -> RconPacket:
-        req = RconPacket(**kwargs)
-        self.tx.write(req.encode())
-        return await RconPacket.async_read(self.rx)
+    captures_output = True
 
     async def init(self, host: str = 'localhost', port: int = 25575, password: str = ''):
-        log.debug("Connecting to rcon on %s:%d", host, port)
-        while True:
-            try:
-                self.rx, self.tx = await asyncio.open_connection(host=host, port=int(port))
-            except (OSError, ConnectionError, ConnectionRefusedError):
-                # Let other coroutines run while we wait for RCON
-                await asyncio.sleep(1)
+        log.debug("Connecting to rcon on %s:%s", host, port)
+        self.client = RconClient(host=host, port=port, password=password)
+        await self.client.connect()
+
+    async def send(self, batch: List[QueuedCommand]):
+        timeouts = [queued.timeout for queued in batch]
+        results = await self.client.commands([queued.text for queued in batch],
+                                             timeout=None if None in timeouts else max(timeouts))
+        for queued, result in zip(batch, results):
+            if queued.future.done():
                 continue
+            if isinstance(result, BaseException):
+                queued.future.set_exception(result)
             else:
-                break
-
-        log.debug("Authenticating to rcon server")
-        req_id = 0x42
-        auth_resp = await self._request(id=req_id, type=RconPacket.SERVERDATA_AUTH, body=password)
-        if auth_resp.type != RconPacket.SERVERDATA_AUTH_RESPONSE or auth_resp.id != req_id:
-            raise RuntimeError("Rcon authentication failed")
-
-        log.debug("Authenticated")
+                log.debug("[rcon] %s", result)
+                queued.future.set_result(result)
 
     async def stop(self):
         log.debug("Stopping server via rcon")
-        resp = await self._request(id=1, type=RconPacket.SERVERDATA_EXECCOMMAND, body=self.server.stop_command)
-        log.debug("[rcon] %s", resp.body)
+        try:
+            resp = await self.client.command(self.server.stop_command, multi=False, timeout=10)
+            log.debug("[rcon] %s", resp)
+        except (ConnectionError, asyncio.TimeoutError):
+            # The server might close the connection before answering
+            pass
+
+    async def close(self):
+        await super().close()
+        await self.client.close()
 
 
 control_types = {
@@ -125,10 +221,32 @@ async def make_control(config: str, server: 'Server') -> Control:
     kwargs = {key: value1 or value2
               for key, value1, value2 in re.findall(r"(\w+)=(?:'([^']*)'|([^\s]*))", args)}
     await control.init(**kwargs)
+    control.start()
 
     return control
 
 
+class CrashTracker:
+    # Decides whether and when to restart a crashed server: the delay doubles with each crash in the last
+    # `window` seconds, and after `max_crashes` of them it is a crash loop, not worth restarting
+    def __init__(self, max_crashes: int, window: float, delay: float, max_delay: float):
+        self.max_crashes: int = max_crashes
+        self.window: float = window
+        self.delay: float = delay
+        self.max_delay: float = max_delay
+        self.crashes: Deque[float] = deque()
+
+    def crashed(self, now: Optional[float] = None) -> Optional[float]:
+        # Returns the seconds to wait before restarting, or None to give up
+        now = now if now is not None else time.monotonic()
+        self.crashes.append(now)
+        while now - self.crashes[0] > self.window:
+            self.crashes.popleft()
+        if self.max_crashes <= 0 or len(self.crashes) >= self.max_crashes:
+            return None
+        return min(self.delay * 2 ** (len(self.crashes) - 1), self.max_delay)
+
+
 class Server:
     game = env.Var('CB_GAME_NAME', type=str,
                    help="The name of the game the server is for",
@@ -155,75 +273,333 @@ class Server:
                            help="The console command to stop the server",
                            optional=True,
                            default='/stop')
+    command_timeout = env.Var('CB_GAME_COMMAND_TIMEOUT', type=float,
+                              help="Seconds after which a console command is given up on, including the time spent "
+                              "waiting behind other commands (0 = never)",
+                              optional=True,
+                              default=30.0)
+    command_queue = env.Var('CB_GAME_COMMAND_QUEUE', type=int,
+                            help="Number of console commands that can wait to be sent; more have to wait to be queued",
+                            optional=True,
+                            default=100)
     control_config = env.Var('CB_GAME_CONTROL', type=str,
                              help="The type of server control\n"
                              "`stdin`: pass commands directly to standard input\n"
                              "`rcon <host=host> <port=port> <password='password'>`: Source/Minecraft rcon protocol\n",
                              optional=True,
                              default='stdin')
-
-    def __init__(self):
+    data_dir = env.Var('CB_DATA_DIR', type=Path,
+                       help="Directory where local state is kept (backup index, snapshots, ...)\n"
+                       "Defaults to `.cieloblocco` in CB_GAME_SERVER_PATH. When running several servers, each one "
+                       "uses a subdirectory named after it",
+                       optional=True,
+                       default=None)
+    backup_format = env.Var('CB_BACKUP_FORMAT', type=str,
+                            help="How saves are backed up\n"
+                            "`zip`: a full zip archive of the save folder, a new timestamped one on each backup (see CB_RETAIN_*)\n"
+                            "`incremental`: content-addressed chunks; only chunks that changed since the last backup are stored\n"
+                            "`region`: like `incremental`, but Minecraft region files (.mca) are split in their own chunks, "
+                            "and only the Minecraft chunks that changed since the last backup are stored",
+                            optional=True,
+                            default='zip')
+    hot_backup_interval = env.Var('CB_HOT_BACKUP_INTERVAL', type=float,
+                                  help="Minutes between backups taken while the server is running (0 = disabled)\n"
+                                  "Saving is paused while the world is copied to a local snapshot, then the snapshot "
+                                  "is backed up in the background",
+                                  optional=True,
+                                  default=0.0)
+    hot_backup_flush_wait = env.Var('CB_HOT_BACKUP_FLUSH_WAIT', type=float,
+                                    help="Maximum seconds to wait for `save-all flush` to complete, for controls that "
+                                    "can not report when it is done (e.g. `stdin`)",
+                                    optional=True,
+                                    default=10.0)
+    backup_workers = env.Var('CB_BACKUP_WORKERS', type=int,
+                             help="Number of threads compressing backups in parallel (0 = one per CPU core)",
+                             optional=True,
+                             default=0)
+    backup_timeout = env.Var('CB_BACKUP_TIMEOUT', type=float,
+                             help="Minutes after which a backup (and its upload) is cancelled (0 = never)",
+                             optional=True,
+                             default=0.0)
+    backup_journal = env.Var('CB_BACKUP_JOURNAL', type=str,
+                             help="How incremental backups find what changed in the save folder\n"
+                             "`inotify`: keep a journal of the paths the server changes while it runs (Linux only), "
+                             "so that backups taken while it is stopped only look at those\n"
+                             "`none`: scan the whole save folder on every backup\n"
+                             "Files edited in place while the server is not running (e.g. by hand) are only noticed "
+                             "by the next full scan",
+                             optional=True,
+                             default='inotify')
+    backup_full_scan_every = env.Var('CB_BACKUP_FULL_SCAN_EVERY', type=int,
+                                     help="Scan the whole save folder anyway every this many incremental backups, "
+                                     "when CB_BACKUP_JOURNAL is enabled",
+                                     optional=True,
+                                     default=10)
+
+    log_lines = env.Var('CB_GAME_LOG_LINES', type=int,
+                        help="Number of recent console lines to keep in memory (e.g. for crash reports)",
+                        optional=True,
+                        default=200)
+    ready_timeout = env.Var('CB_GAME_READY_TIMEOUT', type=float,
+                            help="Seconds to wait for the server to report it is done starting up before "
+                            "connecting the server control anyway",
+                            optional=True,
+                            default=600.0)
+
+    restart_max_crashes = env.Var('CB_RESTART_MAX_CRASHES', type=int,
+                                  help="Restart the server when it crashes, unless it crashed this many times within "
+                                  "CB_RESTART_WINDOW (0 = never restart)",
+                                  optional=True,
+                                  default=5)
+    restart_window = env.Var('CB_RESTART_WINDOW', type=float,
+                             help="Minutes within which crashes count towards CB_RESTART_MAX_CRASHES and the restart delay",
+                             optional=True,
+                             default=30.0)
+    restart_delay = env.Var('CB_RESTART_DELAY', type=float,
+                            help="Seconds to wait before restarting a crashed server; doubles with each recent crash",
+                            optional=True,
+                            default=5.0)
+    restart_max_delay = env.Var('CB_RESTART_MAX_DELAY', type=float,
+                                help="Maximum seconds to wait before restarting a crashed server",
+                                optional=True,
+                                default=300.0)
+    restart_snapshot = env.Var('CB_RESTART_SNAPSHOT', type=str,
+                               help="What to save of a crashed server before restarting it\n"
+                               "`none`: nothing\n"
+                               "`local`: a local copy of the save folder (the last few are kept in CB_DATA_DIR)\n"
+                               "`backup`: a full backup, uploaded like the one done when the server stops",
+                               optional=True,
+                               default='none')
+
+    def __init__(self, name: Optional[str] = None):
+        self.name: Optional[str] = name  # Only set when running several servers
         self.process: Optional[asyncio.Process] = None
         self.control: Optional[Control] = None
+        self.logs: LogStream = LogStream(max_lines=self.log_lines)
+        self.stopping: bool = False  # Set when stopped on purpose, so that whatever the exit code is, it is no crash
+        self._journal: Optional[ChangeJournal] = None
 
     @property
     def modpack(self) -> str:
         # TODO: Proper modpack name detection!
         return self.server_path.resolve().name
 
-    async def run(self) -> Tuple[int, str]:
+    async def run(self, on_spawned: Optional[Callable[[], None]] = None) -> Tuple[int, str]:
         startup_script = str(self.server_path / self.startup_script)
         cmd = f'{startup_script} {self.startup_args}'
 
         log.info("Launching %s", cmd)
-        self.process = await asyncio.create_subprocess_shell(
-            cmd,
-            cwd=self.server_path,
-            stdin=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-
-        self.control = await make_control(server=self, config=self.control_config)
+        self.logs.reset()
+        self.control = None
+        self.stopping = False
+        ready = self.logs.expect('ready')
+        journal = self.journal()
+        if journal is not None:
+            # Watching has to start before the server can change anything
+            with span('journal.start', server=self.name):
+                await asyncio.get_running_loop().run_in_executor(None, journal.start)
+            journal.attach(asyncio.get_running_loop())
+        try:
+            return await self._run(cmd, ready, on_spawned)
+        finally:
+            if journal is not None:
+                journal.detach()
+                with span('journal.stop', server=self.name):
+                    await asyncio.get_running_loop().run_in_executor(None, journal.stop)
+
+    async def _run(self, cmd: str, ready: asyncio.Future, on_spawned: Optional[Callable[[], None]]) -> Tuple[int, str]:
+        with span('server.spawn', server=self.name):
+            self.process = await asyncio.create_subprocess_shell(
+                cmd,
+                cwd=self.server_path,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        if on_spawned is not None:
+            on_spawned()
+        pumps = asyncio.gather(self.logs.pump(self.process.stdout, 'stdout', echo=sys.stdout),
+                               self.logs.pump(self.process.stderr, 'stderr', echo=sys.stderr))
+        exited = asyncio.ensure_future(self.process.wait())
+
+        with span('server.startup', server=self.name):
+            await asyncio.wait((ready, exited), timeout=self.ready_timeout, return_when=asyncio.FIRST_COMPLETED)
+        ready.cancel()
+        if not exited.done():
+            with span('server.control', server=self.name):
+                control_future = asyncio.ensure_future(make_control(server=self, config=self.control_config))
+                await asyncio.wait((control_future, exited), return_when=asyncio.FIRST_COMPLETED)
+            if control_future.done():
+                self.control = control_future.result()
+            else:
+                control_future.cancel()
 
-        exitcode = await self.process.wait()
-        stderr = await self.process.stderr.read()
-        return exitcode, stderr.decode()
+        with span('server.running', server=self.name):
+            exitcode = await exited
+        with span('server.exit', server=self.name):
+            await pumps
+            if self.control is not None:
+                await self.control.close()
+        return exitcode, self.logs.tail()
 
     @property
     def stdin(self) -> Optional[asyncio.StreamWriter]:
         return self.process.stdin if self.process else None
 
     async def stop(self, kill_timeout: Optional[float] = 60):
-        await self.control.stop()
+        if self.control is None:
+            raise RuntimeError("Server control is not ready yet")
+        self.stopping = True
+        with span('server.stop', server=self.name):
+            with span('server.stop.command', server=self.name):
+                await self.control.stop()
+            try:
+                with span('server.stop.wait', server=self.name):
+                    await asyncio.wait_for(self.process.wait(), timeout=kill_timeout)
+            except asyncio.TimeoutError:
+                log.error("Server failed to stop in time, killing it")
+                self.process.kill()
+
+    @property
+    def local_dir(self) -> Path:
+        if self.data_dir is None:
+            return self.server_path / '.cieloblocco'
+        # CB_DATA_DIR may be shared by several servers: each keeps its index, snapshots and journal apart
+        return self.data_dir / self.name if self.name else self.data_dir
+
+    @property
+    def n_backup_workers(self) -> int:
+        return self.backup_workers or os.cpu_count() or 1
+
+    def backup_store(self) -> BackupStore:
+        return BackupStore(self.local_dir / 'backup', workers=self.n_backup_workers)
+
+    def journal(self) -> Optional[ChangeJournal]:
+        # Only kept for incremental backups
+        if self.backup_journal == 'none' or self.backup_format not in ('incremental', 'region'):
+            return None
+        if self.backup_journal != 'inotify':
+            raise RuntimeError(f"Unknown backup journal: {self.backup_journal}")
+        if self._journal is None:
+            self._journal = ChangeJournal(self.local_dir / 'journal.json', self.server_path / self.save_folder)
+        return self._journal
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    @property
+    def zip_name(self) -> str:
+        return f'{self.save_folder.name}.zip'
+
+    async def hot_snapshot(self) -> Path:
+        # Copies the save folder while the server is running, with saving paused for as little as possible;
+        # returns the path of the copy, that can then be passed to `backup_saves` as `src_dir`
+        snapshots_dir = self.local_dir / 'hot'
+        snapshots_dir.mkdir(parents=True, exist_ok=True)
+        prev_dirs = sorted(snapshots_dir.iterdir())
+        snapshot_dir = snapshots_dir / f'{time.time_ns():020d}'
+        if self.control is None:
+            raise RuntimeError("Server control is not ready yet")
+
+        await self.control.command('save-off')
         try:
-            await asyncio.wait_for(self.process.wait(), timeout=kill_timeout)
-        except asyncio.TimeoutError:
-            log.error("Server failed to stop in time, killing it")
-            self.process.kill()
+            saved = self.logs.expect('saved')
+            # However long it takes on a big world
+            if await self.control.command('save-all flush', timeout=0) is None:
+                # No response to tell when the flush is done, look for it in the console instead
+                try:
+                    await asyncio.wait_for(saved, timeout=self.hot_backup_flush_wait)
+                except asyncio.TimeoutError:
+                    log.warning("Did not see the save complete in time, snapshotting anyway")
+            else:
+                saved.cancel()
+
+            loop = asyncio.get_running_loop()
+            n_copied, n_linked = await loop.run_in_executor(
+                None, snapshot_tree, self.server_path / self.save_folder, snapshot_dir,
+                prev_dirs[-1] if prev_dirs else None)
+        except BaseException:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            raise
+        finally:
+            # Without hiding why the snapshot failed, if it did; nothing to turn back on if the server is gone
+            if self.running and self.control is not None:
+                try:
+                    await self.control.command('save-on')
+                except Exception:
+                    log.exception("Could not turn saving back on: the world is not saved until `save-on` is run, "
+                                  "or the server restarts")
+        log.info("Hot snapshot %s: %d files copied, %d linked", snapshot_dir.name, n_copied, n_linked)
+
+        for prev_dir in prev_dirs:
+            shutil.rmtree(prev_dir, ignore_errors=True)
+        return snapshot_dir
+
+    def crash_tracker(self) -> CrashTracker:
+        return CrashTracker(self.restart_max_crashes, self.restart_window * 60,
+                            self.restart_delay, self.restart_max_delay)
+
+    def crash_snapshot(self, keep: int = 3) -> Path:
+        # Local copy of the save folder of a stopped server; unchanged files are linked to the previous copy
+        snapshots_dir = self.local_dir / 'crash'
+        snapshots_dir.mkdir(parents=True, exist_ok=True)
+        prev_dirs = sorted(snapshots_dir.iterdir())
+        snapshot_dir = snapshots_dir / f'{time.time_ns():020d}'
+        snapshot_tree(self.server_path / self.save_folder, snapshot_dir, prev_dirs[-1] if prev_dirs else None)
+        for prev_dir in prev_dirs[:max(len(prev_dirs) + 1 - keep, 0)]:
+            shutil.rmtree(prev_dir, ignore_errors=True)
+        return snapshot_dir
+
+    def backup_saves(self, format: Optional[str] = None, on_progress: Optional[Callable] = None,
+                     src_dir: Optional[Path] = None) -> Union[Path, Snapshot]:
+        format = format or self.backup_format
+        if format in ('incremental', 'region'):
+            in_dir = src_dir or (self.server_path / self.save_folder)
+            # The journal only describes the save folder itself, and only once nothing writes to it anymore
+            journal = self.journal() if src_dir is None and not self.running else None
+            changes = journal.changes(self.backup_full_scan_every) if journal is not None else None
+            dirs = {}
+            with span('backup', server=self.name, format=format, journal=changes is not None):
+                snapshot = self.backup_store().backup(in_dir, self.save_folder.name, on_progress=on_progress,
+                                                      regions=(format == 'region'), changes=changes, dirs=dirs)
+            if journal is not None:
+                journal.backed_up(None if dirs else changes, dirs or None)
+            return snapshot
+        elif format != 'zip':
+            raise RuntimeError(f"Unknown backup format: {format}")
+
+        out_path = Path(tempfile.gettempdir()) / self.zip_name
+        with open(out_path, 'wb') as out:
+            self.write_saves_zip(out, on_progress=on_progress, src_dir=src_dir)
+        return out_path
 
-    def backup_saves(self, format: str = 'zip', on_progress: Optional[Callable] = None) -> Path:
+    def write_saves_zip(self, out: BinaryIO, on_progress: Optional[Callable] = None, src_dir: Optional[Path] = None):
+        # `out` does not need to be seekable
         base_name = self.save_folder.name
-        in_dir = self.server_path / self.save_folder
-        out_path = Path(tempfile.gettempdir()) / f'{base_name}.zip'
+        in_dir = src_dir or (self.server_path / self.save_folder)
 
-        to_backup = []
-        total_src_size = 0
-        for root, dirnames, filenames in os.walk(in_dir):
-            rel_root = os.path.relpath(root, in_dir)
-            for f in filenames:
-                src_path = Path(root) / f
-                src_size = src_path.stat().st_size
-                total_src_size += src_size
-                dst_path = f'{base_name}/{rel_root}/{f}'
-                to_backup.append((src_path, src_size, dst_path))
-
-        to_backup.sort(key=lambda tup: tup[0])
         on_progress = on_progress if on_progress is not None else (lambda *args, **kwargs: None)
 
-        progress = tqdm(total=total_src_size, leave=False, ncols=120, unit='B', unit_scale=True)
-        with zipfile.ZipFile(out_path, mode='w') as zipf, progress:
-            for src, src_size, dst in to_backup:
-                progress.set_description_str(dst)
-                zipf.write(src, dst)
-                progress.update(round(src_size, 2))
-                on_progress(progress)
-
-        return out_path
+        workers = self.n_backup_workers
+        from tqdm.auto import tqdm
+        # Files are written as the folder is scanned, so the total is only known at the end
+        progress = tqdm(total=None, leave=False, ncols=120, unit='B', unit_scale=True)
+        total_src_size = 0
+        batches = scan_tree(in_dir)
+        with ThreadPoolExecutor(workers) as executor, progress:
+            # zlib releases the GIL while compressing, so threads are enough to use all cores
+            zipf = ZipWriter(out, executor, max_pending=2 * workers)
+            while True:
+                with span('zip.walk'):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                for rel_path, src_path, src_stat in batch:
+                    dst = f'{base_name}/{rel_path}'
+                    total_src_size += src_stat.st_size
+                    progress.set_description_str(dst)
+                    with span('zip.read', path=dst, bytes=src_stat.st_size):
+                        progress.update(zipf.write(Path(src_path), dst, src_stat))
+                    on_progress(progress)
+            progress.total = total_src_size
+            with span('zip.drain'):
+                progress.update(zipf.close())
+            on_progress(progress)
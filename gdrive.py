@@ -1,16 +1,166 @@
-import pickle
+import copy
+import time
+import json
+import hashlib
+import logging
+import os
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from types import SimpleNamespace as Namespace
-from typing import Callable, List, Optional
-from tqdm.auto import tqdm
-from googleapiclient.http import MediaFileUpload
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.service_account import Credentials
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
 from . import env
+from .archive import ChunkPipe
+from .backup import Snapshot, blob_name, write_json_atomic
+from .upload import ResumableUpload, SessionExpired, TransferError, UploadSessions, retrying
 from .i18n import tr
+from .startup import profile
+from .tracing import span
+
+log = logging.getLogger()
+
+
+def md5_file(path: Path, block_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class DriveIndex:
+    # Metadata of the files in the root folder, cached on disk and kept up to date with the changes API:
+    # a full (paginated) listing is only needed the first time, or when the saved page token expires
+    VERSION = 1
+    FIELDS = 'id, name, md5Checksum, size, modifiedTime'
+
+    def __init__(self, drive: 'GDrive', root_id: str, path: Path, max_age: float = 60.0):
+        self.drive: 'GDrive' = drive
+        self.root_id: str = root_id
+        self.path: Path = path
+        self.max_age: float = max_age
+        self.lock: threading.RLock = threading.RLock()
+        self.files: Dict[str, Dict] = {}  # id -> metadata
+        self.by_name: Dict[str, str] = {}  # name -> id
+        self.page_token: Optional[str] = None
+        self.refreshed: float = 0.0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != self.VERSION or data.get('root_id') != self.root_id:
+            return
+        self.page_token = data['page_token']
+        for file in data['files']:
+            self._put(file)
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.path, dict(version=self.VERSION, root_id=self.root_id, page_token=self.page_token,
+                                          files=list(self.files.values())))
+
+    def _put(self, file: Dict):
+        if (prev := self.files.get(file['id'])) is not None and self.by_name.get(prev['name']) == prev['id']:
+            del self.by_name[prev['name']]
+        self.files[file['id']] = file
+        self.by_name[file['name']] = file['id']
+
+    def _remove(self, file_id: str):
+        if (prev := self.files.pop(file_id, None)) is not None and self.by_name.get(prev['name']) == file_id:
+            del self.by_name[prev['name']]
+            # Another file with the same name might be left
+            if other := next((f for f in self.files.values() if f['name'] == prev['name']), None):
+                self.by_name[other['name']] = other['id']
+
+    def sync(self):
+        # Full listing; the page token is taken first, so that nothing changed meanwhile is missed
+        with self.lock:
+            page_token = self.drive.api.changes().getStartPageToken(supportsAllDrives=True).execute()['startPageToken']
+            self.files.clear()
+            self.by_name.clear()
+            request = self.drive.api.files().list(q=f"'{self.root_id}' in parents and trashed = false",
+                                            fields=f'nextPageToken, files({self.FIELDS})', pageSize=1000,
+                                            supportsAllDrives=True, includeItemsFromAllDrives=True)
+            while request is not None:
+                resp = request.execute()
+                for file in resp.get('files', []):
+                    self._put(file)
+                request = self.drive.api.files().list_next(request, resp)
+            self.page_token = page_token
+            self.refreshed = time.monotonic()
+            self._save()
+            log.info("Google Drive index synced: %d files", len(self.files))
+
+    def refresh(self, force: bool = False):
+        with self.lock:
+            if not force and time.monotonic() - self.refreshed < self.max_age:
+                return
+            if self.page_token is None:
+                return self.sync()
+
+            n_changes = 0
+            page_token = self.page_token
+            try:
+                while page_token is not None:
+                    resp = self.drive.api.changes().list(
+                        pageToken=page_token, pageSize=1000, spaces='drive',
+                        supportsAllDrives=True, includeItemsFromAllDrives=True,
+                        fields=f'nextPageToken, newStartPageToken, '
+                               f'changes(fileId, removed, file({self.FIELDS}, parents, trashed))').execute()
+                    for change in resp.get('changes', []):
+                        n_changes += 1
+                        file = change.get('file')
+                        if change.get('removed') or file is None or file.get('trashed') \
+                                or self.root_id not in file.get('parents', ()):
+                            self._remove(change['fileId'])
+                        else:
+                            self._put({key: file[key] for key in file if key not in ('parents', 'trashed')})
+                    if 'newStartPageToken' in resp:
+                        self.page_token = resp['newStartPageToken']
+                    page_token = resp.get('nextPageToken')
+            except Exception as err:
+                if getattr(getattr(err, 'resp', None), 'status', None) not in (400, 404, 410):
+                    raise
+                log.warning("Google Drive change token expired, syncing the index again")
+                return self.sync()
+
+            self.refreshed = time.monotonic()
+            if n_changes:
+                self._save()
+
+    def put(self, file: Dict):
+        # For files we just uploaded ourselves, so that there is no need to wait for the changes API
+        # (not saved right away: the changes API reports it again on the next refresh anyway)
+        with self.lock:
+            self._put(file)
+
+    def remove(self, file_id: str):
+        with self.lock:
+            self._remove(file_id)
+
+    def find(self, name: str) -> Optional[Dict]:
+        self.refresh()
+        with self.lock:
+            file_id = self.by_name.get(name)
+            return self.files[file_id] if file_id is not None else None
+
+    def matches(self, name: str, path: Path) -> Optional[Dict]:
+        # Returns the remote file with the given name if it has the same contents as the local file at `path`
+        if (file := self.find(name)) is None or file.get('md5Checksum') is None:
+            return None
+        if int(file.get('size', -1)) != path.stat().st_size:
+            return None
+        return file if md5_file(path) == file['md5Checksum'] else None
+
+    def all(self) -> List[Dict]:
+        self.refresh()
+        with self.lock:
+            return list(self.files.values())
 
 
 class GDrive:
@@ -23,45 +173,343 @@ class GDrive:
     root_id = env.Var('CB_GDRIVE_ROOT_ID', type=str,
                       help="File id of the Google Drive folder / drive to store files in",
                       optional=False)
+    chunk_size = env.Var('CB_GDRIVE_CHUNK_SIZE', type=int,
+                         help="Size (in bytes) of each chunk of a resumable upload; must be a multiple of 256KiB",
+                         optional=True,
+                         default=8 * 1024 * 1024)
+    upload_workers = env.Var('CB_GDRIVE_UPLOAD_WORKERS', type=int,
+                             help="Number of files (e.g. backup blobs) to upload in parallel",
+                             optional=True,
+                             default=4)
+    upload_url = env.Var('CB_GDRIVE_UPLOAD_URL', type=str,
+                         help="Endpoint for file uploads (only to be changed for testing)",
+                         optional=True,
+                         default='https://www.googleapis.com/upload/drive/v3/files')
+    download_url = env.Var('CB_GDRIVE_DOWNLOAD_URL', type=str,
+                           help="Endpoint for file downloads (only to be changed for testing)",
+                           optional=True,
+                           default='https://www.googleapis.com/drive/v3/files')
+    download_workers = env.Var('CB_GDRIVE_DOWNLOAD_WORKERS', type=int,
+                               help="Number of parallel requests when downloading (e.g. when restoring a backup)",
+                               optional=True,
+                               default=8)
+    cache_dir = env.Var('CB_GDRIVE_CACHE_DIR', type=Path,
+                        help="Directory where Google Drive state is kept (e.g. unfinished uploads, to be resumed)",
+                        optional=True,
+                        default=Path.home() / '.cache' / 'cieloblocco')
+    index_max_age = env.Var('CB_GDRIVE_INDEX_MAX_AGE', type=float,
+                            help="Seconds before the cached listing of the Google Drive folder is checked for changes",
+                            optional=True,
+                            default=60.0)
+
+    discovery_url = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+    _discovery: Optional[Dict] = None
+    _lock: threading.Lock = threading.Lock()
 
+    # Google's client libraries take a while to import: nothing is imported or built until it is first needed
     def __init__(self):
-        self.credentials = Credentials.from_service_account_file(self.cred_json, scopes=self.auth_scopes.split(','))
-        self.api = build('drive', 'v3', credentials=self.credentials)
+        self._credentials = None
+        self.sessions = UploadSessions(self.cache_dir / 'uploads.json')
+        self._local = threading.local()
+        self.index = DriveIndex(self, self.root_id, self.cache_dir / f'index-{self.root_id}.json',
+                                max_age=self.index_max_age)
+
+    def subfolder(self, name: str) -> 'GDrive':
+        # A client for a folder inside the root folder (created if needed), sharing this one's connections
+        if (folder := self.index.find(name)) is None:
+            folder = self.api.files().create(body=dict(name=name, parents=[self.root_id],
+                                                       mimeType='application/vnd.google-apps.folder'),
+                                             supportsAllDrives=True, fields=DriveIndex.FIELDS).execute()
+            self.index.put(folder)
+        drive = copy.copy(self)
+        drive.root_id = folder['id']
+        drive.index = DriveIndex(drive, drive.root_id, self.cache_dir / f'index-{drive.root_id}.json',
+                                 max_age=self.index_max_age)
+        return drive
+
+    @property
+    def credentials(self) -> Any:
+        with self._lock:
+            if self._credentials is None:
+                with profile.span("Drive credentials"):
+                    from google.oauth2.service_account import Credentials
+                    self._credentials = Credentials.from_service_account_file(self.cred_json,
+                                                                              scopes=self.auth_scopes.split(','))
+            return self._credentials
+
+    def discovery_document(self) -> Dict:
+        # Describes the Drive API to `googleapiclient`; kept on disk, instead of being fetched (or at best parsed
+        # from the library's own copy) every time the API client is built
+        with self._lock:
+            if GDrive._discovery is None:
+                with profile.span("Drive discovery document"):
+                    GDrive._discovery = self._load_discovery(self.cache_dir / 'drive-v3-discovery.json')
+            return GDrive._discovery
+
+    def _load_discovery(self, cache_path: Path) -> Dict:
+        try:
+            with open(cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        try:
+            from googleapiclient.discovery_cache import get_static_doc
+            document = get_static_doc('drive', 'v3')
+        except ImportError:
+            document = None
+        if document is None:
+            import requests
+            resp = requests.get(self.discovery_url, timeout=30)
+            resp.raise_for_status()
+            document = resp.text
+        document = json.loads(document)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(cache_path, document)
+        return document
+
+    @property
+    def api(self) -> Any:
+        # One per thread, since the underlying `httplib2` connections are not thread-safe
+        if (api := getattr(self._local, 'api', None)) is None:
+            document, credentials = self.discovery_document(), self.credentials
+            with profile.span("Drive API client"):
+                from googleapiclient.discovery import build_from_document
+                api = self._local.api = build_from_document(document, credentials=credentials)
+        return api
+
+    def http_session(self) -> Any:
+        # One per thread, since `requests` sessions are not thread-safe
+        if (session := getattr(self._local, 'session', None)) is None:
+            from google.auth.transport.requests import AuthorizedSession
+            session = self._local.session = AuthorizedSession(self.credentials)
+        return session
 
     def list(self, fields: List[str] = ['id', 'name'], q: str = None) -> List[Namespace]:
-        q = f"'{self.root_id}' in parents"
-        q += f' and {q}' if q else ''
-        resp = self.api.files().list(fields=f'files({",".join(fields)}), nextPageToken', q=q, pageSize=100).execute()
-        files = resp.get('files', [])
+        query = f"'{self.root_id}' in parents and trashed = false"
+        query += f' and ({q})' if q else ''
+        files = []
+        request = self.api.files().list(fields=f'files({",".join(fields)}), nextPageToken', q=query, pageSize=1000,
+                                        supportsAllDrives=True, includeItemsFromAllDrives=True)
+        while request is not None:
+            resp = request.execute()
+            files += resp.get('files', [])
+            request = self.api.files().list_next(request, resp)
         return [Namespace(**f) for f in files]
 
-    def upload_file(self, src: Path, name: str, mime: str = 'application/zip', on_progress: Optional[Callable] = None) -> str:
-        cur_files = self.list()
-        existing_file = next((f for f in cur_files if f.name == name), None)
+    def download(self, file_id: str, start: Optional[int] = None, end: Optional[int] = None) -> bytes:
+        # Downloads a whole file, or only bytes `start` to `end` (inclusive) of it
+        headers = {'Range': f'bytes={start}-{end}'} if start is not None else {}
+        resp = retrying("Download", lambda: self.http_session().get(
+            f'{self.download_url}/{file_id}', params=dict(alt='media', supportsAllDrives='true'), headers=headers))
+        if resp.status_code == 200 and start is not None:
+            # Range not honored
+            return resp.content[start:end + 1]
+        elif resp.status_code not in (200, 206):
+            raise TransferError(f"Download failed: HTTP {resp.status_code}", resp.status_code)
+        return resp.content
+
+    def download_file(self, file_id: str, size: int, dst: Path, part_size: int = 16 * 1024 * 1024,
+                      on_progress: Optional[Callable[[int], None]] = None):
+        # Downloads with parallel ranged requests, each part written in place in `dst`
+        with open(dst, 'wb') as f:
+            f.truncate(size)
+        fd = os.open(dst, os.O_WRONLY)
+
+        def download_part(start: int) -> int:
+            end = min(start + part_size, size) - 1
+            data = self.download(file_id, start, end)
+            if len(data) != end - start + 1:
+                raise TransferError(f"Download failed: got {len(data)} bytes instead of {end - start + 1}")
+            os.pwrite(fd, data, start)
+            return len(data)
+
+        try:
+            with ThreadPoolExecutor(self.download_workers) as executor:
+                for future in as_completed([executor.submit(download_part, start)
+                                            for start in range(0, size, part_size)]):
+                    n_bytes = future.result()
+                    if on_progress is not None:
+                        on_progress(n_bytes)
+        finally:
+            os.close(fd)
+
+    def delete_files(self, file_ids: List[str], batch_size: int = 100) -> List[str]:
+        # Deletes in batches of up to 100 requests (the most Drive accepts in one); returns the ids deleted
+        deleted = []
+
+        from googleapiclient.errors import HttpError
+
+        def on_response(file_id: str, response: Any, exception: Optional[Exception]):
+            if exception is None or (isinstance(exception, HttpError) and exception.resp.status == 404):
+                deleted.append(file_id)
+            else:
+                log.warning("Could not delete %s: %s", file_id, exception)
+
+        for i in range(0, len(file_ids), batch_size):
+            batch = self.api.new_batch_http_request(callback=on_response)
+            for file_id in file_ids[i:i + batch_size]:
+                batch.add(self.api.files().delete(fileId=file_id, supportsAllDrives=True), request_id=file_id)
+            batch.execute()
+
+        for file_id in deleted:
+            self.index.remove(file_id)
+        return deleted
+
+    def _upload_request(self, media: Any, name: str, mime: str):
+        existing_file = self._find(name)
 
-        media = MediaFileUpload(str(src), chunksize=1024*1024, resumable=True)
         if not existing_file:
             body = dict(
                 name=name,
                 parents=[self.root_id],
                 mimeType=mime,
             )
-            req = self.api.files().create(body=body, media_body=media,
-                                          fields='id')
+            req = self.api.files().create(body=body, media_body=media, supportsAllDrives=True,
+                                          fields=DriveIndex.FIELDS)
         else:
             body = {}
             req = self.api.files().update(body=body, media_body=media, fileId=existing_file.id,
-                                          fields='id')
+                                          supportsAllDrives=True, fields=DriveIndex.FIELDS)
+        return req
+
+    def _find(self, name: str) -> Optional[Namespace]:
+        file = self.index.find(name)
+        return Namespace(**file) if file is not None else None
+
+    def _upload(self, src: Path, name: str, mime: str, on_bytes: Optional[Callable[[int], None]] = None) -> str:
+        # Unfinished uploads of the same file (same path, size and mtime) are resumed where they were left,
+        # even across restarts
+        if (file := self.index.matches(name, src)) is not None:
+            log.info("%s is already up to date, not uploading it", name)
+            if on_bytes is not None:
+                on_bytes(src.stat().st_size)
+            return file['id']
+
+        key = UploadSessions.key(src, name)
+        upload = ResumableUpload(self.http_session(), src, mime, chunk_size=self.chunk_size,
+                                 fields=DriveIndex.FIELDS)
+
+        offset = 0
+        if (uri := self.sessions.get(key)) is not None:
+            try:
+                result = upload.query(uri)
+            except SessionExpired:
+                uri = None
+            else:
+                if isinstance(result, dict):
+                    self.sessions.drop(key)
+                    self.index.put(result)
+                    return result['id']
+                offset = result
+                log.info("Resuming upload of %s from byte %d", name, offset)
+
+        if uri is None:
+            if existing_file := self._find(name):
+                uri = upload.start(f'{self.upload_url}/{existing_file.id}', method='PATCH')
+            else:
+                uri = upload.start(self.upload_url, metadata=dict(name=name, parents=[self.root_id], mimeType=mime))
+            self.sessions.put(key, uri)
+
+        result = upload.run(uri, offset, on_progress=on_bytes)
+        self.sessions.drop(key)
+        self.index.put(result)
+        return result['id']
 
+    def upload_file(self, src: Path, name: str, mime: str = 'application/zip', on_progress: Optional[Callable] = None) -> str:
         on_progress = on_progress if on_progress is not None else (lambda *args, **kwargs: None)
 
-        with tqdm(total=100, leave=False, ncols=120, unit='%', desc=tr("Upload")) as pbar:
-            resp = None
-            while resp is None:
-                status, resp = req.next_chunk()
-                if status:
-                    progress = status.progress() * 100.0
-                    pbar.update(progress - pbar.n)
-                    on_progress(pbar)
+        from tqdm.auto import tqdm
+        with tqdm(total=src.stat().st_size, leave=False, ncols=120, unit='B', unit_scale=True,
+                  desc=tr("Upload")) as pbar, span('gdrive.upload_file', file=name, bytes=pbar.total):
+            def on_bytes(n_bytes: int):
+                pbar.update(n_bytes - pbar.n)
+                on_progress(pbar)
+
+            return self._upload(src, name, mime, on_bytes=on_bytes)
+
+    def upload_files(self, files: List[Tuple[Path, str, str]], on_progress: Optional[Callable] = None,
+                     on_uploaded: Optional[Callable[[Path], None]] = None) -> List[str]:
+        # Uploads several (src, name, mime) files in parallel; returns their ids, in order
+        on_progress = on_progress if on_progress is not None else (lambda *args, **kwargs: None)
+        lock = threading.Lock()
+
+        total_size = sum(src.stat().st_size for src, name, mime in files)
+        from tqdm.auto import tqdm
+        with tqdm(total=total_size, leave=False, ncols=120, unit='B', unit_scale=True, desc=tr("Upload")) as pbar, \
+                ThreadPoolExecutor(self.upload_workers) as executor:
+            def upload(src: Path, name: str, mime: str) -> str:
+                sent = 0
+
+                def on_bytes(n_bytes: int):
+                    nonlocal sent
+                    with lock:
+                        pbar.update(n_bytes - sent)
+                        on_progress(pbar)
+                    sent = n_bytes
+
+                file_id = self._upload(src, name, mime, on_bytes=on_bytes)
+                if on_uploaded is not None:
+                    on_uploaded(src)
+                return file_id
 
+            futures = [executor.submit(upload, *file) for file in files]
+            for future in as_completed(futures):
+                future.result()  # Raise early
+            return [future.result() for future in futures]
+
+    def upload_stream(self, produce: Callable[[BinaryIO], Any], name: str, mime: str = 'application/zip',
+                      max_chunks: int = 4, on_progress: Optional[Callable] = None) -> str:
+        # `produce(out)` is run on another thread, and what it writes to `out` is uploaded as it comes;
+        # at most `max_chunks` chunks are buffered in memory
+        pipe = ChunkPipe(self.chunk_size, max_chunks=max_chunks)
+
+        def run_producer():
+            try:
+                produce(pipe)
+            except BaseException as exc:
+                pipe.close(error=exc)
+            else:
+                pipe.close()
+
+        producer = threading.Thread(target=run_producer, name=f'upload-{name}')
+        producer.start()
+        try:
+            from .media import PipeUpload
+            req = self._upload_request(PipeUpload(pipe, mime), name, mime)
+            on_progress = on_progress if on_progress is not None else (lambda *args, **kwargs: None)
+
+            from tqdm.auto import tqdm
+            with tqdm(leave=False, ncols=120, unit='B', unit_scale=True, desc=tr("Upload")) as pbar, \
+                    span('gdrive.upload_stream', file=name):
+                resp = None
+                while resp is None:
+                    with span('upload.chunk', file=name):
+                        status, resp = req.next_chunk()
+                    if status:
+                        pbar.update(status.resumable_progress - pbar.n)
+                        on_progress(pbar)
+        except BaseException:
+            pipe.abort()
+            raise
+        finally:
+            producer.join()
+
+        self.index.put(resp)
         return resp.get('id')
+
+    def upload_snapshot(self, snapshot: Snapshot, on_progress: Optional[Callable] = None) -> str:
+        # Blobs first, so that a manifest is never uploaded before the data it references.
+        # Blobs are named after their contents, so any blob already in the folder does not need to be uploaded again
+        with span('gdrive.upload_snapshot', snapshot=snapshot.name, blobs=len(snapshot.blobs)):
+            to_upload = []
+            for blob in snapshot.blobs:
+                if self.index.find(blob_name(blob.name)) is not None:
+                    snapshot.store.mark_uploaded(blob)
+                else:
+                    to_upload.append(blob)
+            self.upload_files([(blob, blob_name(blob.name), 'application/octet-stream') for blob in to_upload],
+                              on_progress=on_progress, on_uploaded=snapshot.store.mark_uploaded)
+
+            manifest_path = snapshot.manifest_path
+            return self.upload_file(manifest_path, manifest_path.name, mime='application/json',
+                                    on_progress=on_progress)
@@ -0,0 +1,252 @@
+import json
+import math
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from . import env
+from .game import Server
+from .i18n import tr
+from .telemetry import Telemetry
+
+log = logging.getLogger()
+
+# Minecraft Java Edition protocol, just enough to answer the server list and refuse logins.
+# See: https://wiki.vg/Protocol#Handshaking and https://wiki.vg/Server_List_Ping
+STATE_STATUS = 1
+STATE_LOGIN = 2
+STATE_TRANSFER = 3
+MAX_PACKET_SIZE = 64 * 1024  # Handshakes and login starts are way smaller
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_varint(value: int) -> bytes:
+    value &= 0xFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data: bytes, offset: int = 0) -> Tuple[int, int]:
+    # Returns (value, offset after it)
+    value = 0
+    for i in range(5):
+        if offset >= len(data):
+            raise ProtocolError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value - (1 << 32) if value & (1 << 31) else value, offset
+    raise ProtocolError("Varint is too long")
+
+
+def decode_string(data: bytes, offset: int) -> Tuple[str, int]:
+    length, offset = decode_varint(data, offset)
+    if length < 0 or offset + length > len(data):
+        raise ProtocolError("Truncated string")
+    return data[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+def encode_packet(packet_id: int, payload: bytes) -> bytes:
+    body = encode_varint(packet_id) + payload
+    return encode_varint(len(body)) + body
+
+
+async def read_packet(reader: asyncio.StreamReader, first_byte: bytes = b'') -> Tuple[int, bytes]:
+    # Returns (packet id, payload); `first_byte`: already read from `reader`
+    length = 0
+    for i in range(5):
+        byte = (first_byte or await reader.readexactly(1))[0]
+        first_byte = b''
+        length |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            break
+    else:
+        raise ProtocolError("Varint is too long")
+    if not 0 < length <= MAX_PACKET_SIZE:
+        raise ProtocolError(f"Invalid packet length: {length}")
+    data = await reader.readexactly(length)
+    packet_id, offset = decode_varint(data)
+    return packet_id, data[offset:]
+
+
+class SleepListener:
+    # Stands in for a stopped server on its port: the server list shows it as sleeping, and the first player trying
+    # to join wakes it up (they are told to join again once it has started)
+    def __init__(self, host: str, port: int, motd: str, kick_message: str, timeout: float = 10.0):
+        self.host: str = host
+        self.port: int = port
+        self.motd: str = motd
+        self.kick_message: str = kick_message
+        self.timeout: float = timeout
+        self.woken: Optional[asyncio.Future] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.woken = asyncio.get_running_loop().create_future()
+        self._server = await asyncio.start_server(self._handle, host=self.host or None, port=self.port)
+        log.info("Listening for players on %s:%d", self.host or '*', self.port)
+
+    async def close(self):
+        # Before the server starts, since it needs the port
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await asyncio.wait_for(self._converse(reader, writer), timeout=self.timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ProtocolError) as err:
+            log.debug("Sleeping server connection dropped: %s", err)
+        finally:
+            writer.close()
+
+    async def _converse(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if (first_byte := await reader.readexactly(1)) == b'\xfe':
+            # Legacy (pre-1.7) server list ping: not worth answering
+            return
+        packet_id, payload = await read_packet(reader, first_byte)
+        if packet_id != 0x00:
+            raise ProtocolError(f"Expected a handshake, got packet {packet_id}")
+        protocol, offset = decode_varint(payload)
+        address, offset = decode_string(payload, offset)
+        offset += 2  # Port
+        next_state, offset = decode_varint(payload, offset)
+
+        if next_state == STATE_STATUS:
+            await self._status(reader, writer, protocol)
+        elif next_state in (STATE_LOGIN, STATE_TRANSFER):
+            peer = writer.get_extra_info('peername')
+            log.info("Login attempt from %s (via %s), waking the server up", peer[0] if peer else '?', address)
+            # Login disconnect: the reason is a JSON text component
+            writer.write(encode_packet(0x00, encode_string(json.dumps({'text': self.kick_message}))))
+            await writer.drain()
+            if not self.woken.done():
+                self.woken.set_result(True)
+        else:
+            raise ProtocolError(f"Unknown next state: {next_state}")
+
+    async def _status(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, protocol: int):
+        packet_id, _ = await read_packet(reader)
+        if packet_id != 0x00:
+            raise ProtocolError(f"Expected a status request, got packet {packet_id}")
+        status = {
+            # Same protocol as the client, so that it does not show the server as incompatible
+            'version': {'name': tr("Sleeping"), 'protocol': protocol},
+            'players': {'max': 0, 'online': 0},
+            'description': {'text': self.motd},
+        }
+        writer.write(encode_packet(0x00, encode_string(json.dumps(status))))
+        await writer.drain()
+
+        # Ping: answered with the same payload, for the client to show the latency
+        packet_id, payload = await read_packet(reader)
+        if packet_id == 0x01:
+            writer.write(encode_packet(0x01, payload))
+            await writer.drain()
+
+
+def read_properties(path: Path) -> Dict[str, str]:
+    # Java .properties, as written by Minecraft servers (no line continuations or escapes in practice)
+    properties = {}
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith(('#', '!')) and '=' in line:
+                    key, value = line.split('=', 1)
+                    properties[key.strip()] = value.strip()
+    except OSError:
+        pass
+    return properties
+
+
+class IdleManager:
+    stop_after = env.Var('CB_IDLE_STOP_AFTER', type=float,
+                         help="Minutes without any player online after which the server is stopped and backed up, "
+                         "to be started again when a player tries to join (0 = never)",
+                         optional=True,
+                         default=0.0)
+    check_interval = env.Var('CB_IDLE_CHECK_INTERVAL', type=float,
+                             help="Seconds between checks of the number of players online (as sampled by "
+                             "telemetry, see CB_TELEMETRY_INTERVAL)",
+                             optional=True,
+                             default=60.0)
+    port = env.Var('CB_IDLE_PORT', type=int,
+                   help="Port to listen for players on while the server sleeps "
+                   "(0 = `server-port` from server.properties, else 25565)",
+                   optional=True,
+                   default=0)
+    motd = env.Var('CB_IDLE_MOTD', type=str,
+                   help="Message of the day shown in the server list while the server sleeps (empty = a default one)",
+                   optional=True,
+                   default='')
+
+    def __init__(self, server: Server, telemetry: Telemetry):
+        self.server: Server = server
+        self.telemetry: Telemetry = telemetry
+        # Set when the server was stopped for being idle (as opposed to stopped on purpose, or crashed)
+        self.idled: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.stop_after > 0
+
+    def player_count(self) -> int:
+        # As last seen by telemetry: from `list` when the control can run it, else from joins and leaves
+        latest = self.telemetry.series.latest() if self.telemetry.interval > 0 else None
+        if latest is not None and not math.isnan(latest['players']):
+            return int(latest['players'])
+        return len(self.telemetry.players)
+
+    async def watch(self):
+        # Stops the server once it has been idle long enough; runs until then, or until cancelled
+        self.idled = False
+        unsubscribe = None
+        if self.telemetry.interval <= 0:
+            # Telemetry is not running to keep track of players
+            self.telemetry.players.clear()
+            unsubscribe = self.server.logs.subscribe(self.telemetry.track_players)
+        try:
+            last_active = time.monotonic()
+            while True:
+                await asyncio.sleep(min(self.check_interval, self.stop_after * 60))
+                if self.server.control is None or self.player_count() > 0:
+                    # Still starting up, or being played on
+                    last_active = time.monotonic()
+                elif time.monotonic() - last_active >= self.stop_after * 60:
+                    break
+        finally:
+            if unsubscribe is not None:
+                unsubscribe()
+
+        log.info("No players for %.0f minutes, stopping the server", self.stop_after)
+        self.idled = True
+        await self.server.stop()
+
+    def listen_address(self) -> Tuple[str, int]:
+        properties = read_properties(self.server.server_path / 'server.properties')
+        port = self.port or int(properties.get('server-port') or 25565)
+        return properties.get('server-ip', ''), port
+
+    def listener(self) -> SleepListener:
+        host, port = self.listen_address()
+        return SleepListener(host, port, motd=self.motd or tr("Sleeping: join to wake the server up"),
+                             kick_message=tr("The server is starting up, join again in a minute or two"))
@@ -0,0 +1,118 @@
+import time
+import asyncio
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Callable, NamedTuple, Optional
+from .tracing import span
+
+log = logging.getLogger()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    # Cancellation is cooperative: jobs call `check` between steps (files, chunks...), and stop there
+    def __init__(self):
+        self._cancelled: threading.Event = threading.Event()
+        self.reason: str = ''
+
+    def cancel(self, reason: str = "cancelled"):
+        self.reason = reason
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(self.reason)
+
+    def checking(self, on_progress: Optional[Callable] = None) -> Callable:
+        # A progress callback that checks for cancellation first: backups and uploads report progress after every
+        # file and chunk, so that is where they stop
+        def on_progress_checked(*args, **kwargs):
+            self.check()
+            if on_progress is not None:
+                on_progress(*args, **kwargs)
+        return on_progress_checked
+
+
+class JobResult(NamedTuple):
+    name: str
+    value: Any
+    error: Optional[BaseException]  # JobCancelled if it timed out
+    seconds: float
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class Scheduler:
+    # Runs blocking jobs (backups, uploads...) on its own threads, never on the event loop, at most `max_jobs` at a
+    # time. Each job gets a CancelToken, passed as `cancel=`: jobs are cancelled when they time out, or when whatever
+    # waits for them is cancelled
+    def __init__(self, max_jobs: int = 1):
+        self.max_jobs: int = max(max_jobs, 1)
+        self._slots: asyncio.Semaphore = asyncio.Semaphore(self.max_jobs)
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(self.max_jobs, thread_name_prefix='job')
+
+    @asynccontextmanager
+    async def slot(self, name: str) -> AsyncIterator[None]:
+        # For jobs with steps on the event loop too (e.g. a hot backup's snapshot), run them with `execute` in here
+        if self._slots.locked():
+            log.info("Waiting for other jobs to finish before %s", name)
+        async with self._slots:
+            yield
+
+    async def run(self, name: str, fn: Callable[..., Any], *args, timeout: Optional[float] = None,
+                  **kwargs) -> JobResult:
+        async with self.slot(name):
+            return await self.execute(name, fn, *args, timeout=timeout, **kwargs)
+
+    async def execute(self, name: str, fn: Callable[..., Any], *args, timeout: Optional[float] = None,
+                      **kwargs) -> JobResult:
+        # Like `run`, without waiting for a slot
+        cancel = CancelToken()
+        start = time.monotonic()
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args, cancel=cancel, **kwargs))
+        value, error = None, None
+        # The deadline is a timer of its own, so that timeouts raised by the job itself (e.g. from a socket) are not
+        # mistaken for it
+        timer = asyncio.get_running_loop().call_later(
+            timeout, cancel.cancel, f"timed out after {timeout:g} seconds") if timeout else None
+        try:
+            with span('job', job=name):
+                value = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The thread can't be interrupted: let it stop by itself, so that it doesn't outlive the event loop
+            cancel.cancel()
+            await self._wait_out(future)
+            raise
+        except Exception as err:
+            error = err
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        result = JobResult(name=name, value=value, error=error, seconds=time.monotonic() - start)
+        if result.ok:
+            log.info("Job %s done in %.1f s", name, result.seconds)
+        else:
+            log.error("Job %s failed after %.1f s", name, result.seconds, exc_info=error)
+        return result
+
+    @staticmethod
+    async def _wait_out(future: asyncio.Future):
+        with suppress(Exception):
+            await future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
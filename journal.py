@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import ctypes
+import struct
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+from .backup import write_json_atomic
+from .scan import scan_dirs
+
+log = logging.getLogger()
+
+# The paths in a save folder that changed since it was last backed up, so that the next backup only needs to look at
+# those instead of scanning the whole folder. Changes are seen with inotify, watching every directory while the
+# server runs. Between runs, nothing watches the folder: the journal is then only trusted again if no directory
+# changed meanwhile (same inode and mtime), which catches files being added, removed or replaced, but not files
+# being rewritten in place. Hence the occasional full scan anyway (CB_BACKUP_FULL_SCAN_EVERY).
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+STRUCTURE_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_event_struct = struct.Struct('iIII')
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd: int = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise self._error("inotify_init1")
+
+    def _error(self, what: str) -> OSError:
+        errno = ctypes.get_errno()
+        return OSError(errno, f"{what}: {os.strerror(errno)}")
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            # e.g. ENOSPC: fs.inotify.max_user_watches reached
+            raise self._error(f"inotify_add_watch({path})")
+        return wd
+
+    def read(self) -> Tuple[Tuple[int, int, str], ...]:
+        # Returns the pending (watch descriptor, mask, name) events
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return ()
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_struct.unpack_from(data, offset)
+            offset += _event_struct.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return tuple(events)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeJournal:
+    VERSION = 1
+
+    def __init__(self, path: Path, root: Path):
+        self.path: Path = path
+        self.root: Path = root
+        self.lock: threading.Lock = threading.Lock()
+        # Files or directories (= everything under them) that changed since the last backup, by relative path
+        self.dirty: Set[str] = set()
+        # Whether `dirty` has every change since the last backup
+        self.complete: bool = False
+        self.backups_since_full_scan: int = 0
+        # (inode, mtime) of every directory, as of the last backup or the last time it was watched
+        self.dirs: Dict[str, Tuple[int, int]] = {}
+        self._inotify: Optional[Inotify] = None
+        self._watches: Dict[int, str] = {}  # Watch descriptor -> relative directory path
+        self._touched_dirs: Set[str] = set()  # Directories whose entries changed while watched
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != self.VERSION or data.get('root') != str(self.root):
+            return
+        self.dirty = set(data['dirty'])
+        # Still watching means the process did not stop cleanly: the changes seen since the journal was saved are lost
+        self.complete = data['complete'] and not data['watching']
+        self.backups_since_full_scan = data['backups_since_full_scan']
+        self.dirs = {path: tuple(value) for path, value in data['dirs'].items()}
+
+    def save(self):
+        with self.lock:
+            data = dict(version=self.VERSION, root=str(self.root), dirty=sorted(self.dirty), complete=self.complete,
+                        watching=self.watching, backups_since_full_scan=self.backups_since_full_scan, dirs=self.dirs)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.path, data)
+
+    @property
+    def watching(self) -> bool:
+        return self._inotify is not None
+
+    def _watch_tree(self, root_rel: str, root_path: str) -> Dict[str, Tuple[int, int]]:
+        # Returns the (inode, mtime) of the directories it started watching
+        dirs = {}
+        for rel_path, path in scan_dirs(Path(root_path)):
+            rel_path = f'{root_rel}/{rel_path}'.strip('/')
+            try:
+                wd = self._inotify.add_watch(path, WATCH_MASK)
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            self._watches[wd] = rel_path
+            dirs[rel_path] = (st.st_ino, st.st_mtime_ns)
+        return dirs
+
+    def start(self):
+        # Blocking (it walks all directories): to be run before the server starts writing to its save folder
+        if not sys.platform.startswith('linux'):
+            log.warning("Can not watch %s for changes, backups will scan it entirely: inotify is Linux only",
+                        self.root)
+            with self.lock:
+                self.complete = False
+            return
+        try:
+            self._inotify = Inotify()
+            dirs = self._watch_tree('', str(self.root))
+        except (OSError, AttributeError) as err:
+            # AttributeError: no inotify in this libc
+            log.warning("Can not watch %s for changes, backups will scan it entirely: %s", self.root, err)
+            self.stop()
+            with self.lock:
+                self.complete = False
+            return
+        with self.lock:
+            if dirs != self.dirs:
+                if self.complete:
+                    log.info("%s changed while it was not watched, the next backup will scan it entirely", self.root)
+                self.complete = False
+            self.dirs = dirs
+            self._touched_dirs.clear()
+        self.save()
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        # Events are read on the event loop, as they come
+        if self._inotify is not None:
+            self._loop = loop
+            loop.add_reader(self._inotify.fd, self._on_events)
+
+    def _on_events(self):
+        for wd, mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Too many changes in %s to keep track of, the next backup will scan it entirely",
+                            self.root)
+                with self.lock:
+                    self.complete = False
+                continue
+            if (rel_dir := self._watches.get(wd)) is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if rel_dir == '':
+                    with self.lock:
+                        self.complete = False
+                continue
+
+            rel_path = f'{rel_dir}/{name}' if rel_dir else name
+            with self.lock:
+                self.dirty.add(rel_path)
+                if mask & STRUCTURE_MASK:
+                    self._touched_dirs.add(rel_dir)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # A whole new tree: watch it too (it is dirty as a whole already)
+                try:
+                    self._watch_tree(rel_path, str(self.root / rel_path))
+                except OSError as err:
+                    log.warning("Can not watch %s for changes: %s", rel_path, err)
+                    with self.lock:
+                        self.complete = False
+
+    def detach(self):
+        # On the event loop: reads the last events, and stops reading them there
+        if self._loop is not None:
+            self._on_events()
+            self._loop.remove_reader(self._inotify.fd)
+            self._loop = None
+
+    def stop(self):
+        # Blocking, like `start`, once detached from the event loop: the directories that changed are looked at
+        # again, so that their next `start` can tell whether anything happened while they were not watched
+        if self._inotify is None:
+            return
+        self.detach()
+        self._inotify.close()
+        self._inotify = None
+        self._watches.clear()
+        with self.lock:
+            for rel_dir in self._touched_dirs | {path for path in self.dirty if path in self.dirs}:
+                self._restat_tree(rel_dir)
+            self._touched_dirs.clear()
+        self.save()
+
+    def _restat_tree(self, rel_dir: str):
+        for rel_path in [path for path in self.dirs if path == rel_dir or path.startswith(rel_dir + '/')]:
+            del self.dirs[rel_path]
+        path = self.root / rel_dir
+        if path.is_dir() and not path.is_symlink():
+            for rel_path, sub_path in scan_dirs(path):
+                rel_path = f'{rel_dir}/{rel_path}'.strip('/')
+                try:
+                    st = os.stat(sub_path)
+                except OSError:
+                    # e.g. deleted meanwhile: whatever was in it is looked at again by the next backup
+                    self.dirty.add(rel_path)
+                    continue
+                self.dirs[rel_path] = (st.st_ino, st.st_mtime_ns)
+
+    def changes(self, full_scan_every: int) -> Optional[Set[str]]:
+        # What changed since the last backup, or None if the next backup has to scan everything
+        with self.lock:
+            if not self.complete or self.backups_since_full_scan + 1 >= max(full_scan_every, 1):
+                return None
+            return set(self.dirty)
+
+    def backed_up(self, changes: Optional[Set[str]], dirs: Optional[Dict[str, Tuple[int, int]]] = None):
+        # After a backup of the save folder, while nothing was writing to it. `changes` is what `changes()` returned
+        # for it; `dirs` is what the backup's full scan found, if it was one
+        with self.lock:
+            if changes is None:
+                self.backups_since_full_scan = 0
+                self.dirty.clear()
+                if dirs is not None:
+                    self.dirs = dirs
+                    self.complete = True
+            else:
+                self.backups_since_full_scan += 1
+                self.dirty -= changes
+        self.save()
@@ -0,0 +1,123 @@
+import re
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, TextIO, Tuple
+
+log = logging.getLogger()
+
+# Minecraft (vanilla, Forge, Fabric, Paper...) console lines look like:
+# `[12:34:56] [Server thread/INFO]: Done (12.345s)! For help, type "help"`
+EVENT_PATTERNS: Dict[str, str] = {
+    'ready': r'\]: Done \((?P<seconds>[\d.,]+)s\)!',
+    'join': r'\]: (?P<player>[\w.]+) joined the game',
+    'leave': r'\]: (?P<player>[\w.]+) left the game',
+    'lag': r"Can't keep up! Is the server overloaded\? Running (?P<ms>\d+)ms or (?P<ticks>\d+) ticks behind",
+    'saved': r'\]: Saved the game',
+}
+
+
+class LogEvent(NamedTuple):
+    kind: str
+    fields: Dict[str, str]
+    line: str
+    time: float
+
+
+def compile_patterns(patterns: Dict[str, str]) -> re.Pattern:
+    # All patterns are merged in a single regex, so that each line is scanned only once.
+    # Each pattern becomes a group named after its kind; its own groups are prefixed with `<kind>__`
+    alternatives = []
+    for kind, pattern in patterns.items():
+        pattern = re.sub(r'\(\?P<(\w+)>', lambda m: f'(?P<{kind}__{m[1]}>', pattern)
+        alternatives.append(f'(?P<{kind}>{pattern})')
+    return re.compile('|'.join(alternatives))
+
+
+class LogStream:
+    def __init__(self, max_lines: int = 500, patterns: Dict[str, str] = EVENT_PATTERNS):
+        self.lines: Deque[Tuple[str, str]] = deque(maxlen=max_lines)  # (stream name, line)
+        self.regex: re.Pattern = compile_patterns(patterns)
+        self.subscribers: List[Callable[[LogEvent], None]] = []
+        self.line_subscribers: List[Callable[[str, str], None]] = []
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    def reset(self):
+        # For a new run of the same server: subscribers stay, lines and waiters from the previous run go
+        self.lines.clear()
+        for futures in self._waiters.values():
+            for future in futures:
+                future.cancel()
+        self._waiters.clear()
+
+    def subscribe(self, callback: Callable[[LogEvent], None]) -> Callable[[], None]:
+        # `callback` is called on the event loop for every event; returns a function that unsubscribes it
+        self.subscribers.append(callback)
+        return lambda: self.subscribers.remove(callback)
+
+    def subscribe_lines(self, callback: Callable[[str, str], None]) -> Callable[[], None]:
+        # Like `subscribe`, for every line: `callback(line, stream)`
+        self.line_subscribers.append(callback)
+        return lambda: self.line_subscribers.remove(callback)
+
+    def expect(self, kind: str) -> asyncio.Future:
+        # A future for the next event of the given kind; get it *before* doing what will trigger the event
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(kind, []).append(future)
+        return future
+
+    async def wait_for(self, kind: str, timeout: Optional[float] = None) -> LogEvent:
+        return await asyncio.wait_for(self.expect(kind), timeout=timeout)
+
+    def feed(self, line: str, stream: str = 'stdout'):
+        self.lines.append((stream, line))
+        for line_callback in list(self.line_subscribers):
+            try:
+                line_callback(line, stream)
+            except Exception:
+                log.exception("Log line subscriber failed")
+        if not (match := self.regex.search(line)):
+            return
+
+        kind = match.lastgroup
+        prefix = f'{kind}__'
+        fields = {key[len(prefix):]: value for key, value in match.groupdict().items()
+                  if value is not None and key.startswith(prefix)}
+        event = LogEvent(kind=kind, fields=fields, line=line, time=time.time())
+
+        for future in self._waiters.pop(kind, []):
+            if not future.done():
+                future.set_result(event)
+        for callback in list(self.subscribers):
+            try:
+                callback(event)
+            except Exception:
+                log.exception("Log event subscriber failed")
+
+    async def pump(self, reader: asyncio.StreamReader, stream: str, echo: Optional[TextIO] = None):
+        # Feeds lines from `reader` as they arrive, until EOF; if `echo` is given, lines are also copied to it
+        pieces: List[bytes] = []
+        while True:
+            try:
+                raw_line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as err:
+                # EOF: what is left of the last line, if anything
+                raw_line = err.partial
+            except asyncio.LimitOverrunError as err:
+                # Line longer than the reader's limit: it is still in the reader's buffer, gather it in pieces
+                pieces.append(await reader.read(err.consumed))
+                continue
+            if pieces:
+                raw_line = b''.join(pieces) + raw_line
+                pieces.clear()
+            if not raw_line:
+                break
+            if echo is not None:
+                echo.write(raw_line.decode(errors='replace'))
+                echo.flush()
+            self.feed(raw_line.decode(errors='replace').rstrip('\r\n'), stream)
+
+    def tail(self, n: Optional[int] = None, stream: Optional[str] = None) -> str:
+        lines = [line for line_stream, line in self.lines if stream is None or line_stream == stream]
+        return '\n'.join(lines[-n:] if n else lines)
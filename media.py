@@ -0,0 +1,51 @@
+from typing import Optional
+from googleapiclient.http import MediaUpload
+from .archive import ChunkPipe
+
+# Kept apart from `gdrive`, so that `googleapiclient` (slow to import) is only imported when needed
+
+
+class PipeUpload(MediaUpload):
+    # Resumable upload of a stream of unknown size, read from a `ChunkPipe`.
+    # Only the chunk being uploaded is kept around (in case it has to be re-sent), plus one byte of lookahead:
+    # the last chunk must carry the total size, so the end of the stream has to be known before sending it
+    def __init__(self, pipe: ChunkPipe, mimetype: str):
+        super().__init__()
+        self._pipe: ChunkPipe = pipe
+        self._mimetype: str = mimetype
+        self._buffer: bytearray = bytearray()
+        self._buffer_start: int = 0
+        self._next_start: int = 0
+        self._eof: bool = False
+
+    def chunksize(self) -> int:
+        return self._pipe.chunk_size
+
+    def mimetype(self) -> str:
+        return self._mimetype
+
+    def resumable(self) -> bool:
+        return True
+
+    def has_stream(self) -> bool:
+        return False
+
+    def _fill(self, end: int):
+        while not self._eof and self._buffer_start + len(self._buffer) < end:
+            if chunk := self._pipe.read_chunk():
+                self._buffer += chunk
+            else:
+                self._eof = True
+
+    def size(self) -> Optional[int]:
+        self._fill(self._next_start + self.chunksize() + 1)
+        return self._buffer_start + len(self._buffer) if self._eof else None
+
+    def getbytes(self, begin: int, length: int) -> bytes:
+        if begin < self._buffer_start:
+            raise RuntimeError("Can not rewind the upload stream that far")
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        self._next_start = begin + min(length, len(self._buffer))
+        return bytes(self._buffer[:length])
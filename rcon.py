@@ -0,0 +1,235 @@
+import asyncio
+import struct
+import logging
+from collections import namedtuple
+from typing import Dict, List, Optional, Union
+from .tracing import span
+
+log = logging.getLogger()
+
+
+class RconError(RuntimeError):
+    pass
+
+
+class RconPacket(namedtuple('RconPacket', 'id type body')):
+    # See: https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
+    SERVERDATA_AUTH = 3
+    SERVERDATA_AUTH_RESPONSE = 2
+    SERVERDATA_EXECCOMMAND = 2
+    SERVERDATA_RESPONSE_VALUE = 0
+
+    MIN_SIZE = 4 * 3 + 1 + 1
+    MAX_SIZE = 1024 * 1024  # Way more than any real server sends in one packet
+
+    _size_struct = struct.Struct('<l')
+    _header_struct = struct.Struct('<ll')
+
+    def encode(self) -> bytes:
+        body = self.body.encode('utf-8')
+        header = self._header_struct.pack(self.id, self.type)
+        size = self._size_struct.pack(len(header) + len(body) + 2)
+        return b''.join((size, header, body, b'\0\0'))
+
+    @staticmethod
+    def decode(data: Union[bytes, memoryview]) -> 'RconPacket':
+        view = memoryview(data)
+        if len(view) < RconPacket.MIN_SIZE:
+            raise RconError("Packet is too short")
+        size = RconPacket._size_struct.unpack_from(view)[0]
+        if len(view) - RconPacket._size_struct.size != size:
+            raise RconError("Mismatched packet size")
+        return RconPacket.decode_payload(view[RconPacket._size_struct.size:])
+
+    @staticmethod
+    def decode_payload(data: Union[bytes, memoryview]) -> 'RconPacket':
+        # Decodes a packet without its size prefix
+        view = memoryview(data)
+        if len(view) < RconPacket.MIN_SIZE - RconPacket._size_struct.size:
+            raise RconError("Packet is too short")
+        if view[-2:] != b'\0\0':
+            raise RconError("Malformed packet")
+
+        id, type = RconPacket._header_struct.unpack_from(view)
+        body = str(view[RconPacket._header_struct.size:-2], 'utf-8', 'replace')
+        return RconPacket(id=id, type=type, body=body)
+
+    @staticmethod
+    async def async_read(stream: asyncio.StreamReader) -> 'RconPacket':
+        try:
+            size = RconPacket._size_struct.unpack(await stream.readexactly(RconPacket._size_struct.size))[0]
+            if not RconPacket.MIN_SIZE - RconPacket._size_struct.size <= size <= RconPacket.MAX_SIZE:
+                raise RconError(f"Invalid packet size: {size}")
+            return RconPacket.decode_payload(await stream.readexactly(size))
+        except asyncio.IncompleteReadError as err:
+            raise ConnectionResetError("Rcon connection closed") from err
+
+
+class _Request:
+    def __init__(self, future: asyncio.Future, multi: bool):
+        self.future: asyncio.Future = future
+        self.multi: bool = multi
+        self.parts: List[str] = []
+
+
+class RconClient:
+    # Many requests can be in flight at once over one connection: each gets its own id, and a single reader task
+    # routes responses to whoever is waiting for them. Lost connections are re-established in the background.
+    MAX_ID = 0x7FFFFFFF
+
+    def __init__(self, host: str = 'localhost', port: int = 25575, password: str = '',
+                 reconnect_delay: float = 1.0):
+        self.host: str = host
+        self.port: int = int(port)
+        self.password: str = password
+        self.reconnect_delay: float = reconnect_delay
+        self._next_id: int = 0
+        self._tx: Optional[asyncio.StreamWriter] = None
+        self._connected: asyncio.Event = asyncio.Event()
+        self._closed: bool = False
+        self._task: Optional[asyncio.Task] = None
+        self._requests: Dict[int, _Request] = {}  # By command id
+        self._ends: Dict[int, _Request] = {}  # By end-of-response marker id
+
+    def _new_id(self) -> int:
+        self._next_id = self._next_id % self.MAX_ID + 1
+        return self._next_id
+
+    async def connect(self):
+        # Waits until the server accepts the connection (e.g. until it is done starting up) and authenticates
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        if self._connected.is_set():
+            return
+
+        waiter = asyncio.ensure_future(self._connected.wait())
+        try:
+            await asyncio.wait((waiter, self._task), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        if self._task.done():
+            self._task.result()  # Raises whatever made the client give up
+            raise RconError("Rcon client is closed")
+
+    async def _open(self) -> asyncio.StreamReader:
+        while True:
+            try:
+                rx, tx = await asyncio.open_connection(host=self.host, port=self.port)
+            except (OSError, ConnectionError):
+                # Let other coroutines run while we wait for RCON
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            else:
+                break
+
+        log.debug("Authenticating to rcon server")
+        req_id = self._new_id()
+        tx.write(RconPacket(id=req_id, type=RconPacket.SERVERDATA_AUTH, body=self.password).encode())
+        await tx.drain()
+        auth_resp = await RconPacket.async_read(rx)
+        if auth_resp.type == RconPacket.SERVERDATA_RESPONSE_VALUE:
+            # Source servers send an empty response before the actual auth response
+            auth_resp = await RconPacket.async_read(rx)
+        if auth_resp.type != RconPacket.SERVERDATA_AUTH_RESPONSE or auth_resp.id != req_id:
+            tx.close()
+            raise RconError("Rcon authentication failed")
+
+        log.debug("Authenticated")
+        self._tx = tx
+        return rx
+
+    async def _run(self):
+        try:
+            while not self._closed:
+                rx = await self._open()
+                self._connected.set()
+                try:
+                    await self._read_loop(rx)
+                except (ConnectionError, RconError) as err:
+                    log.debug("Rcon connection lost: %s", err)
+                finally:
+                    self._connected.clear()
+                    self._tx.close()
+                    self._tx = None
+                    self._fail_all(ConnectionResetError("Rcon connection lost"))
+        except BaseException as err:
+            # e.g. authentication failed: nothing to retry
+            self._fail_all(err)
+            raise
+
+    async def _read_loop(self, rx: asyncio.StreamReader):
+        while True:
+            packet = await RconPacket.async_read(rx)
+            if (req := self._requests.get(packet.id)) is not None:
+                req.parts.append(packet.body)
+                if not req.multi and not req.future.done():
+                    req.future.set_result(packet.body)
+            elif (req := self._ends.get(packet.id)) is not None:
+                if not req.future.done():
+                    req.future.set_result(''.join(req.parts))
+            # Anything else is a response to a request that was given up on
+
+    def _fail_all(self, err: BaseException):
+        for req in list(self._requests.values()):
+            if not req.future.done():
+                req.future.set_exception(err)
+
+    async def command(self, command: str, timeout: Optional[float] = None, multi: bool = True) -> str:
+        # With `multi`, responses split over several packets are joined back together; this needs an extra
+        # round trip, and for the server to still be there afterwards (so not for e.g. `stop`)
+        result, = await self.commands([command], timeout=timeout, multi=multi)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    async def commands(self, commands: List[str], timeout: Optional[float] = None,
+                       multi: bool = True) -> List[Union[str, BaseException]]:
+        # Sends all commands in one write, then waits for all responses; each command gets either its response,
+        # or the exception it failed with (e.g. `asyncio.TimeoutError`)
+        if self._closed:
+            raise RconError("Rcon client is closed")
+        if not commands:
+            return []
+        await self.connect()
+
+        loop = asyncio.get_running_loop()
+        reqs, ids, data = [], [], []
+        for command in commands:
+            req = _Request(loop.create_future(), multi)
+            req_id = self._new_id()
+            self._requests[req_id] = req
+            ids.append(req_id)
+            data.append(RconPacket(id=req_id, type=RconPacket.SERVERDATA_EXECCOMMAND, body=command).encode())
+            if multi:
+                # Servers answer in order, so the response to this empty packet marks the end of the command's output
+                end_id = self._new_id()
+                self._ends[end_id] = req
+                ids.append(end_id)
+                data.append(RconPacket(id=end_id, type=RconPacket.SERVERDATA_RESPONSE_VALUE, body='').encode())
+            reqs.append(req)
+
+        try:
+            with span('rcon.command', command=commands[0].split(' ', 1)[0], batch=len(commands)):
+                if self._tx is None:
+                    raise ConnectionResetError("Rcon connection lost")
+                self._tx.write(b''.join(data))
+                await self._tx.drain()
+                await asyncio.wait([req.future for req in reqs], timeout=timeout)
+            return [(req.future.exception() or req.future.result()) if req.future.done() else asyncio.TimeoutError()
+                    for req in reqs]
+        finally:
+            for req_id in ids:
+                self._requests.pop(req_id, None)
+                self._ends.pop(req_id, None)
+
+    async def close(self):
+        self._closed = True
+        if self._tx is not None:
+            self._tx.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except BaseException:
+                pass
+        self._fail_all(RconError("Rcon client is closed"))
@@ -0,0 +1,71 @@
+import struct
+from typing import BinaryIO, List, Optional, Tuple
+
+# Minecraft Anvil region files (.mca)
+# See: https://minecraft.fandom.com/wiki/Region_file_format
+SECTOR_SIZE = 4096
+N_CHUNKS = 32 * 32
+HEADER_SIZE = 2 * SECTOR_SIZE
+MAX_SECTORS = 0xFF
+
+_header_struct = struct.Struct(f'>{N_CHUNKS}I{N_CHUNKS}I')
+_length_struct = struct.Struct('>I')
+
+
+class RegionError(Exception):
+    pass
+
+
+def read_header(f: BinaryIO) -> Tuple[List[int], List[int]]:
+    # Returns (locations, timestamps); a location is `sector_offset << 8 | sector_count`, 0 if the chunk is missing
+    f.seek(0)
+    header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE:
+        raise RegionError("Region file is too short")
+    entries = _header_struct.unpack(header)
+    return list(entries[:N_CHUNKS]), list(entries[N_CHUNKS:])
+
+
+def read_chunk(f: BinaryIO, location: int) -> bytes:
+    # Returns the raw chunk as stored in the region file: length + compression type + compressed data
+    offset, n_sectors = location >> 8, location & 0xFF
+    if offset < 2 or n_sectors == 0:
+        raise RegionError(f"Invalid chunk location: {location:#x}")
+
+    f.seek(offset * SECTOR_SIZE)
+    raw_length = f.read(_length_struct.size)
+    if len(raw_length) != _length_struct.size:
+        raise RegionError("Chunk is past the end of the region file")
+    length = _length_struct.unpack(raw_length)[0]
+    if length == 0 or length + _length_struct.size > n_sectors * SECTOR_SIZE:
+        raise RegionError(f"Invalid chunk length: {length}")
+
+    data = f.read(length)
+    if len(data) != length:
+        raise RegionError("Truncated chunk")
+    return raw_length + data
+
+
+def write_region(f: BinaryIO, chunks: List[Optional[bytes]], timestamps: List[int]):
+    # Chunks are laid out back to back (in index order) right after the header
+    if len(chunks) != N_CHUNKS or len(timestamps) != N_CHUNKS:
+        raise RegionError("A region file must contain exactly 32x32 chunks")
+
+    locations = [0] * N_CHUNKS
+    offset = HEADER_SIZE // SECTOR_SIZE
+    for i, chunk in enumerate(chunks):
+        if chunk is None:
+            continue
+        n_sectors = -(-len(chunk) // SECTOR_SIZE)
+        if n_sectors > MAX_SECTORS:
+            raise RegionError(f"Chunk {i} is too big for a region file")
+        locations[i] = offset << 8 | n_sectors
+        offset += n_sectors
+
+    f.write(_header_struct.pack(*locations, *timestamps))
+    for chunk in chunks:
+        if chunk is None:
+            continue
+        f.write(chunk)
+        padding = -len(chunk) % SECTOR_SIZE
+        f.write(b'\0' * padding)
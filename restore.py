@@ -0,0 +1,260 @@
+import os
+import json
+import zlib
+import ctypes
+import shutil
+import hashlib
+import logging
+import threading
+import zipfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from tqdm.auto import tqdm
+from . import env
+from . import region
+from .backup import blob_name, restore_file, restore_region
+from .game import Server
+from .gdrive import GDrive, md5_file
+from .retention import Generation, Retention
+
+log = logging.getLogger()
+
+# Restores a backup from Google Drive into the server's save folder:
+# the backup is rebuilt in a staging directory next to the save folder, reusing every file already on disk that is
+# identical to the one in the backup (so that only what differs is downloaded or extracted), then the staging
+# directory is swapped with the save folder in one go
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2  # From <linux/fs.h>
+
+
+def swap_dirs(a: Path, b: Path):
+    # Atomically exchanges two paths where possible (Linux >= 3.15), with two renames otherwise
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0:
+            return
+        log.debug("renameat2 failed: %s", os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError):
+        pass
+    tmp = a.with_name(a.name + '.swap')
+    os.rename(a, tmp)
+    os.rename(b, a)
+    os.rename(tmp, b)
+
+
+def file_digest(path: Path, block_size: int = 1024 * 1024) -> Tuple[str, int]:
+    # (sha256, crc32) of a file
+    sha256, crc = hashlib.sha256(), 0
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            sha256.update(block)
+            crc = zlib.crc32(block, crc)
+    return sha256.hexdigest(), crc
+
+
+def read_region_chunks(path: Path) -> Tuple[Dict[str, bytes], List[Optional[str]], List[int]]:
+    # Chunks of an existing region file by hash, the hash of each chunk slot (None if empty) and the timestamps
+    chunks, digests = {}, []
+    with open(path, 'rb') as f:
+        locations, timestamps = region.read_header(f)
+        for location in locations:
+            digest = None
+            if location:
+                chunk = region.read_chunk(f, location)
+                digest = hashlib.sha256(chunk).hexdigest()
+                chunks[digest] = chunk
+            digests.append(digest)
+    return chunks, digests, timestamps
+
+
+class Restorer:
+    def __init__(self, gdrive: GDrive, save_dir: Path, workers: int, keep_old: bool = False):
+        self.gdrive: GDrive = gdrive
+        self.save_dir: Path = save_dir
+        self.workers: int = workers
+        self.keep_old: bool = keep_old
+        self.staging: Path = save_dir.with_name(f'.{save_dir.name}.restore')
+        self.n_reused: int = 0
+        self.n_restored: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def _reuse(self, src: Path, dst: Path):
+        # Hard links are enough, unless the old save folder is kept (it would change along with the new one)
+        try:
+            if self.keep_old:
+                shutil.copy2(src, dst)
+            else:
+                os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        with self._lock:
+            self.n_reused += 1
+
+    def _restored(self):
+        with self._lock:
+            self.n_restored += 1
+
+    def _run_parallel(self, jobs: List[Callable[[], int]], total: int, desc: str):
+        with tqdm(total=total, leave=False, ncols=120, unit='B', unit_scale=True, desc=desc) as progress, \
+                ThreadPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(job) for job in jobs]
+            try:
+                for future in as_completed(futures):
+                    progress.update(future.result())
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _restore_zip_entry(self, archive: Path, info: zipfile.ZipInfo, local_zip: threading.local) -> int:
+        rel_path = Path(*Path(info.filename).parts[1:])  # Archive names start with the save folder's name
+        dst_path = self.staging / rel_path
+        dst_path.parent.mkdir(parents=True, exist_ok=True)
+
+        local_path = self.save_dir / rel_path
+        if local_path.is_file() and local_path.stat().st_size == info.file_size \
+                and file_digest(local_path)[1] == info.CRC:
+            self._reuse(local_path, dst_path)
+            return info.file_size
+
+        # `ZipFile`s are not meant to be shared between threads
+        if (zf := getattr(local_zip, 'zf', None)) is None:
+            zf = local_zip.zf = zipfile.ZipFile(archive)
+        # The CRC is checked as the entry is read
+        with zf.open(info) as src, open(dst_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        mtime = datetime(*info.date_time).timestamp()
+        os.utime(dst_path, (mtime, mtime))
+        self._restored()
+        return info.file_size
+
+    def restore_zip(self, generation: Generation):
+        archive = self.staging.with_name(self.staging.name + '.zip')
+        size = int(generation.file['size'])
+        try:
+            with tqdm(total=size, leave=False, ncols=120, unit='B', unit_scale=True, desc="Download") as progress:
+                self.gdrive.download_file(generation.file['id'], size, archive, on_progress=progress.update)
+            if 'md5Checksum' in generation.file and md5_file(archive) != generation.file['md5Checksum']:
+                raise RuntimeError(f"Checksum mismatch for {generation.file['name']}")
+
+            with zipfile.ZipFile(archive) as zf:
+                infos = [info for info in zf.infolist() if not info.is_dir()]
+            local_zip = threading.local()
+            self._run_parallel([lambda info=info: self._restore_zip_entry(archive, info, local_zip) for info in infos],
+                               sum(info.file_size for info in infos), desc="Extract")
+        finally:
+            archive.unlink(missing_ok=True)
+
+    def _fetch_blob(self, digest: str) -> bytes:
+        if (file := self.gdrive.index.find(blob_name(digest))) is None:
+            raise RuntimeError(f"Blob {digest} is missing")
+        return self.gdrive.download(file['id'])
+
+    def _restore_snapshot_file(self, file: Dict) -> int:
+        dst_path = self.staging / file['path']
+        dst_path.parent.mkdir(parents=True, exist_ok=True)
+        local_path = self.save_dir / file['path']
+
+        if file.get('region'):
+            # Region files on disk may have their chunks laid out differently: compare them chunk by chunk,
+            # and only fetch the chunks that differ
+            local_chunks = None
+            if local_path.is_file():
+                try:
+                    local_chunks, local_digests, local_timestamps = read_region_chunks(local_path)
+                except (OSError, region.RegionError):
+                    pass
+                else:
+                    if local_digests == file['chunks'] and local_timestamps == file['region'][1]:
+                        self._reuse(local_path, dst_path)
+                        return file['size']
+            restore_region(file, dst_path, self._fetch_blob, local_chunks=local_chunks)
+        else:
+            if local_path.is_file() and local_path.stat().st_size == file['size'] \
+                    and file_digest(local_path)[0] == file['sha256']:
+                self._reuse(local_path, dst_path)
+                return file['size']
+            restore_file(file, dst_path, self._fetch_blob)
+
+        os.utime(dst_path, ns=(file['mtime_ns'], file['mtime_ns']))
+        self._restored()
+        return file['size']
+
+    def restore_snapshot(self, generation: Generation):
+        manifest = json.loads(self.gdrive.download(generation.file['id']))
+        files = manifest['files']
+        self._run_parallel([lambda file=file: self._restore_snapshot_file(file) for file in files],
+                           sum(file['size'] for file in files), desc="Restore")
+
+    def restore(self, generation: Generation):
+        shutil.rmtree(self.staging, ignore_errors=True)
+        self.staging.mkdir(parents=True)
+        try:
+            if generation.file['name'].endswith('.zip'):
+                self.restore_zip(generation)
+            else:
+                self.restore_snapshot(generation)
+        except BaseException:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            raise
+
+        if self.save_dir.exists():
+            swap_dirs(self.save_dir, self.staging)
+            old_dir = self.staging
+            if self.keep_old:
+                old_dir = self.save_dir.with_name(f'{self.save_dir.name}.old-{datetime.now():%Y%m%d-%H%M%S}')
+                os.rename(self.staging, old_dir)
+                log.info("Previous save folder kept as %s", old_dir)
+            else:
+                shutil.rmtree(old_dir)
+        else:
+            os.rename(self.staging, self.save_dir)
+
+
+def find_generation(generations: List[Generation], name: Optional[str]) -> Optional[Generation]:
+    # By name (with or without extension), or the latest one
+    if name is None:
+        return generations[-1] if generations else None
+    return next((g for g in generations if name in (g.name, g.file['name'])), None)
+
+
+def main(args: List[str]) -> int:
+    argp = ArgumentParser(prog='cieloblocco restore',
+                          usage='cieloblocco restore [-h] [--list] [--keep-old] [--server SERVER] [snapshot] '
+                                '[flags or environment variables]',
+                          description="Restores the save folder from a backup on Google Drive. Stop the server first!")
+    argp.add_argument('snapshot', nargs='?', default=None,
+                      help="Name of the backup to restore (e.g. world-20240101-120000); defaults to the latest one")
+    argp.add_argument('--list', action='store_true', help="List the available backups and exit")
+    argp.add_argument('--keep-old', action='store_true', help="Keep the current save folder, renamed, after restoring")
+    argp.add_argument('--server', default=None, help="Name of the server to restore, when running several (see CB_SERVERS)")
+    opts = env.load_from_args(args, argp)
+
+    if opts.server is not None:
+        server = env.with_prefix(Server, env.name_prefix(opts.server))(name=opts.server)
+        gdrive = GDrive().subfolder(opts.server)
+    else:
+        server = Server()
+        gdrive = GDrive()
+    base_name = server.save_folder.name
+    generations = Retention(gdrive).generations(base_name)
+
+    if opts.list:
+        for generation in generations:
+            print(f"{generation.file['name']}\t{int(generation.file.get('size', 0)) / 2 ** 20:.1f} MiB")
+        return 0
+
+    if (generation := find_generation(generations, opts.snapshot)) is None:
+        log.error("No backup of %s found%s", base_name, f" named {opts.snapshot}" if opts.snapshot else "")
+        return 1
+
+    save_dir = server.server_path / server.save_folder
+    log.info("Restoring %s into %s", generation.file['name'], save_dir)
+    restorer = Restorer(gdrive, save_dir, workers=gdrive.download_workers, keep_old=opts.keep_old)
+    restorer.restore(generation)
+    log.info("Restored %s: %d files restored, %d unchanged", generation.name, restorer.n_restored, restorer.n_reused)
+    return 0
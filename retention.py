@@ -0,0 +1,151 @@
+import re
+import json
+import logging
+from concurrent.futures import Future
+from datetime import datetime
+from threading import Thread
+from typing import Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Set, Tuple
+from . import env
+from .backup import BackupStore, blob_name
+from .gdrive import GDrive
+
+log = logging.getLogger()
+
+BLOB_PREFIX = blob_name('')
+
+
+class Generation(NamedTuple):
+    name: str  # Without extension
+    time: datetime
+    file: Dict  # Drive metadata
+
+
+def parse_generation(file_name: str, base_name: str) -> Optional[Tuple[str, datetime]]:
+    # Backups are named `<base>-YYYYmmdd-HHMMSS.zip` (full archives) or `<base>-YYYYmmdd-HHMMSS.json` (snapshot
+    # manifests); see `backup.snapshot_name`
+    if not (m := re.fullmatch(rf'({re.escape(base_name)}-(\d{{8}}-\d{{6}}))\.(?:zip|json)', file_name)):
+        return None
+    return m[1], datetime.strptime(m[2], '%Y%m%d-%H%M%S')
+
+
+def select_keep(times: Iterable[datetime], hourly: int, daily: int, weekly: int) -> Set[datetime]:
+    # Grandfather-father-son: the latest backup of each of the `hourly` most recent hours that have one,
+    # of each of the `daily` most recent days and of each of the `weekly` most recent (ISO) weeks.
+    # The latest backup is always kept
+    times = sorted(set(times), reverse=True)
+    keep = set(times[:1])
+    buckets: List[Tuple[int, Callable[[datetime], Hashable]]] = [
+        (hourly, lambda t: (t.date(), t.hour)),
+        (daily, lambda t: t.date()),
+        (weekly, lambda t: t.isocalendar()[:2]),
+    ]
+    for n, bucket in buckets:
+        seen = set()
+        for t in times:
+            if len(seen) >= n:
+                break
+            if (b := bucket(t)) not in seen:
+                seen.add(b)
+                keep.add(t)
+    return keep
+
+
+def manifest_blobs(manifest: Dict) -> Set[str]:
+    return {digest for file in manifest['files'] for digest in file['chunks'] if digest}
+
+
+class Retention:
+    hourly = env.Var('CB_RETAIN_HOURLY', type=int,
+                     help="Number of most recent hours to keep a backup of (the latest one of each hour)",
+                     optional=True,
+                     default=24)
+    daily = env.Var('CB_RETAIN_DAILY', type=int,
+                    help="Number of most recent days to keep a backup of (the latest one of each day)",
+                    optional=True,
+                    default=7)
+    weekly = env.Var('CB_RETAIN_WEEKLY', type=int,
+                     help="Number of most recent weeks to keep a backup of (the latest one of each week).\n"
+                     "If CB_RETAIN_HOURLY, CB_RETAIN_DAILY and CB_RETAIN_WEEKLY are all 0, no backup is ever deleted",
+                     optional=True,
+                     default=4)
+
+    def __init__(self, gdrive: GDrive):
+        self.gdrive: GDrive = gdrive
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hourly or self.daily or self.weekly)
+
+    def generations(self, base_name: str) -> List[Generation]:
+        generations = []
+        for file in self.gdrive.index.all():
+            if parsed := parse_generation(file['name'], base_name):
+                generations.append(Generation(*parsed, file=file))
+        return sorted(generations, key=lambda g: g.time)
+
+    def _load_manifest(self, generation: Generation, store: Optional[BackupStore]) -> Dict:
+        local_path = store.snapshots / f'{generation.name}.json' if store is not None else None
+        if local_path is not None and local_path.exists():
+            with open(local_path, 'r') as f:
+                return json.load(f)
+        return json.loads(self.gdrive.download(generation.file['id']))
+
+    def prune(self, base_name: str, store: Optional[BackupStore] = None) -> Tuple[int, int]:
+        # Deletes the backups the policy does not keep, then the blobs no kept snapshot references any more;
+        # returns the number of (backups, blobs) deleted.
+        # `store` must be the local store of the snapshot being uploaded (if any): its manifest is written before
+        # its blobs are uploaded, which is how blobs of a snapshot still in flight are told apart from garbage
+        if not self.enabled:
+            return 0, 0
+
+        self.gdrive.index.refresh(force=True)
+        generations = self.generations(base_name)
+        keep_times = select_keep((g.time for g in generations), self.hourly, self.daily, self.weekly)
+        keep = [g for g in generations if g.time in keep_times]
+        drop = [g for g in generations if g.time not in keep_times]
+
+        # Mark
+        referenced = set()
+        for generation in keep:
+            if generation.file['name'].endswith('.json'):
+                referenced |= manifest_blobs(self._load_manifest(generation, store))
+        stale_manifests = []
+        if store is not None:
+            newest_remote = generations[-1].time if generations else datetime.min
+            for manifest_path in store.snapshots.glob('*.json'):
+                parsed = parse_generation(manifest_path.name, base_name)
+                if parsed is not None and parsed[1] < newest_remote and parsed[1] not in keep_times:
+                    # Pruned, or never uploaded and superseded since
+                    stale_manifests.append(manifest_path)
+                elif parsed is not None and parsed[1] >= newest_remote:
+                    # Not uploaded yet
+                    with open(manifest_path, 'r') as f:
+                        referenced |= manifest_blobs(json.load(f))
+
+        # Sweep: backups first, so that no manifest is ever left referencing deleted blobs
+        deleted = self.gdrive.delete_files([g.file['id'] for g in drop])
+        garbage = {file['id']: file['name'][len(BLOB_PREFIX):] for file in self.gdrive.index.all()
+                   if file['name'].startswith(BLOB_PREFIX) and file['name'][len(BLOB_PREFIX):] not in referenced}
+        deleted_blobs = self.gdrive.delete_files(list(garbage))
+        if store is not None:
+            store.forget(garbage[file_id] for file_id in deleted_blobs)
+            for manifest_path in stale_manifests:
+                manifest_path.unlink(missing_ok=True)
+
+        log.info("Pruned %d of %d backups of %s, and %d unreferenced blobs",
+                 len(deleted), len(generations), base_name, len(deleted_blobs))
+        return len(deleted), len(deleted_blobs)
+
+    def prune_in_background(self, base_name: str, store: Optional[BackupStore] = None) -> Future:
+        # Meant to overlap with the upload of the next backup; failures are only logged
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.prune(base_name, store))
+            except Exception as exc:
+                log.exception("Pruning old backups failed")
+                future.set_exception(exc)
+
+        Thread(target=run, name=f'prune-{base_name}', daemon=True).start()
+        return future
@@ -0,0 +1,92 @@
+import os
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger()
+
+# Streaming directory scans: files come out in batches, sorted by path, while the tree is being walked; in memory
+# at any time are one batch plus the listings of the directories on the way down (not the whole tree)
+
+
+class ScanEntry(NamedTuple):
+    rel_path: str  # Relative to the scanned directory, with `/` separators
+    path: str
+    stat: Optional[os.stat_result]  # None for files known not to have changed (see `BackupStore.backup`)
+
+
+def _sort_key(entry: os.DirEntry) -> str:
+    # With a trailing `/` for directories, whole paths come out in the same order as when sorted as strings
+    return entry.name + '/' if entry.is_dir() else entry.name
+
+
+def _listing(path: str) -> List[os.DirEntry]:
+    try:
+        with os.scandir(path) as it:
+            return sorted(it, key=_sort_key)
+    except OSError as err:
+        # Like `os.walk`, skip what can't be read
+        log.warning("Could not list %s: %s", path, err)
+        return []
+
+
+def scan_tree(root: Path, prefix: str = '', batch_size: int = 1024,
+              dirs: Optional[Dict[str, Tuple[int, int]]] = None) -> Iterator[List[ScanEntry]]:
+    # Yields the files under `root` in sorted batches of at most `batch_size`; relative paths start with `prefix`.
+    # The stat results come from the directory entries (they are cached there, and for directories the type comes
+    # from the listing without any further system call). Symlinks to directories are not followed, as with `os.walk`.
+    # `dirs`, if given, is filled with the (inode, mtime) of every directory, by relative path (the root's is '')
+    batch: List[ScanEntry] = []
+    if dirs is not None:
+        st = os.stat(root)
+        dirs[prefix.rstrip('/')] = (st.st_ino, st.st_mtime_ns)
+    stack = [(iter(_listing(str(root))), prefix)]
+    while stack:
+        entries, rel_dir = stack[-1]
+        if (entry := next(entries, None)) is None:
+            stack.pop()
+            continue
+
+        rel_path = rel_dir + entry.name
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    if dirs is not None:
+                        st = entry.stat()
+                        dirs[rel_path] = (st.st_ino, st.st_mtime_ns)
+                    stack.append((iter(_listing(entry.path)), rel_path + '/'))
+                continue
+            batch.append(ScanEntry(rel_path, entry.path, entry.stat()))
+        except FileNotFoundError:
+            # Deleted since it was listed
+            continue
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scan_dirs(root: Path) -> Iterator[Tuple[str, str]]:
+    # Yields the (relative path, path) of `root` and of every directory under it, without looking at the files
+    stack = [(str(root), '')]
+    while stack:
+        path, rel_path = stack.pop()
+        yield rel_path, path
+        for entry in _listing(path):
+            try:
+                if entry.is_dir() and not entry.is_symlink():
+                    stack.append((entry.path, f'{rel_path}/{entry.name}' if rel_path else entry.name))
+            except OSError:
+                continue
+
+
+def in_batches(entries: Iterable[ScanEntry], batch_size: int = 1024) -> Iterator[List[ScanEntry]]:
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,52 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple
+
+log = logging.getLogger()
+
+
+class StartupProfile:
+    # Timings of the steps of startup, relative to when the process started running Python code of ours.
+    # Always recorded, since it's cheap; only reported when asked to (`--profile-startup`)
+    def __init__(self):
+        self.enabled: bool = False
+        self.start: float = time.perf_counter()
+        # (step, start, end), in seconds since `self.start`
+        self.steps: List[Tuple[str, float, float]] = []
+        self._lock: threading.Lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.perf_counter() - self.start
+
+    def mark(self, step: str):
+        # A point in time, e.g. "server spawned"
+        now = self.now()
+        with self._lock:
+            self.steps.append((step, now, now))
+
+    @contextmanager
+    def span(self, step: str):
+        # Something taking time, e.g. an import
+        start = self.now()
+        try:
+            yield
+        finally:
+            end = self.now()
+            with self._lock:
+                self.steps.append((step, start, end))
+
+    def report(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            steps = sorted(self.steps, key=lambda s: s[1])
+        width = max((len(step) for step, _, _ in steps), default=0)
+        lines = [f"{step:<{width}}  at {start * 1000:8.1f} ms" +
+                 (f"  took {(end - start) * 1000:8.1f} ms" if end > start else '')
+                 for step, start, end in steps]
+        log.info("Startup profile:\n%s", '\n'.join(lines))
+
+
+profile = StartupProfile()
@@ -0,0 +1,349 @@
+import signal
+import asyncio
+import logging
+import threading
+from contextlib import suppress
+from concurrent.futures import wait
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+from . import env
+from .backup import snapshot_name
+from .game import Server
+from .gdrive import GDrive
+from .i18n import tr
+from .idle import IdleManager
+from .jobs import CancelToken, Scheduler
+from .retention import Retention
+from .startup import profile
+from .telemetry import Telemetry
+from .tracing import span, tracer
+
+if TYPE_CHECKING:
+    from .bot import Bot
+
+log = logging.getLogger()
+
+
+class Instance:
+    # One game server, with its own telemetry and backups
+    def __init__(self, supervisor: 'Supervisor', name: Optional[str] = None):
+        self.supervisor: 'Supervisor' = supervisor
+        self.name: Optional[str] = name
+        if name is None:
+            self.server: Server = Server()
+            self.telemetry: Telemetry = Telemetry(self.server)
+            self.idle: IdleManager = IdleManager(self.server, self.telemetry)
+        else:
+            prefix = env.name_prefix(name)
+            self.server = env.with_prefix(Server, prefix)(name=name)
+            self.telemetry = env.with_prefix(Telemetry, prefix)(self.server)
+            self.idle = env.with_prefix(IdleManager, prefix)(self.server, self.telemetry)
+        self.gdrive: Optional[GDrive] = None
+        self.retention: Optional[Retention] = None
+        self.spawned: asyncio.Event = asyncio.Event()
+
+    def init_storage(self):
+        # Connects to Drive on first use, from any thread. Each server of several gets its own folder, so that
+        # pruning one's backups can never touch another's
+        with self.supervisor.storage_lock:
+            if self.gdrive is not None:
+                return
+            gdrive = self.supervisor.gdrive
+            gdrive = gdrive.subfolder(self.name) if self.name is not None else gdrive
+            self.retention = Retention(gdrive)
+            self.gdrive = gdrive
+
+    @property
+    def bot(self) -> 'Bot':
+        return self.supervisor.bot
+
+    def backup_and_upload(self, src_dir: Optional[Path] = None, on_progress: Optional[Callable] = None,
+                          cancel: Optional[CancelToken] = None):
+        # Old backups are pruned while the new one is uploaded. Blocking: run it as a job (see `Scheduler`)
+        cancel = cancel or CancelToken()
+        on_progress = cancel.checking(on_progress)
+        self.init_storage()
+        server = self.server
+        base_name = server.save_folder.name
+        if server.backup_format == 'zip':
+            pruning = self.retention.prune_in_background(base_name)
+            # Compress and upload at the same time, without a temporary file
+            self.gdrive.upload_stream(
+                lambda out: server.write_saves_zip(out, on_progress=on_progress, src_dir=src_dir),
+                f'{snapshot_name(base_name)}.zip')
+        else:
+            snapshot = server.backup_saves(on_progress=on_progress, src_dir=src_dir)
+            pruning = self.retention.prune_in_background(base_name, snapshot.store)
+            cancel.check()
+            self.gdrive.upload_snapshot(snapshot, on_progress=on_progress)
+        # Not before pruning is done, so that it never overlaps with the next backup
+        wait([pruning])
+
+    @property
+    def backup_timeout(self) -> Optional[float]:
+        return self.server.backup_timeout * 60 or None
+
+    async def hot_backups(self, server_done: asyncio.Event):
+        interval = self.server.hot_backup_interval * 60
+        while True:
+            try:
+                await asyncio.wait_for(server_done.wait(), timeout=interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+            name = f'hot-backup-{self.name or "server"}'
+            try:
+                async with self.supervisor.jobs.slot(name):
+                    snapshot_dir = await self.server.hot_snapshot()
+                    # Players keep playing while the snapshot is backed up
+                    result = await self.supervisor.jobs.execute(name, self.backup_and_upload, snapshot_dir,
+                                                                timeout=self.backup_timeout)
+                if result.ok:
+                    log.info("Hot backup done: %s", snapshot_dir.name)
+            except Exception:
+                log.exception("Hot backup failed")
+
+    async def final_backup(self):
+        with span('shutdown.backup', server=self.name):
+            await self._final_backup()
+        # Where the time went, while it is fresh
+        await asyncio.get_running_loop().run_in_executor(None, tracer.dump, f'shutdown-{self.name or "server"}')
+
+    async def _final_backup(self):
+        server, bot = self.server, self.bot
+        msg_intro = bot.label(server, tr("Backing up saves: {save}", save=server.save_folder.name))
+        msg = await bot.message(msg_intro)
+
+        def on_progress(progress):
+            bot.edit_soon(msg, f'{msg_intro}\n{progress}')
+
+        result = await self.supervisor.jobs.run(f'backup-{self.name or "server"}', self.backup_and_upload,
+                                                on_progress=on_progress, timeout=self.backup_timeout)
+        if result.ok:
+            bot.edit_soon(msg, bot.label(server, tr("Done backing up: {save}", save=server.save_folder.name)))
+        else:
+            bot.edit_soon(msg, bot.label(server, tr("Backup of {save} failed: {error}",
+                                                    save=server.save_folder.name, error=result.error)))
+        await bot.flush_edits(msg)
+        bot.add_reactions(msg, [bot.delete_reaction])
+
+    def on_spawned(self):
+        profile.mark(f"Server spawned: {self.name or self.server.modpack}")
+        self.spawned.set()
+
+    async def shut_down(self, server_future: asyncio.Future):
+        # Without Discord nobody could stop the server: don't leave it running
+        server = self.server
+        while server.control is None and not server_future.done():
+            await asyncio.sleep(1)
+        if not server_future.done():
+            await server.stop()
+        await server_future
+
+    async def run_once(self) -> Tuple[int, str]:
+        server, telemetry = self.server, self.telemetry
+        self.idle.idled = False
+        # The server starts up while Discord connects
+        server_future = asyncio.ensure_future(server.run(on_spawned=self.on_spawned))
+        try:
+            bot = await self.supervisor.ready_bot()
+        except BaseException:
+            await self.shut_down(server_future)
+            raise
+
+        exitcode, output = 9999, "<internal error>"
+        server_done = asyncio.Event()
+        hot_backup_task = None
+        monitor_tasks = []
+        try:
+            await bot.on_server_started(server)
+            if server.hot_backup_interval > 0:
+                hot_backup_task = asyncio.ensure_future(self.hot_backups(server_done))
+            if telemetry.interval > 0:
+                monitor_tasks.append(asyncio.ensure_future(telemetry.run()))
+                if bot.status_interval > 0:
+                    monitor_tasks.append(asyncio.ensure_future(bot.show_status(server, telemetry.summary)))
+            if self.idle.enabled:
+                monitor_tasks.append(asyncio.ensure_future(self.idle.watch()))
+            exitcode, output = await server_future
+        finally:
+            server_done.set()
+            for task in monitor_tasks:
+                task.cancel()
+            await bot.on_server_done(server, exitcode, output)
+
+        if hot_backup_task is not None:
+            # Let any hot backup still in progress finish first
+            await hot_backup_task
+        return exitcode, output
+
+    async def before_restart(self):
+        server = self.server
+        if server.restart_snapshot == 'local':
+            snapshot_dir = await asyncio.get_running_loop().run_in_executor(None, server.crash_snapshot)
+            log.info("Saved a copy of the crashed server's saves in %s", snapshot_dir)
+        elif server.restart_snapshot == 'backup':
+            await self.final_backup()
+        elif server.restart_snapshot != 'none':
+            log.error("Unknown restart snapshot type: %s", server.restart_snapshot)
+
+    async def sleep(self) -> bool:
+        # Until a player tries to join (returns True), or the server is stopped from Discord (returns False)
+        server, bot = self.server, self.bot
+        listener = self.idle.listener()
+        try:
+            await listener.start()
+        except OSError:
+            log.exception("Could not listen for players on port %d, stopping for good", listener.port)
+            return False
+        try:
+            stopped = await bot.on_server_sleeping(server)
+            await asyncio.wait((listener.woken, stopped), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            await listener.close()
+            await bot.on_server_woken(server)
+        if listener.woken.done():
+            log.info("Waking %s up", server.name or server.modpack)
+            return True
+        return False
+
+    async def run(self) -> int:
+        # Runs the server until it is stopped, restarting it when it crashes; the Discord connection, the Drive
+        # client and everything else stay up meanwhile
+        server = self.server
+        try:
+            await self.telemetry.serve()
+        except OSError:
+            log.exception("Could not serve metrics for %s", server.name or server.modpack)
+
+        crashes = server.crash_tracker()
+        while True:
+            exitcode, output = await self.run_once()
+            if self.idle.idled:
+                await self.final_backup()
+                if not await self.sleep():
+                    return exitcode
+                continue
+            if exitcode == 0 or server.stopping:
+                break
+
+            bot = self.bot
+            if (delay := crashes.crashed()) is None:
+                if server.restart_max_crashes > 0:
+                    await bot.message(bot.label(server, tr(
+                        "Server crashed {n} times in {minutes:.0f} minutes, not restarting it",
+                        n=len(crashes.crashes), minutes=server.restart_window)), [bot.delete_reaction])
+                return exitcode
+
+            try:
+                await self.before_restart()
+            except Exception:
+                log.exception("Could not save the crashed server's saves")
+            msg = await bot.message(bot.label(server, tr("Restarting server in {seconds:.0f} seconds...",
+                                                         seconds=delay)))
+            await asyncio.sleep(delay)
+            from discord import NotFound
+            with suppress(NotFound):
+                await msg.delete()
+
+        await self.final_backup()
+        return exitcode
+
+
+class Supervisor:
+    servers = env.Var('CB_SERVERS', type=str,
+                      help="Comma-separated names of the servers to run, for running several at once.\n"
+                      "Each server is configured by the usual variables prefixed with its name, which fall back to the "
+                      "unprefixed ones (e.g. CB_MYPACK_GAME_SERVER_PATH, else CB_GAME_SERVER_PATH).\n"
+                      "Empty = a single server, configured by the unprefixed variables. "
+                      "Only read from the environment (or .env file), not from flags",
+                      optional=True,
+                      default='')
+    max_backups = env.Var('CB_MAX_CONCURRENT_BACKUPS', type=int,
+                          help="Maximum number of backups running at the same time, across all servers",
+                          optional=True,
+                          default=1)
+
+    def __init__(self):
+        names = [name.strip() for name in self.servers.split(',') if name.strip()]
+        if len(set(map(env.name_prefix, names))) != len(names):
+            raise RuntimeError("Server names must be unique")
+        # Before parsing the command line, since the prefixed variables get flags too
+        self.instances: List[Instance] = [Instance(self, name) for name in names] or [Instance(self)]
+        self.gdrive: Optional[GDrive] = None
+        self.storage_lock: threading.Lock = threading.Lock()
+        self.bot: Optional['Bot'] = None
+        self.jobs: Optional[Scheduler] = None
+        self._bot_starting: asyncio.Event = asyncio.Event()
+        self._bot_task: Optional[asyncio.Task] = None
+        self._bot_connection: Optional[asyncio.Task] = None
+
+    def init(self):
+        # After parsing the command line. Nothing is imported or connected to here: the game servers are launched
+        # first, and everything else happens while they start up
+        self.gdrive = GDrive()
+        tracer.configure()
+
+    async def start_bot(self) -> 'Bot':
+        with profile.span("Discord import"):
+            from .bot import Bot
+        self.bot = Bot(loop=asyncio.get_running_loop())
+        self._bot_connection = asyncio.ensure_future(self.bot.start(self.bot.token))
+        ready = asyncio.ensure_future(self.bot.is_ready.wait())
+        await asyncio.wait((ready, self._bot_connection), return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            ready.cancel()
+            self._bot_connection.result()
+            raise RuntimeError("Disconnected from Discord before being ready")
+        profile.mark("Discord ready")
+        return self.bot
+
+    async def ready_bot(self) -> 'Bot':
+        # The bot is started once all servers are launched
+        await self._bot_starting.wait()
+        return await asyncio.shield(self._bot_task)
+
+    def warm_up(self):
+        # Loads Drive's libraries and syncs the indices in the background, ahead of the first backup
+        for instance in self.instances:
+            try:
+                instance.init_storage()
+                instance.gdrive.index.refresh()
+            except Exception:
+                log.exception("Could not connect to Google Drive, will retry on the first backup")
+                return
+        profile.mark("Drive ready")
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.jobs = Scheduler(self.max_backups)
+        if tracer.enabled:
+            loop.add_signal_handler(signal.SIGUSR1, lambda: loop.run_in_executor(None, tracer.dump))
+        runs = [asyncio.ensure_future(instance.run()) for instance in self.instances]
+
+        # Nothing slow happens before the servers are launched (unless some of them fail to launch)
+        spawned = asyncio.ensure_future(asyncio.gather(*(instance.spawned.wait() for instance in self.instances)))
+        await asyncio.wait((spawned, *runs), return_when=asyncio.FIRST_COMPLETED)
+        spawned.cancel()
+        warming_up = loop.run_in_executor(None, self.warm_up)
+        self._bot_task = asyncio.ensure_future(self.start_bot())
+        self._bot_starting.set()
+        with suppress(Exception):
+            await self.ready_bot()
+        await warming_up
+        profile.report()
+
+        results = await asyncio.gather(*runs, return_exceptions=True)
+        for instance, result in zip(self.instances, results):
+            if isinstance(result, BaseException):
+                log.error("Server %s failed", instance.name or '', exc_info=result)
+        if self.bot is not None:
+            await self.bot.close()
+        if self._bot_connection is not None:
+            with suppress(Exception):
+                await self._bot_connection
+        self.jobs.shutdown()
+
+    def run(self):
+        asyncio.run(self.main())
@@ -0,0 +1,268 @@
+import os
+import re
+import math
+import time
+import asyncio
+import logging
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from . import env
+from .game import Server
+from .logs import LogEvent
+from .i18n import tr
+
+log = logging.getLogger()
+
+HAVE_PROCFS = os.path.isdir('/proc/self')
+
+_formatting_codes = re.compile(r'§.')
+_forge_tps = re.compile(r'Overall\s*:.*?Mean tick time:\s*(?P<mspt>[\d.]+)\s*ms.*?Mean TPS:\s*(?P<tps>[\d.]+)')
+_paper_tps = re.compile(r'TPS from last [^:]*:\s*\*?(?P<tps>[\d.]+)')
+_vanilla_mspt = re.compile(r'Average time per tick:\s*(?P<mspt>[\d.]+)\s*ms')
+_players = re.compile(r'There are (?P<online>\d+)(?: of a max of |/)(?P<max>\d+) players online')
+
+
+def parse_players(output: str) -> Optional[Tuple[int, int]]:
+    # (online, max) from the output of `list`
+    if m := _players.search(_formatting_codes.sub('', output)):
+        return int(m['online']), int(m['max'])
+    return None
+
+
+class TimeSeries:
+    # Fixed-size ring buffer of samples; each metric is a flat array of doubles
+    def __init__(self, metrics: Iterable[str], capacity: int):
+        self.metrics: List[str] = list(metrics)
+        self.capacity: int = capacity
+        self.times: array = array('d', [math.nan] * capacity)
+        self.values: Dict[str, array] = {m: array('d', [math.nan] * capacity) for m in self.metrics}
+        self.count: int = 0
+
+    def append(self, t: float, sample: Dict[str, float]):
+        i = self.count % self.capacity
+        self.times[i] = t
+        for metric, values in self.values.items():
+            values[i] = sample.get(metric, math.nan)
+        self.count += 1
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return {metric: values[i] for metric, values in self.values.items()}
+
+    def window(self, metric: str) -> List[Tuple[float, float]]:
+        # (time, value) pairs, oldest first
+        start = self.count - len(self)
+        indices = (j % self.capacity for j in range(start, self.count))
+        values = self.values[metric]
+        return [(self.times[i], values[i]) for i in indices]
+
+
+def process_tree(root_pid: int) -> List[int]:
+    # The startup script is usually a shell that runs the actual (Java) server as a child
+    children: Dict[int, List[int]] = {}
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rindex(b')') + 2:].split(maxsplit=2)[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    pids, todo = [], [root_pid]
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        todo.extend(children.get(pid, ()))
+    return pids
+
+
+def process_usage(pids: Iterable[int]) -> Tuple[float, int]:
+    # Returns (CPU seconds, resident set size in bytes), summed over all given processes
+    ticks, pages = 0, 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # Fields after the (comm) field, which may contain spaces; utime, stime and rss are fields 14, 15 and 24
+        fields = stat[stat.rindex(b')') + 2:].split()
+        ticks += int(fields[11]) + int(fields[12])
+        pages += int(fields[21])
+    return ticks / os.sysconf('SC_CLK_TCK'), pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_tps(output: str) -> Dict[str, float]:
+    output = _formatting_codes.sub('', output)
+    sample = {}
+    if m := _forge_tps.search(output):
+        sample['tps'] = float(m['tps'])
+        sample['mspt'] = float(m['mspt'])
+    else:
+        if m := _paper_tps.search(output):
+            sample['tps'] = float(m['tps'])
+        if m := _vanilla_mspt.search(output):
+            sample['mspt'] = float(m['mspt'])
+    return sample
+
+
+class Telemetry:
+    interval = env.Var('CB_TELEMETRY_INTERVAL', type=float,
+                       help="Seconds between server health samples (0 = disabled)",
+                       optional=True,
+                       default=10.0)
+    history = env.Var('CB_TELEMETRY_HISTORY', type=int,
+                      help="Number of samples to keep in memory",
+                      optional=True,
+                      default=360)
+    tps_command = env.Var('CB_TELEMETRY_TPS_COMMAND', type=str,
+                          help="Console command that reports the server's TPS/MSPT "
+                          "(e.g. `forge tps`, `tps` on Paper, `tick query` on vanilla 1.20.3+; empty = disabled)",
+                          optional=True,
+                          default='forge tps')
+    host = env.Var('CB_TELEMETRY_HOST', type=str,
+                   help="Address to serve Prometheus metrics on",
+                   optional=True,
+                   default='127.0.0.1')
+    port = env.Var('CB_TELEMETRY_PORT', type=int,
+                   help="Port to serve Prometheus metrics on, at /metrics (0 = disabled)",
+                   optional=True,
+                   default=0)
+
+    METRICS = ('tps', 'mspt', 'players', 'max_players', 'cpu_percent', 'cpu_seconds', 'rss_bytes')
+
+    def __init__(self, server: Server):
+        self.server: Server = server
+        self.series: TimeSeries = TimeSeries(self.METRICS, self.history)
+        self.players: Set[str] = set()
+        self._prev_cpu: Optional[Tuple[float, float]] = None
+        self._unsubscribe = None
+
+    def track_players(self, event: LogEvent):
+        # Keeps track of players for controls that can not run `list` (e.g. stdin)
+        if event.kind == 'join':
+            self.players.add(event.fields['player'])
+        elif event.kind == 'leave':
+            self.players.discard(event.fields['player'])
+
+    async def _command(self, command: str) -> Optional[str]:
+        control = self.server.control
+        if control is None or not control.captures_output:
+            # Typing commands in the console would only spam it
+            return None
+        try:
+            return await control.command(command, timeout=max(self.interval, 1.0))
+        except (ConnectionError, asyncio.TimeoutError):
+            return None
+
+    async def sample(self) -> Dict[str, float]:
+        sample = {}
+        now = time.monotonic()
+
+        # Process stats come from procfs: not on every OS (e.g. Windows), where only what RCON says is sampled
+        if (process := self.server.process) is not None and process.returncode is None and HAVE_PROCFS:
+            cpu_seconds, rss = process_usage(process_tree(process.pid))
+            sample['cpu_seconds'] = cpu_seconds
+            sample['rss_bytes'] = rss
+            if self._prev_cpu is not None:
+                prev_time, prev_seconds = self._prev_cpu
+                sample['cpu_percent'] = 100.0 * (cpu_seconds - prev_seconds) / max(now - prev_time, 1e-6)
+            self._prev_cpu = (now, cpu_seconds)
+
+        # Both commands are in flight at once over RCON
+        list_output, tps_output = await asyncio.gather(
+            self._command('list'),
+            self._command(self.tps_command) if self.tps_command else asyncio.sleep(0))
+        if list_output and (players := parse_players(list_output)) is not None:
+            sample['players'], sample['max_players'] = players
+        else:
+            sample['players'] = len(self.players)
+        if tps_output:
+            sample.update(parse_tps(tps_output))
+
+        return sample
+
+    async def run(self):
+        # Samples until cancelled
+        self.players.clear()
+        self._prev_cpu = None
+        self._unsubscribe = self.server.logs.subscribe(self.track_players)
+        try:
+            while True:
+                try:
+                    self.series.append(time.time(), await self.sample())
+                except Exception:
+                    log.exception("Telemetry sample failed")
+                await asyncio.sleep(self.interval)
+        finally:
+            self._unsubscribe()
+
+    def prometheus(self) -> str:
+        # See: https://prometheus.io/docs/instrumenting/exposition_formats/
+        latest = self.series.latest() or {}
+        labels = f'{{server="{self.server.modpack}"}}'
+        metrics = [
+            ('cieloblocco_tps', 'gauge', "Server ticks per second", 'tps'),
+            ('cieloblocco_mspt', 'gauge', "Milliseconds per server tick", 'mspt'),
+            ('cieloblocco_players', 'gauge', "Players online", 'players'),
+            ('cieloblocco_max_players', 'gauge', "Maximum number of players", 'max_players'),
+            ('cieloblocco_process_cpu_seconds_total', 'counter', "CPU time used by the server processes",
+             'cpu_seconds'),
+            ('cieloblocco_process_resident_memory_bytes', 'gauge', "Resident memory of the server processes",
+             'rss_bytes'),
+        ]
+        lines = []
+        for name, kind, help, metric in metrics:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            value = latest.get(metric, math.nan)
+            if not math.isnan(value):
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b'\r\n', b'\n', b''):
+                pass
+            method, path, *_ = request_line.decode('latin-1').split() + ['', '']
+            if method == 'GET' and path.split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', self.prometheus().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> Optional[asyncio.AbstractServer]:
+        if not self.port:
+            return None
+        log.info("Serving metrics on %s:%d", self.host, self.port)
+        return await asyncio.start_server(self._handle_http, host=self.host, port=self.port)
+
+    def summary(self) -> str:
+        latest = self.series.latest()
+        if latest is None:
+            return tr("No data yet")
+
+        def fmt(value: float, spec: str) -> str:
+            return '?' if math.isnan(value) else format(value, spec)
+
+        return tr("TPS: {tps} ({mspt} ms/tick) | Players: {players} | CPU: {cpu}% | RAM: {ram} GiB",
+                  tps=fmt(latest['tps'], '.1f'), mspt=fmt(latest['mspt'], '.1f'),
+                  players=fmt(latest['players'], '.0f'), cpu=fmt(latest['cpu_percent'], '.0f'),
+                  ram=fmt(latest['rss_bytes'] / 2 ** 30, '.2f'))
@@ -0,0 +1,200 @@
+import os
+import json
+import math
+import time
+import asyncio
+import logging
+import weakref
+import itertools
+import threading
+from array import array
+from collections import deque
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Any, ContextManager, Deque, Dict, Iterator, List, Optional, Tuple
+from . import env
+
+log = logging.getLogger()
+
+# Spans: named, timed sections of code, e.g. `with span('backup.compress', bytes=len(data)): ...`.
+# When tracing is enabled, each span goes to a rolling histogram of its name's durations, and to a bounded list of
+# recent spans that can be written out in Chrome's trace format (chrome://tracing, https://ui.perfetto.dev).
+# When it is not, `span()` returns a shared no-op context manager, and costs about as much as a function call
+
+
+class RollingHistogram:
+    # Durations in log-scale buckets (4 per doubling, from 1µs to about an hour), over the last `window` seconds:
+    # kept as `n_slots` histograms of `window / n_slots` seconds each, the oldest of which is reused as time passes
+    BUCKETS_PER_DOUBLING = 4
+    N_BUCKETS = BUCKETS_PER_DOUBLING * 32
+
+    def __init__(self, window: float, n_slots: int = 6):
+        self.slot_seconds: float = window / n_slots
+        self.n_slots: int = n_slots
+        self.slot_ids: List[int] = [-1] * n_slots
+        self.counts: List[array] = [array('L', [0]) * self.N_BUCKETS for _ in range(n_slots)]
+        self.totals: array = array('d', [0.0]) * n_slots
+        self.maxes: array = array('d', [0.0]) * n_slots
+
+    @classmethod
+    def bucket(cls, seconds: float) -> int:
+        micros = seconds * 1e6
+        if micros <= 1.0:
+            return 0
+        return min(int(math.log2(micros) * cls.BUCKETS_PER_DOUBLING), cls.N_BUCKETS - 1)
+
+    @classmethod
+    def bucket_limit(cls, bucket: int) -> float:
+        # Upper bound of the bucket, in seconds
+        return 2 ** ((bucket + 1) / cls.BUCKETS_PER_DOUBLING) / 1e6
+
+    def add(self, seconds: float, now: float):
+        slot_id = int(now // self.slot_seconds)
+        i = slot_id % self.n_slots
+        if self.slot_ids[i] != slot_id:
+            self.slot_ids[i] = slot_id
+            self.counts[i] = array('L', [0]) * self.N_BUCKETS
+            self.totals[i] = 0.0
+            self.maxes[i] = 0.0
+        self.counts[i][self.bucket(seconds)] += 1
+        self.totals[i] += seconds
+        self.maxes[i] = max(self.maxes[i], seconds)
+
+    def summary(self, now: float) -> Optional[Dict]:
+        # Times in milliseconds; percentiles are the upper bounds of their buckets
+        oldest = int(now // self.slot_seconds) - self.n_slots + 1
+        slots = [i for i, slot_id in enumerate(self.slot_ids) if slot_id >= oldest]
+        counts = [sum(self.counts[i][b] for i in slots) for b in range(self.N_BUCKETS)]
+        if not (n := sum(counts)):
+            return None
+        total = sum(self.totals[i] for i in slots)
+        max_seconds = max(self.maxes[i] for i in slots)
+
+        def percentile(p: float) -> float:
+            rank, seen = math.ceil(p / 100 * n), 0
+            for b, count in enumerate(counts):
+                seen += count
+                if seen >= rank:
+                    return min(self.bucket_limit(b), max_seconds) * 1000
+            return max_seconds * 1000
+
+        return dict(count=n, total_ms=total * 1000, mean_ms=total / n * 1000, p50_ms=percentile(50),
+                    p90_ms=percentile(90), p99_ms=percentile(99), max_ms=max_seconds * 1000,
+                    buckets=[[self.bucket_limit(b) * 1000, count] for b, count in enumerate(counts) if count])
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'start', 'task')
+
+    def __init__(self, tracer: 'Tracer', name: str, args: Dict[str, Any]):
+        self.tracer: 'Tracer' = tracer
+        self.name: str = name
+        self.args: Dict[str, Any] = args
+
+    def __enter__(self) -> '_Span':
+        # Spans of concurrent tasks interleave on the event loop's thread: each task gets its own track in the trace
+        try:
+            self.task: Optional[asyncio.Task] = asyncio.current_task()
+        except RuntimeError:
+            self.task = None
+        self.start: int = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self, time.perf_counter_ns())
+
+
+class Tracer:
+    trace_dir = env.Var('CB_TRACE_DIR', type=Path,
+                        help="Directory to write traces to (empty = tracing disabled)\n"
+                        "When set, timings of server startup/shutdown, backups, uploads and RCON commands are written "
+                        "there after every backup done on shutdown, and whenever the process gets SIGUSR1",
+                        optional=True,
+                        default=None)
+    max_events = env.Var('CB_TRACE_EVENTS', type=int,
+                         help="Number of most recent spans kept for the Chrome trace",
+                         optional=True,
+                         default=100000)
+    window = env.Var('CB_TRACE_WINDOW', type=float,
+                     help="Minutes of history of the timing histograms",
+                     optional=True,
+                     default=60.0)
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.lock: threading.Lock = threading.Lock()
+        self.histograms: Dict[str, RollingHistogram] = {}
+        # (name, start ns, end ns, track, track name, args)
+        self.events: Deque[Tuple[str, int, int, int, str, Dict[str, Any]]] = deque()
+        # Tasks come and go (and their ids get reused): each gets a track number of its own, forgotten with it
+        self._task_tracks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._tracks: Iterator[int] = itertools.count(1)
+        self._origin_ns: int = time.perf_counter_ns()
+
+    def configure(self):
+        # After parsing the command line
+        self.enabled = self.trace_dir is not None
+        self.events = deque(maxlen=max(self.max_events, 0))
+        if self.enabled:
+            log.info("Tracing to %s", self.trace_dir)
+
+    def record(self, span: _Span, end: int):
+        with self.lock:
+            if span.task is not None:
+                if (track := self._task_tracks.get(span.task)) is None:
+                    track = self._task_tracks[span.task] = next(self._tracks)
+                track_name = span.task.get_name()
+            else:
+                track = threading.get_ident()
+                track_name = threading.current_thread().name
+            if (histogram := self.histograms.get(span.name)) is None:
+                histogram = self.histograms[span.name] = RollingHistogram(self.window * 60)
+            histogram.add((end - span.start) / 1e9, time.monotonic())
+            self.events.append((span.name, span.start, end, track, track_name, span.args))
+
+    def summary(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        with self.lock:
+            summaries = {name: histogram.summary(now) for name, histogram in sorted(self.histograms.items())}
+        return {name: summary for name, summary in summaries.items() if summary is not None}
+
+    def chrome_trace(self) -> Dict:
+        # See: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nt46SRgjbmM
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        # Only the names of the tracks still having events
+        track_names = {track: track_name for _, _, _, track, track_name, _ in events}
+        trace_events: List[Dict] = [dict(name='thread_name', ph='M', pid=pid, tid=track, args=dict(name=name))
+                                    for track, name in track_names.items()]
+        trace_events += [dict(name=name, cat=name.split('.', 1)[0], ph='X', pid=pid, tid=track,
+                              ts=(start - self._origin_ns) / 1000, dur=(end - start) / 1000, args=args)
+                         for name, start, end, track, _, args in events]
+        return dict(traceEvents=trace_events, displayTimeUnit='ms')
+
+    def dump(self, label: str = 'trace') -> Optional[Path]:
+        # Writes the histograms (`<label>-<time>.json`) and the Chrome trace (`<label>-<time>.trace.json`)
+        if not self.enabled:
+            return None
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        base = self.trace_dir / f'{label}-{datetime.now():%Y%m%d-%H%M%S}'
+        with open(base.with_name(base.name + '.json'), 'w') as f:
+            json.dump(dict(created=datetime.now().isoformat(), window_minutes=self.window, spans=self.summary()),
+                      f, indent=1)
+        with open(base.with_name(base.name + '.trace.json'), 'w') as f:
+            json.dump(self.chrome_trace(), f, separators=(',', ':'))
+        log.info("Trace written to %s.json", base)
+        return base
+
+
+tracer = Tracer()
+_disabled = nullcontext()
+
+
+def span(name: str, **args: Any) -> ContextManager:
+    if not tracer.enabled:
+        return _disabled
+    return _Span(tracer, name, args)
@@ -0,0 +1,194 @@
+import json
+import time
+import random
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from .backup import write_json_atomic
+from .tracing import span
+
+log = logging.getLogger()
+
+# Google resumable upload protocol, spoken over any `requests.Session`-like object (e.g. an `AuthorizedSession`)
+# See: https://developers.google.com/drive/api/guides/manage-uploads#resumable
+CHUNK_ALIGN = 256 * 1024
+MIN_CHUNK_SIZE = CHUNK_ALIGN
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class TransferError(Exception):
+    def __init__(self, what: str, status: Optional[int] = None):
+        super().__init__(what)
+        self.status: Optional[int] = status
+
+
+class UploadError(TransferError):
+    pass
+
+
+class SessionExpired(UploadError):
+    pass
+
+
+class UploadSessions:
+    # Session URIs of unfinished uploads, persisted so that they can be resumed after a restart
+    MAX_AGE = 6 * 24 * 60 * 60  # Sessions expire after a week
+
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self.lock: threading.Lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.sessions: Dict[str, Dict] = json.load(f)
+        except (OSError, ValueError):
+            self.sessions = {}
+        now = time.time()
+        self.sessions = {key: s for key, s in self.sessions.items() if now - s['created'] < self.MAX_AGE}
+
+    @staticmethod
+    def key(src: Path, name: str) -> str:
+        st = src.stat()
+        return f'{name}:{src.resolve()}:{st.st_size}:{st.st_mtime_ns}'
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            session = self.sessions.get(key)
+        return session['uri'] if session else None
+
+    def put(self, key: str, uri: str):
+        with self.lock:
+            self.sessions[key] = dict(uri=uri, created=time.time())
+            self._save()
+
+    def drop(self, key: str):
+        with self.lock:
+            if self.sessions.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.path, self.sessions)
+
+
+def retrying(what: str, request: Callable[[], Any], max_retries: int = 6) -> Any:
+    # Runs `request` until it returns a response that is not a transient error, with exponential backoff
+    for attempt in range(max_retries + 1):
+        try:
+            resp = request()
+        except (ConnectionError, OSError) as err:
+            # `requests` exceptions derive from IOError
+            failure = str(err)
+        else:
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+            failure = f"HTTP {resp.status_code}"
+        if attempt == max_retries:
+            raise TransferError(f"{what} failed: {failure}")
+        delay = min(2 ** attempt + random.random(), 60)
+        log.warning("%s failed (%s), retrying in %.1fs", what, failure, delay)
+        time.sleep(delay)
+
+
+def _align(size: int) -> int:
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size // CHUNK_ALIGN * CHUNK_ALIGN))
+
+
+class ResumableUpload:
+    def __init__(self, session: Any, src: Path, mime: str, chunk_size: int = 8 * 1024 * 1024,
+                 target_seconds: float = 4.0, max_retries: int = 6, fields: str = 'id'):
+        self.session: Any = session
+        self.src: Path = src
+        self.mime: str = mime
+        self.size: int = src.stat().st_size
+        self.chunk_size: int = _align(chunk_size)
+        self.target_seconds: float = target_seconds
+        self.max_retries: int = max_retries
+        self.fields: str = fields  # Metadata of the uploaded file to return
+
+    def _retrying(self, what: str, request: Callable[[], Any]) -> Any:
+        return retrying(what, request, max_retries=self.max_retries)
+
+    def start(self, url: str, method: str = 'POST', metadata: Optional[Dict] = None) -> str:
+        params = dict(uploadType='resumable', fields=self.fields, supportsAllDrives='true')
+        with span('upload.start', file=self.src.name):
+            resp = self._retrying("Upload start", lambda: self.session.request(
+                method, url, params=params, json=metadata or {},
+                headers={'X-Upload-Content-Type': self.mime, 'X-Upload-Content-Length': str(self.size)}))
+        if resp.status_code != 200 or 'Location' not in resp.headers:
+            raise UploadError(f"Could not start upload: HTTP {resp.status_code}", resp.status_code)
+        return resp.headers['Location']
+
+    def _handle(self, resp) -> Any:
+        # Returns the uploaded file's metadata if done, or the offset to continue from
+        if resp.status_code in (200, 201):
+            return resp.json()
+        elif resp.status_code == 308:
+            if range_header := resp.headers.get('Range'):
+                return int(range_header.rsplit('-', 1)[1]) + 1
+            return 0
+        elif resp.status_code in (404, 410):
+            raise SessionExpired("Upload session expired", resp.status_code)
+        raise UploadError(f"Upload failed: HTTP {resp.status_code}", resp.status_code)
+
+    def query(self, uri: str) -> Any:
+        # Asks the server how much of the upload it already has
+        with span('upload.query', file=self.src.name):
+            return self._handle(self._retrying("Upload status query", lambda: self.session.put(
+                uri, headers={'Content-Range': f'bytes */{self.size}', 'Content-Length': '0'})))
+
+    def run(self, uri: str, offset: int = 0, on_progress: Optional[Callable[[int], None]] = None) -> Dict:
+        # Uploads from `offset` on; returns the uploaded file's metadata
+        failures = 0
+        with open(self.src, 'rb') as f:
+            while True:
+                if offset >= self.size:
+                    # Nothing left to send (e.g. an empty file); finalize the upload
+                    result = self.query(uri)
+                    if isinstance(result, dict):
+                        return result
+                    offset = result
+                    if offset < self.size:
+                        continue
+                    raise UploadError("Upload did not complete")
+
+                f.seek(offset)
+                data = f.read(self.chunk_size)
+                end = offset + len(data) - 1
+                start_time = time.monotonic()
+                try:
+                    with span('upload.chunk', file=self.src.name, offset=offset, bytes=len(data)):
+                        resp = self.session.put(uri, data=data, headers={
+                            'Content-Range': f'bytes {offset}-{end}/{self.size}',
+                            'Content-Length': str(len(data)),
+                        })
+                    result = self._handle(resp) if resp.status_code not in RETRY_STATUSES else None
+                except (ConnectionError, OSError) as err:
+                    log.warning("Upload chunk failed (%s), checking upload status", err)
+                    result = None
+                elapsed = time.monotonic() - start_time
+
+                if result is None:
+                    # Transient failure: find out what actually made it to the server
+                    failures += 1
+                    if failures > self.max_retries:
+                        raise UploadError("Upload failed: too many errors")
+                    time.sleep(min(2 ** failures + random.random(), 60))
+                    result = self.query(uri)
+                else:
+                    failures = 0
+                    # Aim for chunks that take `target_seconds` each: bigger chunks when the link is fast,
+                    # smaller ones (= less to resend on failures) when it is slow
+                    if elapsed < self.target_seconds / 2:
+                        self.chunk_size = _align(self.chunk_size * 2)
+                    elif elapsed > self.target_seconds * 2:
+                        self.chunk_size = _align(self.chunk_size // 2)
+
+                if isinstance(result, dict):
+                    if on_progress is not None:
+                        on_progress(self.size)
+                    return result
+                offset = result
+                if on_progress is not None:
+                    on_progress(offset)